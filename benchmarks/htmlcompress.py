@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the HTML minifiers, on a large list page
+
+- legacy normalize: HTMLCompress.normalize as it was, rescanning the stack
+  of tags for every text fragment
+- HTMLCompress.normalize: with the isolated depth counter
+- HTMLMinifier.minify: the runtime minifier, on the whole page
+- HTMLMinifier.minify_stream: the runtime minifier, on `generate()`
+
+    python benchmarks/htmlcompress.py [number]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from jinja2 import Environment
+from jinja2.lexer import Token
+from mocha.extras import htmlcompress
+from mocha.extras.htmlcompress import (HTMLCompress,
+                                       HTMLMinifier,
+                                       StreamProcessContext)
+
+TEMPLATE = """
+<html>
+  <head>
+    <style>
+      body { margin: 0 }
+    </style>
+  </head>
+  <body>
+    <div class="list">
+      <ul>
+      {% for i in items %}
+        <li class="item">
+          <a href="/item/{{ i }}">  Item   {{ i }}  </a>
+          <p>
+            Some    description  of the item
+          </p>
+        </li>
+      {% endfor %}
+      </ul>
+      <pre>
+        keep   this
+      </pre>
+    </div>
+  </body>
+</html>
+"""
+
+
+class LegacyHTMLCompress(HTMLCompress):
+    """ HTMLCompress before the isolated depth counter """
+
+    def normalize(self, ctx):
+        pos = 0
+        buffer = []
+
+        def write_data(value):
+            if not self.is_isolated(ctx.stack):
+                value = htmlcompress.gl_ws_normalize_re.sub(' ', value)
+            buffer.append(value)
+
+        for match in htmlcompress.gl_tag_re.finditer(ctx.token.value):
+            closes, tag, sole = match.groups()
+            preamble = ctx.token.value[pos:match.start()]
+            write_data(preamble)
+            if sole:
+                write_data(sole)
+            else:
+                buffer.append(match.group())
+                (closes and self.leave_tag or self.enter_tag)(tag, ctx)
+            pos = match.end()
+
+        write_data(ctx.token.value[pos:])
+        return ''.join(buffer)
+
+
+def normalize(ext, html):
+    ctx = StreamProcessContext(type("Stream", (), {"name": None,
+                                                    "filename": None}))
+    ctx.token = Token(1, "data", html)
+    return ext.normalize(ctx)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    env = Environment()
+    tpl = env.from_string(TEMPLATE)
+    items = range(2000)
+    html = tpl.render(items=items)
+    size = len(html) / 1024.0 / 1024.0
+
+    legacy = LegacyHTMLCompress(env)
+    current = HTMLCompress(env)
+    assert normalize(legacy, html) == normalize(current, html)
+    assert normalize(current, html) == HTMLMinifier.minify(html)
+
+    cases = [
+        ("legacy normalize", lambda: normalize(legacy, html)),
+        ("HTMLCompress.normalize", lambda: normalize(current, html)),
+        ("HTMLMinifier.minify", lambda: HTMLMinifier.minify(html)),
+        ("HTMLMinifier.minify_stream",
+         lambda: "".join(HTMLMinifier.minify_stream(tpl.generate(items=items)))),
+        ("generate() only",
+         lambda: "".join(tpl.generate(items=items))),
+    ]
+
+    print("%.2fMB page, %s runs" % (size, number))
+    for name, fn in cases:
+        elapsed = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        print("%-28s %8.2fms  %6.1fMB/s" % (name, elapsed * 1000,
+                                            size / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of mocha.extras.md.html under threads
+
+It compares the legacy path, which built a new Markdown instance with its
+extensions on every call, with the pooled instances, and with the pool plus
+the content hash LRU.
+
+    python benchmarks/markdown_pool.py [number] [threads]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import markdown
+from mocha.extras import md
+
+TEXT = """
+# Title
+
+[TOC]
+
+Some *text* with a [link](http://example.com) and an image
+
+![image](http://example.com/a.png)
+
+## Section
+
+- one
+- two
+- three
+
+| a | b |
+|---|---|
+| 1 | 2 |
+
+[[embed]](http://example.com/video)
+""" * 4
+
+
+def legacy_html(text, lazy_images=False):
+    extensions = [
+        'markdown.extensions.nl2br',
+        'markdown.extensions.sane_lists',
+        'markdown.extensions.toc',
+        'markdown.extensions.tables',
+        md.OEmbedExtension()
+    ]
+    if lazy_images:
+        extensions.append(md.LazyImageExtension())
+    return markdown.markdown(text, extensions=extensions)
+
+
+def run(fn, number, threads):
+    pool = ThreadPool(threads)
+    start = time.time()
+    pool.map(lambda _: fn(TEXT), range(number))
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    return elapsed
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    assert legacy_html(TEXT) == md.html(TEXT)
+
+    results = []
+    md.set_cache_size(0)
+    results.append(("legacy", run(legacy_html, number, threads)))
+    results.append(("pooled", run(md.html, number, threads)))
+    md.set_cache_size(256)
+    results.append(("pooled + lru", run(md.html, number, threads)))
+    md.set_cache_size(0)
+
+    print("%s calls, %s threads" % (number, threads))
+    base = results[0][1]
+    for name, elapsed in results:
+        print("%-14s %8.1f us/call  x%.2f" % (name,
+                                              elapsed / number * 1e6,
+                                              base / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the per request overhead of Mocha.make_proxy_method
+
+It compares the legacy proxy, which resolved the hooks and the template on
+every request, with the proxy running from the precompiled dispatch record.
+
+The view and the renderer do as little as possible, so the numbers are the
+cost of the proxy itself.
+
+    python benchmarks/proxy_dispatch.py [number]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+import functools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import Flask, Response, make_response, g, request as f_request
+from mocha import core
+from mocha.core import Mocha, request, utils
+
+
+class Bench(Mocha):
+
+    @classmethod
+    def render(cls, data={}, _template=None, _layout=None, **kwargs):
+        return "ok"
+
+    def before_request(self, name, **kwargs):
+        pass
+
+    def after_request(self, name, response):
+        return response
+
+    def index(self):
+        return {}
+
+
+def legacy_make_proxy_method(cls, name):
+    """ The proxy as it was before the dispatch record """
+
+    i = cls()
+    view = getattr(i, name)
+
+    for decorator in cls.decorators:
+        view = decorator(view)
+
+    @functools.wraps(view)
+    def proxy(**forgettable_view_args):
+        del forgettable_view_args
+
+        if hasattr(i, "before_request"):
+            response = i.before_request(name, **request.view_args)
+            if response is not None:
+                return response
+
+        before_view_name = "before_" + name
+        if hasattr(i, before_view_name):
+            before_view = getattr(i, before_view_name)
+            response = before_view(**request.view_args)
+            if response is not None:
+                return response
+
+        response = view(**request.view_args)
+
+        if isinstance(response, dict) or response is None:
+            response = response or {}
+            if hasattr(i, "_renderer"):
+                response = i._renderer(response)
+            else:
+                _template = core.build_endpoint_route_name(cls, view.__name__)
+                _template = utils.list_replace([".", ":"], "/", _template)
+                _template = "%s.%s" % (_template, cls.template_markup)
+
+                _meta_title = getattr(g, "__META__", {}).get("title")
+                if (not _meta_title or _meta_title == "") \
+                        and core.get_view_attr(view, "title"):
+                    core.page_attr(title=core.get_view_attr(view, "title"))
+
+                response.setdefault("_template", _template)
+                response = i.render(**response)
+
+        if not isinstance(response, Response):
+            response = make_response(response)
+
+        for ext in cls._ext:
+            response = ext(response)
+
+        after_view_name = "after_" + name
+        if hasattr(i, after_view_name):
+            after_view = getattr(i, after_view_name)
+            response = after_view(response)
+
+        if hasattr(i, "after_request"):
+            response = i.after_request(name, response)
+
+        return response
+
+    return proxy
+
+
+def run(number=20000):
+    app = Flask(__name__)
+    proxies = [
+        ("legacy", legacy_make_proxy_method(Bench, "index")),
+        ("dispatch", Bench.make_proxy_method("index")),
+    ]
+
+    with app.test_request_context("/bench/"):
+        f_request.view_args = {}
+        results = {}
+        for label, proxy in proxies:
+            proxy()
+            results[label] = min(timeit.repeat(proxy, number=number, repeat=5))
+
+    for label, _ in proxies:
+        t = results[label]
+        print("%-10s %8.2f us/request" % (label, t / number * 1e6))
+    print("speedup    %8.2fx" % (results["legacy"] / results["dispatch"]))
+
+
+if __name__ == "__main__":
+    run(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+XML serialization of nested payloads, xml_serializer vs dicttoxml
+
+- flat: a list of small records
+- nested: records with nested dicts and lists
+- deep: a tree of dicts, a few levels deep
+- wide keys: records with many distinct keys, some needing sanitization
+
+    python benchmarks/xml_serializer.py [number]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dicttoxml import dicttoxml
+from mocha.extras import xml_serializer
+
+
+def flat(n=2000):
+    return [{"id": i, "name": "Item %s" % i, "price": i * 1.5,
+             "active": i % 2 == 0} for i in range(n)]
+
+
+def nested(n=500):
+    return {"posts": [{"id": i,
+                       "title": "Post <%s> & co" % i,
+                       "created_at": datetime.datetime(2017, 1, 2, 3, 4, 5),
+                       "author": {"id": i % 10, "name": "Author %s" % i},
+                       "tags": ["flask", "mocha", "xml"],
+                       "comments": [{"id": j, "body": "Comment %s" % j,
+                                     "score": None} for j in range(5)]}
+                      for i in range(n)]}
+
+
+def deep(depth=6, width=4):
+    if depth == 0:
+        return "leaf"
+    return {"node_%s" % i: deep(depth - 1, width) for i in range(width)}
+
+
+def wide_keys(n=200):
+    # String keys only: dicttoxml fails on int keys
+    return [{("key %s" % k if k % 3 else "%s" % k): k for k in range(50)}
+            for _ in range(n)]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    payloads = [
+        ("flat", flat()),
+        ("nested", nested()),
+        ("deep", deep()),
+        ("wide keys", wide_keys()),
+    ]
+
+    print("%s runs" % number)
+    print("%-12s %12s %12s %8s" % ("payload", "dicttoxml", "xml_serial.",
+                                   "speedup"))
+    for name, data in payloads:
+        assert xml_serializer.dumps(data) == dicttoxml(data)
+        times = []
+        for fn in (dicttoxml, xml_serializer.dumps):
+            elapsed = min(timeit.repeat(lambda: fn(data), number=number,
+                                        repeat=3)) / number
+            times.append(elapsed)
+        print("%-12s %10.2fms %10.2fms %7.1fx" % (name,
+                                                   times[0] * 1000,
+                                                   times[1] * 1000,
+                                                   times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
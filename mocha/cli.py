@@ -21,6 +21,7 @@ ________________________________________________________________________________
 import os
 import re
 import sys
+import time
 import traceback
 import logging
 import importlib
@@ -297,6 +298,52 @@ def assets2s3():
     print("")
 
 
+@cli.command(":warm-templates")
+@click.option("--workers", "-w", default=4)
+@catch_exception
+def warm_templates(workers):
+    """ Compile all the templates ahead, into TEMPLATE_CACHE_DIR """
+    header("Warming templates ...")
+    print("")
+    app = application.app
+    if not app.config.get("TEMPLATE_CACHE_DIR") \
+            and not app.config.get("TEMPLATE_BYTECODE_CACHE"):
+        print("** TEMPLATE_CACHE_DIR or TEMPLATE_BYTECODE_CACHE is not set in the config")
+        return
+    from .core import Mocha
+    start = time.time()
+    with app.app_context():
+        results = Mocha.precompile_templates(workers=workers)
+    errors = 0
+    for name, elapsed, error in sorted(results, key=lambda r: -r[1]):
+        if error:
+            errors += 1
+            print("ERROR: %s - %s" % (name, error))
+        else:
+            print("%8.1fms  %s" % (elapsed * 1000, name))
+    print("")
+    print("- Templates: %s" % len(results))
+    print("- Errors: %s" % errors)
+    print("- Time: %.2fs" % (time.time() - start))
+    print("")
+
+
+@cli.command(":worker")
+@click.option("--burst", "-b", is_flag=True, default=False)
+@catch_exception
+def worker(burst):
+    """ Run the queued tasks. TASKS_BACKEND must be 'sql' or 'redis://' """
+    header("Running tasks worker ...")
+    print("")
+    app = application.app
+    from .tasks import tasks
+    print("- Backend: %s" % app.config.get("TASKS_BACKEND"))
+    print("")
+    count = tasks.work(burst=burst)
+    print("- Jobs: %s" % count)
+    print("")
+
+
 @cli.command(":version")
 def version():
     print("-" * 80)
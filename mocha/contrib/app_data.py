@@ -3,15 +3,80 @@ Application Data
 
 Simple K/V store for application data. 
 
+Reads go through a process local cache. Each key has a version stored in
+`mocha.cache`; `set()` changes it, so other workers drop their stale entry
+the next time they check the version, at most every APP_DATA_CACHE_TTL seconds.
+When `mocha.cache` is per process (null, simple), the other workers can't see
+the version, so the local entry is read again from the db after
+APP_DATA_CACHE_TTL seconds.
+
 """
 
 import copy
-from mocha import (db, utils)
+import time
+from mocha import (db, utils, cache, config)
+from mocha.ext import is_cache_shared
+
+# Process local cache: {key: (version, value, check_at)}
+_local_cache = {}
+
 
 def make_key(key):
     return utils.slugify(key)
 
 
+def _version_key(key):
+    return "mocha:contrib:app_data:version:%s" % key
+
+
+def _data_key(key, version):
+    return "mocha:contrib:app_data:data:%s:%s" % (key, version)
+
+
+def _get_value(key):
+    """
+    Read through the local cache, then mocha.cache, then the db
+    :param key: the slugified key
+    :return: dict_dot
+    """
+    now = time.time()
+    entry = _local_cache.get(key)
+    if entry and now < entry[2]:
+        return entry[1]
+
+    check_at = now + config("APP_DATA_CACHE_TTL", 5)
+    if not is_cache_shared():
+        value = utils.dict_dot(AppData.get_by_key(key) or {})
+        _local_cache[key] = (None, value, check_at)
+        return value
+
+    version = cache.get(_version_key(key))
+    if version is None:
+        version = utils.guid()
+        cache.set(_version_key(key), version, timeout=0)
+    elif entry and entry[0] == version:
+        _local_cache[key] = (version, entry[1], check_at)
+        return entry[1]
+
+    value = cache.get(_data_key(key, version))
+    if value is None:
+        value = AppData.get_by_key(key) or {}
+        cache.set(_data_key(key, version), value)
+    value = utils.dict_dot(value)
+    _local_cache[key] = (version, value, check_at)
+    return value
+
+
+def _invalidate(key):
+    """
+    Publish a new version of the key, and drop the local entry
+    :param key: the slugified key
+    """
+    if is_cache_shared():
+        cache.set(_version_key(key), utils.guid(), timeout=0)
+    _local_cache.pop(key, None)
+
+
 def get(key, node=None, default=None):
     """
     Retrieve data
@@ -22,10 +87,16 @@ def get(key, node=None, default=None):
     :param default:
     :return: dict_dot dict object
     """
-    d = AppData.get_by_key(key)
+    d = _get_value(make_key(key))
     if d:
-        data = utils.dict_dot(d)
-        return data.get(node, default) if node else data
+        # A copy, so the caller can't change the cached value. For a node,
+        # only the node is copied, and only if it's a dict or a list
+        if node:
+            value = d.get(node, default)
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+            return value
+        return utils.dict_dot(copy.deepcopy(d))
     return {}
 
 
@@ -47,6 +118,7 @@ def set(key, value={}, reset=False, init=False):
     k = AppData.get_by_key(key, True)
     if not k:
         AppData.create(key=make_key(key), value=value)
+        _invalidate(make_key(key))
     else:
         if init is False:
             if reset is False:
@@ -54,6 +126,7 @@ def set(key, value={}, reset=False, init=False):
                 value = copy.deepcopy(k.value)
                 value.update(nv)
             k.update(value=value)
+            _invalidate(make_key(key))
 
 
 class AppData(db.Model):
@@ -63,6 +136,6 @@ class AppData(db.Model):
     @classmethod
     def get_by_key(cls, key, as_object=False):
         key = make_key(key)
-        r = cls.query().filter(key == key).first()
+        r = cls.query().filter(cls.key == key).first()
         return r.value if r and as_object is False else r
 
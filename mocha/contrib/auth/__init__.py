@@ -3,6 +3,8 @@ Mocha Auth
 """
 
 import logging
+import threading
+from six.moves import cPickle as pickle
 from . import signals, exceptions, oauth
 import flask_login
 from flask import current_app
@@ -11,6 +13,8 @@ import mocha.cli
 from mocha import (_,
                    utc_now,
                    config,
+                   db,
+                   cache,
                    abort,
                    send_mail,
                    url_for,
@@ -54,6 +58,8 @@ init_app(login_manager.init_app)
 
 @login_manager.user_loader
 def load_user(userid):
+    if __options__.get("user_cache"):
+        return _user(_get_cached_user(userid))
     return get_user_by_id(userid)
 
 
@@ -77,6 +83,102 @@ def load_user(userid):
 
 
 
+# ------------------------------------------------------------------------------
+# USER CACHE
+# An optional identity cache for `load_user`, so authenticated requests don't
+# have to query the user and its role. Set in the AUTH options:
+#   "user_cache": "local" for a per process LRU, or "cache" for `mocha.cache`
+#   "user_cache_ttl": seconds to keep a user, default 60
+#   "user_cache_size": max number of users in the "local" cache, default 1000
+#
+# Entries are dropped on `signals.user_update` and `signals.user_login`, and
+# when the user's secret key is reset or the user is deleted.
+# The "local" cache can't be invalidated across processes, so keep its ttl short
+
+_user_cache_local = None
+_user_cache_stats = {"hits": 0, "misses": 0}
+_user_cache_stats_lock = threading.Lock()
+
+
+def _user_cache_key(id):
+    return "mocha:contrib:auth:user:%s" % id
+
+
+def _get_user_cache_local():
+    global _user_cache_local
+    if _user_cache_local is None:
+        _user_cache_local = utils.LRUCache(
+            maxsize=__options__.get("user_cache_size", 1000),
+            ttl=__options__.get("user_cache_ttl", 60))
+    return _user_cache_local
+
+
+def _get_cached_user(id):
+    """
+    Return the AuthUser, with its role, from the cache or from the db.
+    The cache holds a pickled snapshot, which is merged into the current
+    session without querying the db
+    :param id: int
+    :return: AuthUser
+    """
+    key = _user_cache_key(id)
+    local = __options__.get("user_cache") == "local"
+    data = _get_user_cache_local().get(key) if local else cache.get(key)
+    if data is not None:
+        with _user_cache_stats_lock:
+            _user_cache_stats["hits"] += 1
+        return db.session.merge(pickle.loads(data), load=False)
+
+    with _user_cache_stats_lock:
+        _user_cache_stats["misses"] += 1
+    user = models.AuthUser.query()\
+        .options(db.joinedload(models.AuthUser.role))\
+        .filter(models.AuthUser.id == id)\
+        .first()
+    if user:
+        data = pickle.dumps(user, pickle.HIGHEST_PROTOCOL)
+        if local:
+            _get_user_cache_local().set(key, data)
+        else:
+            cache.set(key, data, timeout=__options__.get("user_cache_ttl", 60))
+    return user
+
+
+def delete_cached_user(id):
+    """
+    Remove a user from the identity cache
+    :param id: int
+    """
+    if __options__.get("user_cache"):
+        key = _user_cache_key(id)
+        if __options__.get("user_cache") == "local":
+            _get_user_cache_local().delete(key)
+        else:
+            cache.delete(key)
+
+
+def get_user_cache_stats():
+    """
+    Return the hits and misses of the identity cache
+    :return: dict
+    """
+    with _user_cache_stats_lock:
+        return dict(_user_cache_stats)
+
+
+@signals.user_update.observe
+def _user_cache_on_update(result, **kw):
+    user = kw.get("kwargs", {}).get("user")
+    if user:
+        delete_cached_user(user.id)
+
+
+@signals.user_login.observe
+def _user_cache_on_login(result, **kw):
+    if result:
+        delete_cached_user(result.id)
+
+
 # ------------------------------------------------------------------------------
 
 def is_authenticated():
@@ -17,6 +17,21 @@ from . import (is_authenticated,
                login_manager)
 
 
+# The attribute set by @login_not_required on the views it decorates
+LOGIN_NOT_REQUIRED_ATTR = "_login_not_required"
+
+
+def is_login_not_required(func):
+    """
+    Check if a view, or any function it wraps, has been decorated
+    with @login_not_required
+    :param func:
+    :return: bool
+    """
+    return any(getattr(f, LOGIN_NOT_REQUIRED_ATTR, False)
+               for f in utils.get_wrapped_functions(func))
+
+
 def login_required(func):
     """
     A wrapper around the flask_login.login_required.
@@ -30,10 +45,13 @@ def login_required(func):
         apply_function_to_members(func, login_required)
         return func
     else:
+        # Resolved once, when decorating
+        if is_login_not_required(func):
+            return func
+
         @functools.wraps(func)
         def decorated_view(*args, **kwargs):
-            if "login_not_required" not in utils.get_decorators_list(func) \
-                    and not_authenticated():
+            if not_authenticated():
                 return login_manager.unauthorized()
             return func(*args, **kwargs)
 
@@ -42,8 +60,7 @@ def login_required(func):
 
 def login_not_required(func):
     """
-    Dummy decorator. @login_required will inspect the method
-    to look for this decorator
+    Marker decorator. @login_required will look for this marker on the method
     Use this decorator when you want do not require login in a "@login_required" class/method
     :param func:
     :return:
@@ -53,6 +70,7 @@ def login_not_required(func):
     def decorated_view(*args, **kwargs):
         return func(*args, **kwargs)
 
+    setattr(decorated_view, LOGIN_NOT_REQUIRED_ATTR, True)
     return decorated_view
 
 
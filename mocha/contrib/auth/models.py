@@ -1,4 +1,5 @@
 
+import time
 import datetime
 import arrow
 from . import exceptions
@@ -6,10 +7,23 @@ from mocha import (db,
                    utils,
                    send_mail,
                    bcrypt,
+                   cache,
+                   config,
                    _)
+from mocha.ext import is_cache_shared
 from mocha.exceptions import ModelError
 
 
+def _delete_cached_user(id):
+    """
+    Remove a user from the identity cache of mocha.contrib.auth, which
+    imports this module
+    :param id: int
+    """
+    from . import delete_cached_user
+    delete_cached_user(id)
+
+
 class AuthUserRole(db.Model):
 
     SUPERADMIN = "SUPERADMIN"  # ALL MIGHTY, RESERVED FOR SYS ADMIN
@@ -32,6 +46,19 @@ class AuthUserRole(db.Model):
     name = db.Column(db.String(75), index=True)
     level = db.Column(db.Integer, index=True)
 
+    # Process wide map of the roles table: {id: (name, level)}
+    # It is loaded on first use, and reset when roles are changed. Other workers
+    # reload it when its version in `mocha.cache` changes, or, if the cache is
+    # per process, after AUTH_ROLES_MAP_TTL seconds
+    _roles_map = None
+    _roles_map_version = None
+    _roles_map_expire_at = 0
+    _ROLES_MAP_VERSION_KEY = "mocha:contrib:auth:roles_map:version"
+
+    # Memoized slugified role names: {roles tuple: frozenset}
+    _slug_names = {}
+    _SLUG_NAMES_MAX_SIZE = 1000
+
     @classmethod
     def initialize__(cls):
         """
@@ -45,7 +72,81 @@ class AuthUserRole(db.Model):
     def new(cls, name, level):
         name = cls.slug_name(name)
         if not cls.get_by_name(name) and not cls.get_by_level(level):
-            return cls.create(name=name, level=level)
+            role = cls.create(name=name, level=level)
+            cls.reset_roles_map()
+            return role
+
+    def update(self, **kwargs):
+        role = super(AuthUserRole, self).update(**kwargs)
+        self.reset_roles_map()
+        return role
+
+    def delete(self, delete=True, hard_delete=False):
+        r = super(AuthUserRole, self).delete(delete=delete,
+                                             hard_delete=hard_delete)
+        self.reset_roles_map()
+        return r
+
+    @classmethod
+    def get_roles_map(cls):
+        """
+        Return the map of all the roles, loaded once per process, and again
+        when it's changed by another worker
+        :return: dict {id: (name, level)}
+        """
+        now = time.time()
+        version = None
+        if is_cache_shared():
+            version = cache.get(cls._ROLES_MAP_VERSION_KEY)
+        if cls._roles_map is None \
+                or version != cls._roles_map_version \
+                or now >= cls._roles_map_expire_at:
+            cls._roles_map = {r.id: (r.name, r.level) for r in cls.query()}
+            cls._roles_map_version = version
+            cls._roles_map_expire_at = now + config("AUTH_ROLES_MAP_TTL", 10)
+        return cls._roles_map
+
+    @classmethod
+    def reset_roles_map(cls):
+        """
+        Invalidate the roles map. It will be loaded again on next use, by this
+        process and the ones sharing `mocha.cache`
+        """
+        cls._roles_map = None
+        if is_cache_shared():
+            cache.set(cls._ROLES_MAP_VERSION_KEY, utils.guid(), timeout=0)
+
+    @classmethod
+    def get_info(cls, id):
+        """
+        Return the name and level of a role from the roles map
+        :param id: int - the role id
+        :return: tuple (name, level), or (None, None) if it doesn't exist
+        """
+        if id is None:
+            return None, None
+        roles_map = cls.get_roles_map()
+        if id not in roles_map:
+            # The role may have been created by another process
+            cls.reset_roles_map()
+            roles_map = cls.get_roles_map()
+        return roles_map.get(id, (None, None))
+
+    @classmethod
+    def slug_names(cls, roles):
+        """
+        Return the slugified role names, memoized
+        :param roles: tuple of roles string
+        :return: frozenset
+        """
+        roles = tuple(roles)
+        try:
+            return cls._slug_names[roles]
+        except KeyError:
+            names = frozenset(map(cls.slug_name, roles))
+            if len(cls._slug_names) < cls._SLUG_NAMES_MAX_SIZE:
+                cls._slug_names[roles] = names
+            return names
 
     @classmethod
     def get_by_name(cls, name):
@@ -91,6 +192,9 @@ class AuthUser(db.Model):
     # Relationship to role
     role = db.relationship(AuthUserRole)
 
+    # The (role_id, (name, level)) of the role, resolved once per instance
+    _role_info = None
+
     @classmethod
     def encrypt_password(cls, password):
         return bcrypt.hash(password)
@@ -271,6 +375,12 @@ class AuthUser(db.Model):
         BTW, AuthUserLogin.change_password, already performs this method
         """
         self.update(secret_key=utils.guid())
+        _delete_cached_user(self.id)
+
+    def delete(self, delete=True, hard_delete=False):
+        r = super(AuthUser, self).delete(delete=delete, hard_delete=hard_delete)
+        _delete_cached_user(self.id)
+        return r
 
     def set_options(self, **kwargs):
         """
@@ -287,6 +397,26 @@ class AuthUser(db.Model):
         if not role_:
             raise ModelError("Invalid user role: '%s'" % role)
         self.update(role=role_)
+        self._role_info = None
+        AuthUserRole.reset_roles_map()
+
+    def get_role_info(self):
+        """
+        Return the name and level of the user's role.
+        It uses the `role` relationship if it's already loaded, otherwise the
+        roles map, so it doesn't query the db. It's resolved once per instance,
+        and again if the role_id changes
+        :return: tuple (name, level)
+        """
+        role_id = self.role_id
+        if self._role_info is None or self._role_info[0] != role_id:
+            role = self.__dict__.get("role")
+            if role is not None and role.id == role_id:
+                info = (role.name, role.level)
+            else:
+                info = AuthUserRole.get_info(role_id)
+            self._role_info = (role_id, info)
+        return self._role_info[1]
 
     def has_any_roles(self, *roles):
         """
@@ -294,15 +424,7 @@ class AuthUser(db.Model):
         :param roles: tuple of roles string
         :return: bool
         """
-        roles = map(utils.slugify, list(roles))
-
-        return True \
-            if AuthUserRole.query() \
-            .join(AuthUser) \
-            .filter(AuthUserRole.name.in_(roles)) \
-            .filter(AuthUser.id == self.id) \
-            .count() \
-            else False
+        return self.get_role_info()[0] in AuthUserRole.slug_names(roles)
 
 
 class AuthUserFederation(db.Model):
@@ -757,6 +757,7 @@ class Admin(Mocha):
         return [(r.id, r.name.upper()) for r in _r]
 
     @render.nav("All Users")
+    @render.stream
     @render.template("contrib/auth/Admin/index.jade")
     def index(self):
 
@@ -786,7 +787,7 @@ class Admin(Mocha):
             else:
                 users = users.order_by(getattr(models.AuthUser, col).desc())
 
-        users = paginate(users)
+        users = paginate(users, mode="estimate")
 
         sorting = [("username__asc", "Username ASC"),
                    ("username__desc", "Username DESC"),
@@ -10,12 +10,14 @@ import re
 import os
 import sys
 import six
+import time
 import arrow
 import jinja2
 import inspect
 import logging
 import werkzeug
 import functools
+import collections
 from . import utils
 import pkg_resources
 import logging.config
@@ -25,6 +27,7 @@ from .extras.mocha_db import MochaDB
 from flask_assets import Environment
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.routing import (BaseConverter, parse_rule)
+from werkzeug.http import is_resource_modified
 from flask import (Flask,
                    g,
                    render_template,
@@ -32,10 +35,15 @@ from flask import (Flask,
                    session,
                    make_response,
                    Response,
+                   current_app,
+                   stream_with_context,
+                   get_flashed_messages,
+                   _request_ctx_stack,
                    request as f_request,
                    abort,
                    url_for as f_url_for,
                    redirect as f_redirect)
+from flask.signals import before_render_template, template_rendered
 
 # ------------------------------------------------------------------------------
 
@@ -264,6 +272,46 @@ python
     setattr(g, "__META__", meta)
 
 
+def _check_conditional(etag=None, last_modified=None):
+    """
+    Keep the validators supplied by the view for the response, and return a
+    304 response if the client holds the same copy already, so the response
+    doesn't need to be built.
+    :param etag: str - a strong etag
+    :param last_modified: datetime or Arrow
+    :return: Response or None
+    """
+    if last_modified is not None:
+        last_modified = arrow.get(last_modified).to("utc").naive
+    g.__CONDITIONAL__ = etag, last_modified
+    if f_request.method not in ("GET", "HEAD") \
+            or is_resource_modified(f_request.environ,
+                                    etag=etag,
+                                    last_modified=last_modified):
+        return None
+    response = Response(status=304)
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def _stream_with_context(generator):
+    """
+    Like flask.stream_with_context, to keep the request context while a
+    response is streamed. It pushes the request context again, which reopens
+    the session on older Flask, so the one changed by the view is kept.
+    :param generator:
+    :return: generator
+    """
+    ctx = _request_ctx_stack.top
+    session = ctx.session
+    stream = stream_with_context(generator)
+    ctx.session = session
+    return stream
+
+
 def flash_success(msg):
     """
     Alias to flash, but set a success message
@@ -421,11 +469,9 @@ def redirect(endpoint, **kw):
         if "/" in endpoint:
             return f_redirect(endpoint)
         else:
-            for r in Mocha._app.url_map.iter_rules():
-                _endpoint = endpoint
-                if 'GET' in r.methods and endpoint in r.endpoint:
-                    _endpoint = r.endpoint
-                    break
+            _endpoint = Mocha._endpoints.resolve(endpoint) \
+                or Mocha._endpoints.scan(Mocha._app.url_map, endpoint) \
+                or endpoint
     else:
         # self, will refer the caller method, by getting the method name
         if isinstance(endpoint, Mocha):
@@ -450,6 +496,9 @@ def _get_action_endpoint(action):
     """
     _endpoint = None
     if is_method(action):
+        _endpoint = Mocha._endpoints.resolve_action(action)
+        if _endpoint:
+            return _endpoint
         if hasattr(action, "_rule_cache"):
             rc = action._rule_cache
             if rc:
@@ -463,11 +512,9 @@ def _get_action_endpoint(action):
                         _endpoint = _build_endpoint_route_name(action)
                 elif len_rules > 1:
                     _prefix = _build_endpoint_route_name(action)
-                    for r in Mocha._app.url_map.iter_rules():
-                        if ('GET' in r.methods or 'POST' in r.methods) \
-                                and _prefix in r.endpoint:
-                            _endpoint = r.endpoint
-                            break
+                    _endpoint = Mocha._endpoints.scan(Mocha._app.url_map,
+                                                      _prefix,
+                                                      ("GET", "POST"))
     return _endpoint
 
 
@@ -611,6 +658,172 @@ request = _RequestProxy()
 
 # ------------------------------------------------------------------------------
 
+# The per endpoint dispatch record, resolved once at registration.
+# Hooks that are not defined on the view are None
+_ViewDispatch = collections.namedtuple("_ViewDispatch", ["view",
+                                                         "before_request",
+                                                         "before_view",
+                                                         "renderer",
+                                                         "template",
+                                                         "title",
+                                                         "extensions",
+                                                         "after_view",
+                                                         "after_request"])
+
+
+class _EndpointIndex(object):
+    """
+    Index of the endpoints registered by the Mocha views, so `redirect`,
+    `url_for` and `_get_action_endpoint` don't have to scan the url map.
+
+    Actions are added while the views are registered. The endpoint fragments
+    are indexed when Mocha has registered all the views, then the index is
+    frozen. Each app gets its own index.
+    Fragments matching more than one action are reported at that time, and
+    resolving them raises an error, since the endpoint can't be told.
+    The fragments that are not indexed are scanned for once, see `scan`.
+
+    Fragments are the '.' separated suffixes of an endpoint that still contain
+    the method, ie: for 'main.Index:hello_0'
+        main.Index:hello_0, Index:hello_0, main.Index:hello, Index:hello
+    """
+
+    _multi_rule_re = re.compile(r"_\d+$")
+
+    def __init__(self):
+        self.frozen = False
+        self.ambiguous = {}
+        self._actions = {}
+        self._functions = {}
+        self._fragments = {}
+        self._scanned = {}
+
+    def add_action(self, cls, name, fn, endpoints):
+        """
+        Add the endpoints of an action
+        :param cls: the view class
+        :param name: the name of the method
+        :param fn: the function of the method
+        :param endpoints: list of tuple (endpoint, methods), in the order they
+                          were added to the url map
+        """
+        if self.frozen:
+            raise exceptions.MochaError("The endpoint index is frozen. "
+                                        "'%s.%s' can't be added" % (cls.__name__, name))
+        if not endpoints:
+            return
+        # The first endpoint accepting GET or POST, otherwise the first one
+        endpoint = endpoints[0][0]
+        for ep, methods in endpoints:
+            methods = [m.upper() for m in methods]
+            if "GET" in methods or "POST" in methods:
+                endpoint = ep
+                break
+        self._actions[(cls, name)] = endpoint
+        # A function inherited by several views can only be resolved with its
+        # class, ie: as a bound method
+        func = getattr(fn, "__func__", fn)
+        if self._functions.get(func, endpoint) != endpoint:
+            self._functions[func] = None
+        else:
+            self._functions[func] = endpoint
+
+    def freeze(self, url_map):
+        """
+        Index the fragments of all the GET endpoints and freeze the index
+        :param url_map: the app url_map
+        """
+        fragments = {}
+        for r in url_map.iter_rules():
+            if r.methods and "GET" not in r.methods:
+                continue
+            for fragment in self._get_fragments(r.endpoint):
+                endpoints = fragments.setdefault(fragment, [])
+                if r.endpoint not in endpoints:
+                    endpoints.append(r.endpoint)
+
+        # Rules of the same action (ie: hello_0, hello_1) are not ambiguous
+        self.ambiguous = {f: e for f, e in fragments.items()
+                          if len(set([self._multi_rule_re.sub("", _) for _ in e])) > 1}
+        for fragment in sorted(self.ambiguous):
+            logging.warning("Ambiguous endpoint '%s' matches: %s"
+                            % (fragment, ", ".join(self.ambiguous[fragment])))
+
+        self._fragments = {f: e[0] for f, e in fragments.items()}
+        self.frozen = True
+
+    def resolve(self, fragment):
+        """
+        Return the endpoint of an endpoint fragment
+        :param fragment: string
+        :return: string or None
+        :raise: MochaError if the fragment matches more than one action
+        """
+        if fragment in self.ambiguous:
+            raise exceptions.MochaError("Ambiguous endpoint '%s' matches: %s. "
+                                        "Use a longer endpoint"
+                                        % (fragment,
+                                           ", ".join(self.ambiguous[fragment])))
+        return self._fragments.get(fragment)
+
+    def scan(self, url_map, fragment, methods=("GET",)):
+        """
+        Return the first endpoint containing the fragment, for the fragments
+        that are not indexed, ie: a part of a method name.
+        It scans the url map once per fragment, and logs it, so the caller
+        can use an indexed endpoint instead
+        :param url_map: the app url_map
+        :param fragment: string
+        :param methods: tuple - the rule must accept one of them
+        :return: string or None
+        """
+        key = (fragment, methods)
+        if key not in self._scanned:
+            logging.warning("Endpoint '%s' is not indexed, the url map is "
+                            "scanned for it" % fragment)
+            endpoint = None
+            for r in url_map.iter_rules():
+                if (not r.methods or set(methods) & r.methods) \
+                        and fragment in r.endpoint:
+                    endpoint = r.endpoint
+                    break
+            self._scanned[key] = endpoint
+        return self._scanned[key]
+
+    def resolve_action(self, action):
+        """
+        Return the endpoint of a view's method
+        :param action: the method, bound or not
+        :return: string or None
+        """
+        owner = getattr(action, "im_class", None) \
+            or getattr(action, "__self__", None)
+        if owner is not None:
+            if not inspect.isclass(owner):
+                owner = owner.__class__
+            _endpoint = self._actions.get((owner, action.__name__))
+            if _endpoint:
+                return _endpoint
+        return self._functions.get(getattr(action, "__func__", action))
+
+    @classmethod
+    def _get_fragments(cls, endpoint):
+        module_class, _, method = endpoint.partition(":")
+        if not method:
+            return [endpoint]
+
+        methods = [method]
+        base_method = cls._multi_rule_re.sub("", method)
+        if base_method != method:
+            methods.append(base_method)
+
+        parts = module_class.split(".")
+        return ["%s:%s" % (".".join(parts[i:]), m)
+                for m in methods
+                for i in range(len(parts))]
+
+# ------------------------------------------------------------------------------
+
 
 class Mocha(object):
     decorators = []
@@ -619,9 +832,10 @@ class Mocha(object):
     trailing_slash = True
     base_layout = "layouts/base.jade"
     template_markup = "jade"
+    template_stream = False
     assets = None
     logger = None
-    _ext = set()
+    _ext = []
     __special_methods = ["get", "put", "patch", "post", "delete", "index"]
     _installed_apps = []
     _app = None
@@ -629,6 +843,8 @@ class Mocha(object):
     _template_paths = set()
     _static_paths = set()
     _asset_bundles = set()
+    _template_names = {}
+    _endpoints = _EndpointIndex()
 
     @classmethod
     def __call__(cls,
@@ -725,13 +941,15 @@ class Mocha(object):
         if cls._template_paths:
             loader = [cls._app.jinja_loader] + list(cls._template_paths)
             cls._app.jinja_loader = jinja2.ChoiceLoader(loader)
+        cls._setup_bytecode_cache()
 
         # Static
         if cls._static_paths:
             cls.assets.load_path = [cls._app.static_folder] + list(cls._static_paths)
             [cls.assets.from_yaml(a) for a in cls._asset_bundles]
 
-        # Register views
+        # Register views, in a new endpoint index for this app
+        cls._endpoints = _EndpointIndex()
         for subcls in cls.__subclasses__():
             base_route = subcls.base_route
             if not base_route:
@@ -740,6 +958,14 @@ class Mocha(object):
                     base_route = "/"
             subcls._register(cls._app, base_route=base_route)
 
+        # All views are registered, the endpoints can be indexed
+        cls._endpoints.freeze(cls._app.url_map)
+
+        # TEMPLATE_PRECOMPILE: to compile all the templates at boot
+        if cls._app.config.get("TEMPLATE_PRECOMPILE"):
+            cls.precompile_templates(
+                workers=cls._app.config.get("TEMPLATE_PRECOMPILE_WORKERS", 4))
+
         return cls._app
 
     @classmethod
@@ -787,14 +1013,31 @@ class Mocha(object):
                         import_app(t[0], t[1])
 
     @classmethod
-    def render(cls, data={}, _template=None, _layout=None, **kwargs):
+    def render(cls, data={}, _template=None, _layout=None, _stream=None,
+               _etag=None, _last_modified=None, **kwargs):
         """
         Render the view template based on the class and the method being invoked
         :param data: The context data to pass to the template
         :param _template: The file template to use. By default it will map the module/classname/action.html
         :param _layout: The body layout, must contain {% include __template__ %}
+        :param _stream: bool - To stream the template instead of rendering the
+                whole page first. By default it is the class `template_stream`.
+                See @render.stream
+        :param _etag: str - The etag of the page. If the client has it already,
+                a 304 is returned without rendering the template
+        :param _last_modified: datetime - The last modified date of the page.
+                Used like _etag
+
+        When _template is not provided, the template is the one of the method
+        calling render, ie: a helper method gets its own template, not the
+        one of the action being dispatched.
         """
 
+        if _etag or _last_modified:
+            response = _check_conditional(_etag, _last_modified)
+            if response is not None:
+                return response
+
         # Invoke the page meta so it can always be set
         page_attr()
 
@@ -809,18 +1052,63 @@ class Mocha(object):
 
         # Build the template using the method name being called
         if not _template:
-            stack = inspect.stack()[1]
-            action_name = stack[3]
-            _template = build_endpoint_route_name(cls, action_name)
-            _template = utils.list_replace([".", ":"], "/", _template)
-            _template = "%s.%s" % (_template, cls.template_markup)
+            action_name = sys._getframe(1).f_code.co_name
+            _template = cls._get_template_name(action_name)
 
         data = data or {}
         data.update(kwargs)
         data["__template__"] = _template
 
+        if cls.template_stream if _stream is None else _stream:
+            return cls._stream_template(_layout or cls.base_layout, data)
         return render_template(_layout or cls.base_layout, **data)
 
+    @classmethod
+    def _stream_template(cls, template_name, context):
+        """
+        Return a streamed Response of the template, from Jinja's generate().
+        The request context is kept while the response is sent. Like
+        render_template, it sends the signals `before_render_template`, and
+        `template_rendered` once the whole template is sent.
+        With COMPRESS_HTML, the template is compressed when it's compiled, like
+        for render_template. The values rendered in it are kept as they are.
+        :param template_name: str
+        :param context: dict
+        :return: Response
+        """
+        app = current_app._get_current_object()
+        app.update_template_context(context)
+        template = app.jinja_env.get_or_select_template(template_name)
+
+        def generate():
+            before_render_template.send(app, template=template,
+                                        context=context)
+            for chunk in template.generate(context):
+                yield chunk
+            template_rendered.send(app, template=template, context=context)
+
+        stream = _stream_with_context(generate())
+
+        # The session is saved before the body is sent, so the flashed
+        # messages are popped now, and kept in the request for the template
+        get_flashed_messages()
+        return Response(stream, mimetype="text/html")
+
+    @classmethod
+    def _get_template_name(cls, action_name):
+        """
+        Return the template of an action: module/Class/action.$template_markup
+        The name is built once per class and action, then cached
+        :param action_name: the name of the method
+        :return: string
+        """
+        key = (cls, action_name)
+        if key not in cls._template_names:
+            _template = build_endpoint_route_name(cls, action_name)
+            _template = utils.list_replace([".", ":"], "/", _template)
+            cls._template_names[key] = "%s.%s" % (_template, cls.template_markup)
+        return cls._template_names[key]
+
     @classmethod
     def _add_asset_bundle(cls, path):
         """
@@ -854,6 +1142,84 @@ class Mocha(object):
         cls._app._logger = cls.logger
         cls._app._loger_name = cls.logger.name
 
+    @classmethod
+    def _setup_bytecode_cache(cls):
+        """
+        Setup the Jinja bytecode cache if TEMPLATE_BYTECODE_CACHE is set.
+            - "filesystem": in TEMPLATE_CACHE_DIR/bytecode
+            - "memcached://host:port"
+        Jinja checks the template source checksum, so a changed template is
+        compiled again. The entries are also keyed by the extensions loaded,
+        because they change the compiled code.
+        """
+        conf = cls._app.config.get("TEMPLATE_BYTECODE_CACHE")
+        if not conf:
+            return
+        env = cls._app.jinja_env
+        extensions = sorted(env.extensions.keys())
+        ext_key = utils.md5(",".join(extensions).encode("utf-8"))[:8]
+
+        if conf == "filesystem":
+            cache_dir = cls._app.config.get("TEMPLATE_CACHE_DIR")
+            if not cache_dir:
+                raise exceptions.MochaError("TEMPLATE_BYTECODE_CACHE 'filesystem' "
+                                            "requires TEMPLATE_CACHE_DIR")
+            directory = os.path.join(cache_dir, "bytecode")
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            env.bytecode_cache = jinja2.FileSystemBytecodeCache(
+                directory=directory,
+                pattern="__jinja2_%s_" + ext_key + ".cache")
+        elif conf.startswith("memcache"):
+            import memcache
+            host_port = utils.urlparse(conf).netloc
+            env.bytecode_cache = jinja2.MemcachedBytecodeCache(
+                client=memcache.Client(servers=[host_port]),
+                prefix="jinja2/bytecode/%s/" % ext_key)
+        else:
+            raise exceptions.MochaError("Invalid TEMPLATE_BYTECODE_CACHE: %s"
+                                        % conf)
+
+    @classmethod
+    def precompile_templates(cls, workers=4, extensions=("html", "jade")):
+        """
+        Compile all the templates reachable by the loaders, in parallel.
+        The compiled templates are kept by Jinja, and in the bytecode cache
+        if it is set.
+        :param workers: int - the number of threads
+        :param extensions: tuple of the template file extensions to compile
+        :return: list of tuple (name, seconds, error)
+        """
+        from multiprocessing.pool import ThreadPool
+
+        env = cls._app.jinja_env
+
+        def compile_template(name):
+            start = time.time()
+            error = None
+            try:
+                env.get_template(name)
+            except Exception as ex:
+                error = ex
+                logging.warning("Template compile error: %s - %s" % (name, ex))
+            return name, time.time() - start, error
+
+        start = time.time()
+        pool = ThreadPool(max(1, workers))
+        try:
+            results = pool.map(compile_template,
+                               env.list_templates(extensions=extensions))
+        finally:
+            pool.close()
+            pool.join()
+
+        for name, elapsed, _ in results:
+            logging.info("Template compiled: %s in %.1fms" % (name,
+                                                              elapsed * 1000))
+        logging.info("%s templates compiled in %.2fs" % (len(results),
+                                                         time.time() - start))
+        return results
+
     @classmethod
     def _setup_db(cls):
         """
@@ -933,6 +1299,7 @@ class Mocha(object):
         for name, value in get_interesting_members(Mocha, cls):
             proxy = cls.make_proxy_method(name)
             route_name = build_endpoint_route_name(cls, name)
+            endpoints = []
             try:
                 if hasattr(value, "_rule_cache") and name in value._rule_cache:
                     for idx, cached_rule in enumerate(value._rule_cache[name]):
@@ -953,6 +1320,7 @@ class Mocha(object):
                         app.add_url_rule(rule, endpoint, proxy,
                                          subdomain=subdomain,
                                          **options)
+                        endpoints.append((endpoint, options.get("methods") or ["GET"]))
                 elif name in cls.__special_methods:
                     if name in ["get", "index"]:
                         methods = ["GET"]
@@ -968,24 +1336,27 @@ class Mocha(object):
                     app.add_url_rule(rule, route_name, proxy,
                                      methods=methods,
                                      subdomain=subdomain)
+                    endpoints.append((route_name, methods))
 
                 else:
                     methods = value._methods_cache \
                         if hasattr(value, "_methods_cache") \
                         else ["GET"]
 
-                    name = utils.dasherize(name)
-                    route_str = '/%s/' % name
+                    route_str = '/%s/' % utils.dasherize(name)
                     if not cls.trailing_slash:
                         route_str = route_str.rstrip('/')
                     rule = cls.build_rule(route_str, value)
                     app.add_url_rule(rule, route_name, proxy,
                                      subdomain=subdomain,
                                      methods=methods)
+                    endpoints.append((route_name, methods))
             except DecoratorCompatibilityError:
                 raise DecoratorCompatibilityError(
                     "Incompatible decorator detected on %s in class %s" % (name, cls.__name__))
 
+            cls._endpoints.add_action(cls, name, value, endpoints)
+
         if hasattr(cls, "orig_base_route"):
             cls.base_route = cls.orig_base_route
             del cls.orig_base_route
@@ -1022,6 +1393,10 @@ class Mocha(object):
         for decorator in cls.decorators:
             view = decorator(view)
 
+        # Everything that doesn't change between requests is resolved once
+        # here, so the proxy below only runs straight-line calls
+        dispatch = cls._build_dispatch(i, name, view)
+
         @functools.wraps(view)
         def proxy(**forgettable_view_args):
             # Always use the global request object's view_args, because they
@@ -1029,56 +1404,70 @@ class Mocha(object):
             # wrapper gets called. This matches Flask's behavior.
             del forgettable_view_args
 
-            if hasattr(i, "before_request"):
-                response = i.before_request(name, **request.view_args)
+            if dispatch.before_request:
+                response = dispatch.before_request(name, **f_request.view_args)
                 if response is not None:
                     return response
 
-            before_view_name = "before_" + name
-            if hasattr(i, before_view_name):
-                before_view = getattr(i, before_view_name)
-                response = before_view(**request.view_args)
+            if dispatch.before_view:
+                response = dispatch.before_view(**f_request.view_args)
                 if response is not None:
                     return response
 
-            response = view(**request.view_args)
+            response = dispatch.view(**f_request.view_args)
 
             # You can also return a dict or None, it will pass it to render
             if isinstance(response, dict) or response is None:
                 response = response or {}
-                if hasattr(i, "_renderer"):
-                    response = i._renderer(response)
+                if dispatch.renderer:
+                    response = dispatch.renderer(response)
                 else:
-                    _template = build_endpoint_route_name(cls, view.__name__)
-                    _template = utils.list_replace([".", ":"], "/", _template)
-                    _template = "%s.%s" % (_template, cls.template_markup)
-
                     # Set the title from the nav title, if not set
-                    _meta_title = getattr(g, "__META__", {}).get("title")
-                    if (not _meta_title or _meta_title == "") and get_view_attr(view, "title"):
-                        page_attr(title=get_view_attr(view, "title"))
+                    if dispatch.title \
+                            and not getattr(g, "__META__", {}).get("title"):
+                        page_attr(title=dispatch.title)
 
-                    response.setdefault("_template", _template)
+                    response.setdefault("_template", dispatch.template)
                     response = i.render(**response)
 
             if not isinstance(response, Response):
                 response = make_response(response)
 
-            for ext in cls._ext:
+            for ext in dispatch.extensions:
                 response = ext(response)
 
-            after_view_name = "after_" + name
-            if hasattr(i, after_view_name):
-                after_view = getattr(i, after_view_name)
-                response = after_view(response)
+            if dispatch.after_view:
+                response = dispatch.after_view(response)
 
-            if hasattr(i, "after_request"):
-                response = i.after_request(name, response)
+            if dispatch.after_request:
+                response = dispatch.after_request(name, response)
 
             return response
 
         return proxy
 
+    @classmethod
+    def _build_dispatch(cls, i, name, view):
+        """
+        Resolve the hooks, renderer and template of an endpoint into a
+        frozen dispatch record, used by the proxy on every request
+        :param i: the view instance
+        :param name: the name of the method
+        :param view: the method, with the class decorators applied
+        :return: _ViewDispatch
+        """
+        return _ViewDispatch(
+            view=view,
+            before_request=getattr(i, "before_request", None),
+            before_view=getattr(i, "before_" + name, None),
+            renderer=getattr(i, "_renderer", None),
+            template=cls._get_template_name(view.__name__),
+            title=get_view_attr(view, "title"),
+            extensions=tuple(cls._ext),
+            after_view=getattr(i, "after_" + name, None),
+            after_request=getattr(i, "after_request", None)
+        )
+
     @classmethod
     def build_rule(cls, rule, method=None):
         """Creates a routing rule based on either the class name (minus the
@@ -1146,8 +1535,17 @@ class Mocha(object):
 
     @classmethod
     def _load_extensions(cls):
+        from .extras import jade
+
+        # TEMPLATE_CACHE_DIR: to keep the jade conversions on disk
+        cache_dir = cls._app.config.get("TEMPLATE_CACHE_DIR")
+        if cache_dir:
+            max_age = cls._app.config.get("TEMPLATE_CACHE_MAX_AGE", 30)
+            jade.set_cache_dir(os.path.join(cache_dir, "jade"),
+                               max_age=max_age * 86400 if max_age else None)
+
         extensions = [
-            'pyjade.ext.jinja.PyJadeExtension',
+            'mocha.extras.jade.PyJadeExtension',
             'mocha.extras.jade.JadeTagExtension',
             'mocha.extras.md.MarkdownExtension',
             'mocha.extras.md.MarkdownTagExtension',
@@ -8,12 +8,16 @@ Misc decorators
 
 import copy
 import inspect
+import logging
 import blinker
 import functools
+import threading
 import flask_cors
+from multiprocessing.pool import ThreadPool
 from .core import (init_app as h_init_app,
-                   apply_function_to_members)
-from flask import make_response
+                   apply_function_to_members,
+                   config)
+from flask import make_response, current_app
 
 
 # ------------------------------------------------------------------------------
@@ -168,7 +172,7 @@ That's it!
 __signals_namespace = blinker.Namespace()
 
 
-def emit_signal(sender=None, namespace=None):
+def emit_signal(sender=None, namespace=None, background=False):
     """
     @emit_signal
     A decorator to mark a method or function as a signal emitter
@@ -178,11 +182,17 @@ def emit_signal(sender=None, namespace=None):
     *post will run after running the function
     
     **observe is an alias to post.connect
+
+    The arguments are bound for the receivers only when the signal has some,
+    so a signal without receivers costs nothing more than the call.
     
     :param sender: string  to be the sender.
     If empty, it will use the function __module__+__fn_name,
     or method __module__+__class_name__+__fn_name__
     :param namespace: The namespace. If None, it will use the global namespace
+    :param background: bool - To run the receivers in a background thread,
+        with the app context, instead of blocking the function. Their errors
+        are logged
     :return:
 
     """
@@ -200,35 +210,67 @@ def emit_signal(sender=None, namespace=None):
             fname += "__" + fn.__name__
 
         # pre and post
-        fn.pre = namespace.signal('pre_%s' % fname)
-        fn.post = namespace.signal('post_%s' % fname)
+        pre = fn.pre = namespace.signal('pre_%s' % fname)
+        post = fn.post = namespace.signal('post_%s' % fname)
         # alias to post.connect
         fn.observe = fn.post.connect
 
-        def send(action, *a, **kw):
-            sig_name = "%s_%s" % (action, fname)
-            result = kw.pop("result", None)
-            kw.update(inspect.getcallargs(fn, *a, **kw))
-            sendkw = {
-                "kwargs": {k: v for k, v in kw.items() if k in kw.keys()},
+        def bind(args, kwargs):
+            callargs = dict(kwargs)
+            callargs.update(inspect.getcallargs(fn, *args, **kwargs))
+            return {
+                "kwargs": callargs,
                 "sender": fn.__name__,
-                "emitter": kw.get('self', kw.get('cls', fn))
+                "emitter": callargs.get('self', callargs.get('cls', fn))
             }
-            if action == 'post':
-                namespace.signal(sig_name).send(result, **sendkw)
+
+        def send(signal, *a, **kw):
+            if background:
+                _send_signal_in_background(signal, *a, **kw)
             else:
-                namespace.signal(sig_name).send(**sendkw)
+                signal.send(*a, **kw)
 
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            send('pre', *args, **kwargs)
+            sendkw = None
+            if pre.receivers:
+                sendkw = bind(args, kwargs)
+                send(pre, **sendkw)
             result = fn(*args, **kwargs)
-            kwargs["result"] = result
-            send('post', *args, **kwargs)
+            if post.receivers:
+                if sendkw is None:
+                    sendkw = bind(args, kwargs)
+                send(post, result, **sendkw)
             return result
         return wrapper
     return decorator
 
 
+_signals_pool = None
+_signals_pool_lock = threading.Lock()
+
 
+def _send_signal_in_background(signal, *args, **kwargs):
+    """
+    Send the signal from a thread pool, within the app context if any.
+    The pool size is the config SIGNALS_BACKGROUND_WORKERS
+    """
+    global _signals_pool
+    if _signals_pool is None:
+        with _signals_pool_lock:
+            if _signals_pool is None:
+                _signals_pool = ThreadPool(
+                    config("SIGNALS_BACKGROUND_WORKERS", 4))
+    app = current_app._get_current_object() if current_app else None
+
+    def run():
+        try:
+            if app:
+                with app.app_context():
+                    signal.send(*args, **kwargs)
+            else:
+                signal.send(*args, **kwargs)
+        except Exception as e:
+            logging.exception(e)
 
+    _signals_pool.apply_async(run)
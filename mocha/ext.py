@@ -6,7 +6,7 @@ Extensions
 import re
 import six
 import logging
-from flask import request, current_app, send_file
+from flask import request, current_app, send_file, g
 import flask_cloudy
 import flask_recaptcha
 import flask_seasurf
@@ -20,6 +20,7 @@ from flask_babel import lazy_gettext as _
 from passlib.hash import bcrypt as passhash
 from . import (Mocha,
                init_app,
+               db,
                utils,
                exceptions,
                g,
@@ -27,6 +28,7 @@ from . import (Mocha,
                signals)
 
 from.extras import jinja_helpers, mocha_db
+from .tasks import async_task, tasks
 from paginator import Paginator
 
 __all__ = ["cache",
@@ -39,6 +41,7 @@ __all__ = ["cache",
            "csrf",
            "bcrypt",
            "send_mail",
+           "async_task",
            "paginate",
            "_",
            ]
@@ -68,6 +71,69 @@ init_app(_setup)
 
 # ------------------------------------------------------------------------------
 
+# Query recorder
+#
+# With DB_RECORD_QUERIES, the statements of each request are recorded.
+# In debug, the response gets the header X-DB-Queries. A warning is logged
+# when the request crosses the DB_QUERIES_WARNING_* thresholds.
+# A streamed response runs its queries while it's sent, so they are logged at
+# the request teardown, and it gets no header.
+# The recorder is always stopped at the teardown, even when the view raised
+def _query_recorder(app):
+    if not db._IS_OK_ or not app.config.get("DB_RECORD_QUERIES"):
+        return
+
+    max_count = app.config.get("DB_QUERIES_WARNING_COUNT", 30)
+    max_time = app.config.get("DB_QUERIES_WARNING_TIME", 0.5)
+    max_repeated = app.config.get("DB_QUERIES_WARNING_REPEATED", 5)
+
+    def log_queries(summary):
+        if summary["count"] > max_count \
+                or summary["total_time"] > max_time \
+                or summary["repeated"]:
+            logging.warning("%s %s: %s queries in %.1fms, %s duplicates%s"
+                            % (request.method, request.path,
+                               summary["count"], summary["total_time"] * 1000,
+                               summary["duplicates"],
+                               "".join("\n  repeated %sx: %s" % (n, q)
+                                       for q, n in summary["repeated"])))
+
+    @app.before_request
+    def start_recording():
+        g.__QUERIES__ = db.record_queries()
+        g.__QUERIES_STREAMED__ = False
+
+    @app.after_request
+    def log_recording(response):
+        recorder = getattr(g, "__QUERIES__", None)
+        if recorder is None:
+            return response
+        if response.is_streamed:
+            g.__QUERIES_STREAMED__ = True
+            return response
+        summary = recorder.summary(min_count=max_repeated)
+        if app.debug:
+            response.headers["X-DB-Queries"] = \
+                "count=%s; time=%.1fms; duplicates=%s; repeated=%s" \
+                % (summary["count"], summary["total_time"] * 1000,
+                   summary["duplicates"], len(summary["repeated"]))
+        log_queries(summary)
+        return response
+
+    @app.teardown_request
+    def stop_recording(exc):
+        recorder = getattr(g, "__QUERIES__", None)
+        if recorder is None:
+            return
+        recorder.stop()
+        g.__QUERIES__ = None
+        if getattr(g, "__QUERIES_STREAMED__", False):
+            log_queries(recorder.summary(min_count=max_repeated))
+
+init_app(_query_recorder)
+
+# ------------------------------------------------------------------------------
+
 # Session
 #
 # It uses KV session to allow multiple backend for the session
@@ -129,6 +195,11 @@ class _Mailer(object):
     config = None
     _template = None
 
+    # The flask_mail.Message keys
+    _smtp_keys = ["recipients", "subject", "body", "html", "alts", "cc", "bcc",
+                  "attachments", "reply_to", "sender", "date", "charset",
+                  "extra_headers", "mail_options", "rcpt_options"]
+
     @property
     def validated(self):
         return bool(self.mail)
@@ -225,12 +296,8 @@ class _Mailer(object):
             kwargs["sender"] = sender
 
             # Remove invalid Messages keys
-            _safe_keys = ["recipients", "subject", "body", "html", "alts",
-                          "cc", "bcc", "attachments", "reply_to", "sender",
-                           "date", "charset", "extra_headers", "mail_options",
-                           "rcpt_options"]
             for k in kwargs.copy():
-                if k not in _safe_keys:
+                if k not in self._smtp_keys:
                     del kwargs[k]
 
             message = flask_mail.Message(**kwargs)
@@ -238,6 +305,27 @@ class _Mailer(object):
         else:
             raise exceptions.MochaError("Invalid mail provider. Must be 'SES' or 'SMTP'")
 
+    def render(self, template, **kwargs):
+        """
+        Render the mail of a template now, to send it later with
+        `send(to, **data)`. The mail options of kwargs, ie: reply_to, are kept
+        :param template: the template
+        :param kwargs: context args
+        :return: dict - subject, body and the mail options
+        """
+        if not self.validated:
+            raise exceptions.MochaError("Mail configuration error")
+
+        if self.provider == "SES":
+            data = self.mail.parse_template(template, **kwargs)
+            data["reply_to"] = kwargs.get("reply_to")
+        else:
+            data = self._template(template=template, **kwargs)
+            data.update({k: v for k, v in kwargs.items()
+                         if k in self._smtp_keys
+                         and k not in ("recipients", "subject", "body")})
+        return data
+
 mail = _Mailer()
 init_app(mail.init_app)
 
@@ -245,18 +333,40 @@ def send_mail(template, to, **kwargs):
     """
     Alias to mail.send(), but makes template required
     ie: send_mail("welcome-to-the-site.txt", "user@email.com")
+
+    With the config MAIL_ASYNC, the mail is rendered now, then queued as a
+    task and sent by the TASKS_BACKEND, so it returns right away. It returns
+    the job id then, instead of the result of mail.send().
+    The task only gets the rendered mail, so the template context, ie: a
+    model, is not shared with it. A mail which can't be queued as JSON, ie:
+    with attachments, is sent right away instead.
     :param template: 
     :param to:
     :param kwargs:
-    :return:
+    :return: the result of mail.send(), or the job id
     """
-
     def cb():
+        if config("MAIL_ASYNC"):
+            data = mail.render(template, **kwargs)
+            if tasks.can_enqueue((to, data)):
+                return _send_mail_task.delay(to, data)
+            logging.warning("send_mail: '%s' can't be queued as JSON, the "
+                            "mail is sent now" % template)
         return mail.send(to=to, template=template, **kwargs)
 
     return signals.send_mail(cb, data={"to": to, "template": template, "kwargs": kwargs})
 
 
+@async_task(name="mocha.send_mail", retries=3, retry_delay=60)
+def _send_mail_task(to, data):
+    """
+    Send a mail rendered by send_mail
+    :param to: the recipients
+    :param data: dict - the rendered mail
+    """
+    mail.send(to=to, **data)
+
+
 # ------------------------------------------------------------------------------
 
 # Assets Delivery
@@ -342,12 +452,26 @@ init_app(bcrypt.init_app)
 
 # ------------------------------------------------------------------------------
 
-
-
 # Cache
 cache = flask_caching.Cache()
 init_app(cache.init_app)
 
+# The cache types that live in each process. A value set by a worker is not
+# seen by the other workers
+_LOCAL_CACHE_TYPES = ("null", "simple", "nullcache", "simplecache")
+
+
+def is_cache_shared():
+    """
+    Tell if `cache` is shared by all the workers of the application, ie: redis,
+    memcached. The 'null' and 'simple' caches are per process
+    :return: bool
+    """
+    if not current_app:
+        return False
+    cache_type = current_app.config.get("CACHE_TYPE") or "null"
+    return cache_type.split(".")[-1].lower() not in _LOCAL_CACHE_TYPES
+
 # Storage
 storage = flask_cloudy.Storage()
 init_app(storage.init_app)
@@ -441,14 +565,32 @@ recaptcha = flask_recaptcha.ReCaptcha()
 init_app(recaptcha.init_app)
 
 # CSRF
-csrf = flask_seasurf.SeaSurf()
+class _SeaSurf(flask_seasurf.SeaSurf):
+    """
+    SeaSurf, which marks the request when the token is read, ie: by
+    `csrf_token()` in a form. A page holding the token is not cached by
+    @render.cached
+    """
+
+    def _get_token(self):
+        g.__CSRF_TOKEN_READ__ = True
+        return super(_SeaSurf, self)._get_token()
+
+csrf = _SeaSurf()
 init_app(csrf.init_app)
 
 
-def paginate(iter, **kwargs):
+def paginate(iter, mode=None, **kwargs):
     """
      A wrapper around the Paginator that takes config data
     :param iter: Query object or any iterables
+    :param mode: str - How to paginate. By default PAGINATION_MODE
+        - count: the query is counted on each page
+        - estimate: the count of the query is cached for
+                    PAGINATION_COUNT_CACHE_TIMEOUT seconds
+        - keyset: the pages are seeked by the sort columns, with a cursor
+                  as `page`. There is no count and no page number.
+                  Returns a KeysetPaginator. Query object only
     :param kwargs:
         - page: current page
         - per_page: max number of items per page
@@ -456,13 +598,49 @@ def paginate(iter, **kwargs):
         - padding: Number of elements of the next page to show
         - callback: a function to callback on each item being iterated.
         - static_query: bool - When True it will return the query as is, without slicing/limit. Usally when using the paginator to just create the pagination.
+        - order_by: list of columns to sort by, with mode 'keyset'
+        With mode 'keyset', `padding` is ignored, and `static_query` is
+        rejected, since there is no offset
     :return: Paginator
     """
-    kwargs.setdefault("page", int(request.args.get('page', 1)))
+    mode = mode or config("PAGINATION_MODE", "count")
     kwargs.setdefault("per_page", int(config("PAGINATION_PER_PAGE", 1)))
+
+    if mode == "keyset":
+        if kwargs.pop("static_query", False):
+            raise exceptions.MochaError("static_query can't be used with the "
+                                        "pagination mode 'keyset'")
+        kwargs.pop("padding", None)
+        kwargs.setdefault("page", request.args.get("page"))
+        return mocha_db.KeysetPaginator(iter, **kwargs)
+
+    kwargs.setdefault("page", int(request.args.get('page', 1)))
     kwargs.setdefault("padding", int(config("PAGINATION_PADDING", 0)))
+    if mode == "estimate":
+        if not kwargs.get("total") and hasattr(iter, "statement"):
+            kwargs["total"] = _cached_count(iter)
+    elif mode != "count":
+        raise exceptions.MochaError("Invalid pagination mode: '%s'" % mode)
     return Paginator(iter, **kwargs)
 
+
+def _cached_count(query):
+    """
+    Count the query, and cache the count by its SQL and parameters
+    :param query: Query object
+    :return: int
+    """
+    query = query.order_by(None)
+    compiled = query.statement.compile()
+    key = "%s%r" % (compiled, sorted(compiled.params.items()))
+    key = "mocha:paginate:count:%s" % utils.md5(key.encode("utf-8"))
+    total = cache.get(key)
+    if total is None:
+        total = query.count()
+        cache.set(key, total,
+                  timeout=config("PAGINATION_COUNT_CACHE_TIMEOUT", 60))
+    return total
+
 # Babel
 babel = flask_babel.Babel()
 
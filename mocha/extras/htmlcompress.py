@@ -23,13 +23,18 @@
 
       {% strip %} ... {% endstrip %}
 
+    To minify at runtime, ie: a stream from `template.generate()`, use
+    HTMLMinifier, which doesn't need to buffer the whole response:
+
+      HTMLMinifier.minify_stream(template.generate(**context))
+
 """
 from jinja2.ext import Extension
 from jinja2.lexer import Token, describe_token
 from jinja2 import TemplateSyntaxError
 import re
 
-gl_tag_re = re.compile(r'(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*))(?s)')
+gl_tag_re = re.compile(r'(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*))', re.S)
 gl_ws_normalize_re = re.compile(r'[ \t\r\n]+')
 
 
@@ -38,6 +43,8 @@ class StreamProcessContext(object):
         self.stream = stream
         self.token = None
         self.stack = []
+        # The number of isolated elements in the stack
+        self.isolated = 0
 
     def fail(self, message):
         raise TemplateSyntaxError(message, self.token.lineno, self.stream.name,
@@ -85,18 +92,24 @@ class HTMLCompress(Extension):
             self.leave_tag(ctx.stack[-1], ctx)
         if tag not in self.void_elements:
             ctx.stack.append(tag)
+            if tag in self.isolated_elements:
+                ctx.isolated += 1
+
+    def pop_tag(self, ctx):
+        if ctx.stack.pop() in self.isolated_elements:
+            ctx.isolated -= 1
 
     def leave_tag(self, tag, ctx):
         if not ctx.stack:
             ctx.fail(
                 'Tried to leave "%s" but something closed it already' % tag)
         if tag == ctx.stack[-1]:
-            ctx.stack.pop()
+            self.pop_tag(ctx)
             return
         for idx, other_tag in enumerate(reversed(ctx.stack)):
             if other_tag == tag:
                 for num in range(idx + 1):
-                    ctx.stack.pop()
+                    self.pop_tag(ctx)
             elif not self.breaking_rules.get(other_tag):
                 break
 
@@ -105,7 +118,7 @@ class HTMLCompress(Extension):
         buffer = []
 
         def write_data(value):
-            if not self.is_isolated(ctx.stack):
+            if not ctx.isolated:
                 value = gl_ws_normalize_re.sub(' ', value)
             buffer.append(value)
 
@@ -162,3 +175,122 @@ class SelectiveHTMLCompress(HTMLCompress):
             else:
                 yield stream.current
             next(stream)
+
+
+class HTMLMinifier(object):
+    """
+    A streaming HTML minifier, to minify the rendered HTML at runtime.
+    Like HTMLCompress, it collapses the whitespace, but leaves the content of
+    the isolated elements (pre, textarea, script...) untouched.
+
+    It makes a single pass with precompiled patterns: it jumps from one
+    isolated tag to the next, collapsing the whitespace in between, and keeps
+    the depth of the isolated element it's in, so it never rescans a stack.
+    The content of the raw text elements (script, style, textarea) is not
+    markup, so it ends at their first closing tag, ie: '<script>' in a
+    javascript string is not an opening tag.
+    Text fed in chunks is minified the same way as the whole text. A chunk
+    ending in whitespace or in a tag name is held until the next chunk.
+
+        minifier = HTMLMinifier()
+        for chunk in template.generate(**context):
+            yield minifier.feed(chunk)
+        yield minifier.flush()
+    """
+
+    isolated_elements = HTMLCompress.isolated_elements
+    raw_text_elements = set(['script', 'style', 'textarea'])
+
+    _names = "|".join(sorted(isolated_elements))
+    _isolated_re = re.compile(r'<(/?)(%s)\b' % _names, re.I)
+    _ws_re = gl_ws_normalize_re
+    # the longest tail to hold for a tag name, ie: '</noscript'
+    _max_tag_len = max(len(n) for n in isolated_elements) + 2
+
+    def __init__(self):
+        self.tag = None
+        self.depth = 0
+        self._pending = ""
+
+    def feed(self, data):
+        """
+        Minify a chunk of HTML
+        :param data: str
+        :return: str - the minified text that can be sent
+        """
+        data = self._pending + data
+        end = len(data)
+        lt = data.rfind("<", max(0, end - self._max_tag_len))
+        if lt != -1 and ">" not in data[lt:]:
+            end = lt
+        end = len(data[:end].rstrip(" \t\r\n"))
+        self._pending = data[end:]
+        return self._minify(data[:end])
+
+    def flush(self):
+        """
+        Minify the text held from the last chunk
+        :return: str
+        """
+        data, self._pending = self._pending, ""
+        return self._minify(data)
+
+    def _minify(self, text):
+        out = []
+        pos = 0
+        while True:
+            m = self._isolated_re.search(text, pos)
+            end = m.start() if m else len(text)
+            if self.depth:
+                out.append(text[pos:end])
+            else:
+                out.append(self._ws_re.sub(" ", text[pos:end]))
+            if m is None:
+                break
+            name = m.group(2).lower()
+            if not self.depth:
+                if not m.group(1):
+                    self.tag = name
+                    self.depth = 1
+            elif name == self.tag:
+                if m.group(1):
+                    self.depth -= 1
+                elif name not in self.raw_text_elements:
+                    self.depth += 1
+            out.append(m.group())
+            pos = m.end()
+        return "".join(out)
+
+    @classmethod
+    def minify(cls, html):
+        """
+        Minify the HTML
+        :param html: str
+        :return: str
+        """
+        return cls()._minify(html)
+
+    @classmethod
+    def minify_stream(cls, stream, buffer_size=8192):
+        """
+        Minify an iterable of HTML chunks, ie: `template.generate()`
+        The small chunks are grouped up to buffer_size before being minified
+        :param stream: iterable
+        :param buffer_size: int - the number of chars to group
+        :return: generator
+        """
+        minifier = cls()
+        buffer = []
+        size = 0
+        for chunk in stream:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                data = minifier.feed("".join(buffer))
+                buffer = []
+                size = 0
+                if data:
+                    yield data
+        data = minifier.feed("".join(buffer)) + minifier.flush()
+        if data:
+            yield data
@@ -6,10 +6,20 @@ A jade extension that embed jade markup in the .html file
 
 {% endjade %}
 
+The jade to jinja conversions can be kept on disk, by the hash of their
+source, so workers don't convert the templates again on every start.
+See `set_cache_dir`, or the config TEMPLATE_CACHE_DIR
+
 """
 
+import os
 import re
+import time
+import hashlib
+import tempfile
+import pkg_resources
 import pyjade
+import pyjade.ext.jinja
 from jinja2.ext import Extension
 from pyjade.utils import process
 from pyjade.ext.jinja import Compiler
@@ -22,13 +32,140 @@ end_tag_rx = r'\{%\-?\s*endjade\s*\-?%\}'
 begin_tag_m = re.compile(begin_tag_rx)
 end_tag_m = re.compile(end_tag_rx)
 
-
-def convert(text, filename=None):
-    return process(text, filename=filename, compiler=Compiler)
+try:
+    _pyjade_version = pkg_resources.get_distribution("pyjade").version
+except pkg_resources.DistributionNotFound:
+    _pyjade_version = ""
+
+
+class ConversionCache(object):
+    """
+    A disk cache of the jade to jinja conversions.
+    Each conversion is saved in a file named by the hash of the jade source and
+    the conversion options, so a changed template gets a new entry.
+    The old entries are never read again, see `prune` to remove them.
+    """
+
+    suffix = ".jinja"
+    tmp_prefix = ".tmp-"
+
+    def __init__(self, directory):
+        """
+        :param directory: str - the directory to save the conversions
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_key(self, source, options):
+        h = hashlib.sha1(("%s:%s" % (_pyjade_version,
+                                     sorted(options.items()))).encode("utf-8"))
+        h.update(source.encode("utf-8"))
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """
+        Return the converted source, or None if it's not in the cache
+        :param key: str
+        :return: str
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                source = f.read().decode("utf-8")
+        except (IOError, OSError):
+            return None
+        # Mark the entry as used, for `prune`
+        try:
+            os.utime(path, None)
+        except (IOError, OSError):
+            pass
+        return source
+
+    def set(self, key, value):
+        """
+        Save the converted source. It writes to a temp file first, so
+        concurrent workers never read a partial file
+        :param key: str
+        :param value: str
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=self.tmp_prefix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(value.encode("utf-8"))
+            os.rename(tmp, self.get_path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def prune(self, max_age):
+        """
+        Remove the entries not used for max_age seconds, and the temp files
+        left by the workers that died while writing
+        :param max_age: int - seconds
+        :return: int - the number of files removed
+        """
+        expire = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix) \
+                    and not name.startswith(self.tmp_prefix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < expire:
+                    os.remove(path)
+                    removed += 1
+            except (IOError, OSError):
+                # Removed by another worker
+                pass
+        return removed
+
+
+# The conversion cache. None when disabled
+_cache = None
+
+
+def set_cache_dir(directory, max_age=None):
+    """
+    Enable the disk cache of the conversions
+    :param directory: str - the directory. None to disable
+    :param max_age: int - seconds. To remove the entries not used for that long
+    """
+    global _cache
+    _cache = ConversionCache(directory) if directory else None
+    if _cache and max_age:
+        _cache.prune(max_age)
+
+
+def convert(text, filename=None, **options):
+    if _cache is None:
+        return process(text, filename=filename, compiler=Compiler, **options)
+    key = _cache.get_key(text, options)
+    source = _cache.get(key)
+    if source is None:
+        source = process(text, filename=filename, compiler=Compiler, **options)
+        _cache.set(key, source)
+    return source
 
 class TemplateIndentationError(TemplateSyntaxError): pass
 
 
+class PyJadeExtension(pyjade.ext.jinja.PyJadeExtension):
+    """
+    The PyJade extension for .jade templates, with the conversion cache
+    """
+
+    def preprocess(self, source, name, filename=None):
+        if (not name or
+           (name and not os.path.splitext(name)[1] in self.file_extensions)):
+            return source
+        return convert(source, filename=name, **self.options)
+
+
 class JadeTagExtension(Extension):
     tags = set(['jade'])
 
@@ -39,7 +176,7 @@ class JadeTagExtension(Extension):
         return 0
 
     def preprocess(self, source, name, filename=None):
-        ret_source = ''
+        ret_source = []
         start_pos = 0
 
         while True:
@@ -51,19 +188,19 @@ class JadeTagExtension(Extension):
                                               self._get_lineno(source[:start_pos]))
 
                 jade_source = source[tag_match.end(): end_tag.start()]
-                jade_source = convert(jade_source)
-
                 try:
-                    ret_source += source[start_pos: tag_match.start()] + jade_source
+                    jade_source = convert(jade_source)
                 except TemplateIndentationError as e:
                     raise TemplateSyntaxError(e.message, e.lineno, name=name, filename=filename)
                 except TemplateSyntaxError as e:
                     raise TemplateSyntaxError(e.message, e.lineno, name=name, filename=filename)
+
+                ret_source.append(source[start_pos: tag_match.start()])
+                ret_source.append(jade_source)
                 start_pos = end_tag.end()
             else:
-                ret_source += source[start_pos:]
+                ret_source.append(source[start_pos:])
                 break
 
-        return ret_source
-
+        return "".join(ret_source)
 
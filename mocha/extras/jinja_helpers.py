@@ -100,6 +100,7 @@ FILTERS = {
 
 def jinja_helpers(app):
     app.jinja_env.filters.update(FILTERS)
+    md.set_cache_size(app.config.get("MARKDOWN_CACHE_SIZE"))
 
 
 init_app(jinja_helpers)
@@ -5,14 +5,25 @@ html : render markdown to html
 toc : Get the Table of Content
 extract_images: Return a list of images, can be used to extract the top image
 
+Markdown instances are not thread safe, and costly to build. They are kept
+in a pool per extension set, and checked out for each conversion.
+An optional LRU of the results, keyed by the content hash, can be enabled with
+`set_cache_size`
+
+The tree processors use Element.iter(), Element.getiterator() is gone from
+Python 3.9
+
 """
 
 import os
+import hashlib
+import threading
 import markdown
 from markdown.treeprocessors import Treeprocessor
 from markdown.extensions import Extension
 from jinja2.nodes import CallBlock
 from jinja2.ext import Extension as JExtension
+from mocha import utils
 
 ###
 # This extension will extract all the images from the doc
@@ -25,7 +36,7 @@ class ExtractImagesTreeprocessor(Treeprocessor):
     def run(self, root):
         "Find all images and append to markdown.images. "
         self.markdown.images = []
-        for image in root.getiterator("img"):
+        for image in root.iter("img"):
             self.markdown.images.append(image.attrib["src"])
 
 ###
@@ -39,7 +50,7 @@ class LazyImageExtension(Extension):
 
 class LazyImageTreeprocessor(Treeprocessor):
     def run(self, root):
-        for image in root.getiterator("img"):
+        for image in root.iter("img"):
             image.set("data-src", image.attrib["src"])
             image.set("src", "")
             image.set("class", "lazy")
@@ -56,13 +67,113 @@ class OEmbedExtension(Extension):
 
 class OEmbedTreeprocessor(Treeprocessor):
     def run(self, root):
-        for a in root.getiterator("a"):
+        for a in root.iter("a"):
             if a.text.strip() == "[embed]":
                 a.text = ""
                 a.set("class", "oembed")
                 a.set("target", "_blank")
 
 # ------------------------------------------------------------------------------
+
+HTML_EXTENSIONS = ('markdown.extensions.nl2br',
+                   'markdown.extensions.sane_lists',
+                   'markdown.extensions.toc',
+                   'markdown.extensions.tables',
+                   OEmbedExtension)
+HTML_LAZY_IMAGES_EXTENSIONS = HTML_EXTENSIONS + (LazyImageExtension,)
+TOC_EXTENSIONS = ('markdown.extensions.toc',)
+IMAGES_EXTENSIONS = (ExtractImagesExtension,)
+CONVERT_EXTENSIONS = ('markdown.extensions.nl2br',
+                      'markdown.extensions.sane_lists',
+                      'markdown.extensions.toc',
+                      'markdown.extensions.tables')
+TAG_EXTENSIONS = ('extra',)
+
+
+class MarkdownPool(object):
+    """
+    A pool of Markdown instances, per extension set.
+    An instance is used by one thread at a time, and reset when it's released
+    """
+
+    def __init__(self, maxsize=16):
+        """
+        :param maxsize: int - max idle instances to keep per extension set
+        """
+        self.maxsize = maxsize
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, extensions):
+        """
+        Checkout a Markdown instance
+        :param extensions: tuple of extension names or Extension classes
+        :return: markdown.Markdown
+        """
+        with self._lock:
+            pool = self._pools.get(extensions)
+            if pool:
+                return pool.pop()
+        return markdown.Markdown(extensions=[e() if isinstance(e, type) else e
+                                             for e in extensions])
+
+    def release(self, extensions, mkd):
+        """
+        Return a Markdown instance to the pool
+        :param extensions: tuple - the extension set it was acquired with
+        :param mkd: markdown.Markdown
+        """
+        mkd.reset()
+        with self._lock:
+            pool = self._pools.setdefault(extensions, [])
+            if len(pool) < self.maxsize:
+                pool.append(mkd)
+
+    def convert(self, text, extensions, attr=None):
+        """
+        Convert the text with a pooled instance
+        :param text: str
+        :param extensions: tuple
+        :param attr: str - to return this attribute of the instance after the
+                conversion instead of the html. ie: toc, images
+        :return: mixed
+        """
+        mkd = self.acquire(extensions)
+        try:
+            html = mkd.convert(text)
+            return getattr(mkd, attr) if attr else html
+        finally:
+            self.release(extensions, mkd)
+
+
+pool = MarkdownPool()
+
+# The LRU of the results, by content hash. None when disabled
+_cache = None
+
+
+def set_cache_size(size):
+    """
+    Enable the LRU of the results, keyed by the content hash.
+    :param size: int - the max number of results to keep. 0/None to disable
+    """
+    global _cache
+    _cache = utils.LRUCache(maxsize=size) if size else None
+
+
+def _convert(text, extensions, attr=None):
+    if _cache is None:
+        return pool.convert(text, extensions, attr)
+    h = hashlib.md5(text.encode("utf-8") if not isinstance(text, bytes)
+                    else text).hexdigest()
+    key = (extensions, attr, h)
+    result = _cache.get(key)
+    if result is None:
+        result = pool.convert(text, extensions, attr)
+        _cache.set(key, result)
+    return result
+
+
 def html(text, lazy_images=False):
     """
     To render a markdown format text into HTML.
@@ -75,17 +186,8 @@ def html(text, lazy_images=False):
     :param lazy_images: bool - If true, it will activate the LazyImageExtension
     :return:
     """
-    extensions = [
-        'markdown.extensions.nl2br',
-        'markdown.extensions.sane_lists',
-        'markdown.extensions.toc',
-        'markdown.extensions.tables',
-        OEmbedExtension()
-    ]
-    if lazy_images:
-        extensions.append(LazyImageExtension())
-
-    return markdown.markdown(text, extensions=extensions)
+    extensions = HTML_LAZY_IMAGES_EXTENSIONS if lazy_images else HTML_EXTENSIONS
+    return _convert(text, extensions)
 
 def toc(text):
     """
@@ -93,10 +195,7 @@ def toc(text):
     :param text:
     :return:
     """
-    extensions = ['markdown.extensions.toc']
-    mkd = markdown.Markdown(extensions=extensions)
-    html = mkd.convert(text)
-    return mkd.toc
+    return _convert(text, TOC_EXTENSIONS, "toc")
 
 
 def extract_images(text):
@@ -105,10 +204,7 @@ def extract_images(text):
     :param text:
     :return:
     """
-    extensions = [ExtractImagesExtension()]
-    mkd = markdown.Markdown(extensions=extensions)
-    html = mkd.convert(text)
-    return mkd.images
+    return list(_convert(text, IMAGES_EXTENSIONS, "images"))
 
 # ------------------------------------------------------------------------------
 
@@ -118,6 +214,8 @@ class MarkdownTagExtension(JExtension):
 
     def __init__(self, environment):
         super(MarkdownTagExtension, self).__init__(environment)
+        # Deprecated: the tag renders with the pool. `environment.markdowner`
+        # is kept for the code using it, but it's not thread safe
         environment.extend(
             markdowner=markdown.Markdown(extensions=['extra'])
         )
@@ -158,8 +256,7 @@ class MarkdownTagExtension(JExtension):
         return output.strip()
 
     def _render_markdown(self, block):
-        block = self.environment.markdowner.convert(block)
-        return block
+        return _convert(block, TAG_EXTENSIONS)
 
 
 class MarkdownExtension(JExtension):
@@ -174,24 +271,13 @@ class MarkdownExtension(JExtension):
         return html(source)
 
 
-# Markdown
-mkd = markdown.Markdown(extensions=[
-    'markdown.extensions.nl2br',
-    'markdown.extensions.sane_lists',
-    'markdown.extensions.toc',
-    'markdown.extensions.tables'
-])
-
-
 def convert(text):
     """
     Convert MD text to HTML
     :param text:
     :return:
     """
-    html = mkd.convert(text)
-    mkd.reset()
-    return html
+    return _convert(text, CONVERT_EXTENSIONS)
 
 
 def get_toc(text):
@@ -200,7 +286,4 @@ def get_toc(text):
     :param text:
     :return:
     """
-    mkd.convert(text)
-    toc = mkd.toc
-    mkd.reset()
-    return toc
+    return _convert(text, CONVERT_EXTENSIONS, "toc")
@@ -5,10 +5,30 @@ Just like sqlalchemy_utils, this module contains some custom types to
 save in the db
 """
 
+import six
+import json
+import time
+import base64
+import decimal
+import datetime
+import random
+import hashlib
+import bisect
+import logging
+import itertools
+import threading
+import contextlib
+import collections
+import arrow
 import active_alchemy
+import sqlalchemy as sa
+from sqlalchemy import (event as sa_event,
+                        orm as sa_orm,
+                        sql as sa_sql)
 from sqlalchemy.engine.url import make_url as sa_make_url
 import sqlalchemy_utils as sa_utils
 import flask_cloudy
+from multiprocessing.pool import ThreadPool
 
 
 class MochaDB(active_alchemy.ActiveAlchemy):
@@ -20,15 +40,27 @@ class MochaDB(active_alchemy.ActiveAlchemy):
         self.BaseModel = active_alchemy.declarative_base(cls=active_alchemy.BaseModel, name='BaseModel')
         self._initialized = False
         self._IS_OK_ = False
+        self.pool_metrics = None
 
     def connect__(self, uri, app):
+        """
+        Connect to the db, with the pool options from the config:
+            DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+            DB_POOL_RECYCLE, DB_POOL_PRE_PING
+        With DB_POOL_METRICS, the checkouts of the pool are measured.
+        See `pool_stats()`
+        With DB_REPLICA_URLS, the reads go to the replicas. See `RoutingSession`
+        """
+        config = app.config
         self.uri = uri
         self.info = sa_make_url(uri)
         self.options = self._cleanup_options(
             echo=False,
-            pool_size=None,
-            pool_timeout=None,
-            pool_recycle=None,
+            pool_size=config.get("DB_POOL_SIZE"),
+            max_overflow=config.get("DB_POOL_MAX_OVERFLOW"),
+            pool_timeout=config.get("DB_POOL_TIMEOUT"),
+            pool_recycle=config.get("DB_POOL_RECYCLE"),
+            pool_pre_ping=config.get("DB_POOL_PRE_PING") or None,
             convert_unicode=True,
         )
 
@@ -36,7 +68,25 @@ class MochaDB(active_alchemy.ActiveAlchemy):
         self._IS_OK_ = True
         self.connector = None
         self._engine_lock = active_alchemy.threading.Lock()
-        self.session = active_alchemy._create_scoped_session(self, query_cls=active_alchemy.BaseQuery)
+        self.replicas = None
+        replica_urls = config.get("DB_REPLICA_URLS")
+        if replica_urls:
+            if isinstance(replica_urls, six.string_types):
+                replica_urls = replica_urls.split(",")
+            self.replicas = ReplicaSet(
+                [u.strip() for u in replica_urls if u.strip()],
+                self.options,
+                policy=config.get("DB_REPLICA_POLICY", "round_robin"),
+                check_interval=config.get("DB_REPLICA_CHECK_INTERVAL", 30))
+            self.session = sa_orm.scoped_session(
+                sa_orm.sessionmaker(class_=RoutingSession,
+                                    db=self,
+                                    autoflush=True,
+                                    autocommit=False,
+                                    bind=self.engine,
+                                    query_cls=active_alchemy.BaseQuery))
+        else:
+            self.session = active_alchemy._create_scoped_session(self, query_cls=active_alchemy.BaseQuery)
 
         self.Model.db, self.BaseModel.db = self, self
         self.Model._query, self.BaseModel._query = self.session.query, self.session.query
@@ -45,6 +95,599 @@ class MochaDB(active_alchemy.ActiveAlchemy):
         active_alchemy._include_sqlalchemy(self)
         self.StorageObjectType = StorageObjectType
 
+        if config.get("DB_POOL_METRICS"):
+            self.pool_metrics = PoolMetrics(
+                wait_warning=config.get("DB_POOL_WAIT_WARNING", 0.5))
+            self.pool_metrics.instrument(self.engine)
+
+    def record_queries(self):
+        """
+        Return a QueryRecorder recording the statements run by the current
+        thread, until it's stopped. Use it as a context manager
+            with db.record_queries() as recorder:
+                ...
+            recorder.count
+        :return: QueryRecorder
+        """
+        _instrument_queries()
+        return QueryRecorder().start()
+
+    @contextlib.contextmanager
+    def assert_max_queries(self, max_queries):
+        """
+        For tests, to assert that a block runs at most `max_queries` statements
+            with db.assert_max_queries(3):
+                client.get("/")
+        :param max_queries: int
+        """
+        with self.record_queries() as recorder:
+            yield recorder
+        if recorder.count > max_queries:
+            raise AssertionError("%s queries run, expected at most %s:\n%s"
+                                 % (recorder.count, max_queries,
+                                    "\n".join(q[0] for q in recorder.queries)))
+
+    def pool_stats(self):
+        """
+        Return the state of the connection pool, and the checkouts metrics
+        when DB_POOL_METRICS is set
+        :return: dict
+        """
+        pool = self.engine.pool
+        stats = {"status": pool.status()}
+        for k in ("size", "checkedin", "checkedout", "overflow"):
+            if hasattr(pool, k):
+                stats[k] = getattr(pool, k)()
+        if self.pool_metrics:
+            stats.update(self.pool_metrics.stats())
+        return stats
+
+# ------------------------------------------------------------------------------
+# Query recorder
+
+_recorders = threading.local()
+_queries_instrumented = []
+
+
+def _instrument_queries():
+    """
+    Listen to the statements of all the engines, once
+    """
+    if not _queries_instrumented:
+        sa_event.listen(sa.engine.Engine, "before_cursor_execute",
+                        _before_cursor_execute)
+        sa_event.listen(sa.engine.Engine, "after_cursor_execute",
+                        _after_cursor_execute)
+        _queries_instrumented.append(True)
+
+
+# The start time is kept in the execution context of the statement, so a
+# statement that raises doesn't leave it on the pooled connection
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None and getattr(_recorders, "stack", None):
+        context._mocha_query_start = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stack = getattr(_recorders, "stack", None)
+    start = getattr(context, "_mocha_query_start", None)
+    if stack and start is not None:
+        duration = time.time() - start
+        for recorder in stack:
+            recorder.record(statement, parameters, duration)
+
+
+class QueryRecorder(object):
+    """
+    Record the statements run by the current thread, while it's started.
+    Recorders can be nested, ie: per request and in a test.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def start(self):
+        if not hasattr(_recorders, "stack"):
+            _recorders.stack = []
+        _recorders.stack.append(self)
+        return self
+
+    def stop(self):
+        stack = getattr(_recorders, "stack", [])
+        if self in stack:
+            stack.remove(self)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def record(self, statement, parameters, duration):
+        self.queries.append((statement, parameters, duration))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(q[2] for q in self.queries)
+
+    def duplicates(self):
+        """
+        The statements run more than once with the same parameters
+        :return: list of (statement, count)
+        """
+        counter = collections.Counter((q[0], repr(q[1])) for q in self.queries)
+        return [(k[0], n) for k, n in counter.most_common() if n > 1]
+
+    def repeated(self, min_count=2):
+        """
+        The statements of the same shape run at least `min_count` times, with
+        any parameters. Most likely a N+1, ie: a lazy load in a loop
+        :return: list of (statement, count)
+        """
+        counter = collections.Counter(q[0] for q in self.queries)
+        return [(k, n) for k, n in counter.most_common() if n >= min_count]
+
+    def summary(self, min_count=2):
+        """
+        :return: dict
+        """
+        return {
+            "count": self.count,
+            "total_time": self.total_time,
+            "duplicates": sum(n - 1 for _, n in self.duplicates()),
+            "repeated": self.repeated(min_count)
+        }
+
+# ------------------------------------------------------------------------------
+# Read replicas
+
+
+class RoutingSession(sa_orm.Session):
+    """
+    A session sending the reads to a replica, and the writes to the primary.
+    Once the session has written, or `use_primary()` is called, all its
+    queries go to the primary, so they see the writes. The session is
+    removed at the end of the request, so it sticks to the primary for the
+    rest of the request.
+    SELECT ... FOR UPDATE and raw statements go to the primary.
+    """
+    def __init__(self, db=None, **kwargs):
+        self.db = db
+        self._use_primary = False
+        super(RoutingSession, self).__init__(**kwargs)
+
+    def use_primary(self):
+        """
+        Send all the queries of the session to the primary
+        """
+        self._use_primary = True
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or not isinstance(clause, sa_sql.Select):
+            if self._flushing or clause is not None:
+                self._use_primary = True
+            return self.db.engine
+        if self._use_primary or clause._for_update_arg is not None:
+            return self.db.engine
+        return self.db.replicas.get() or self.db.engine
+
+
+class ReplicaSet(object):
+    """
+    The engines of the read replicas.
+    A replica raising a connection error is ejected, and checked again in the
+    background every `check_interval` seconds, until it answers.
+    When all the replicas are ejected, the reads go to the primary.
+    """
+    def __init__(self, urls, options, policy="round_robin", check_interval=30):
+        """
+        :param urls: list of db urls
+        :param options: dict - the engine options
+        :param policy: round_robin | random
+        :param check_interval: int - seconds between the checks of an
+                ejected replica
+        """
+        if policy not in ("round_robin", "random"):
+            raise ValueError("Invalid DB_REPLICA_POLICY: '%s'" % policy)
+        self.policy = policy
+        self.check_interval = check_interval
+        self.engines = []
+        for url in urls:
+            engine = sa.create_engine(sa_make_url(url), **options)
+            sa_event.listen(engine, "handle_error", self._on_error)
+            self.engines.append(engine)
+        self.healthy = list(self.engines)
+        self.ejected = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._checking = False
+
+    def get(self):
+        """
+        Return the engine of a healthy replica, or None if all are ejected
+        """
+        if self.ejected and not self._checking:
+            self._check_ejected()
+        healthy = self.healthy
+        if not healthy:
+            return None
+        if self.policy == "random":
+            return random.choice(healthy)
+        return healthy[next(self._counter) % len(healthy)]
+
+    def eject(self, engine):
+        with self._lock:
+            if engine in self.healthy:
+                logging.warning("DB replica ejected: %r" % (engine.url,))
+                self.healthy = [e for e in self.healthy if e is not engine]
+                self.ejected[engine] = time.time() + self.check_interval
+
+    def restore(self, engine):
+        with self._lock:
+            if engine in self.ejected:
+                logging.warning("DB replica restored: %r" % (engine.url,))
+                del self.ejected[engine]
+                self.healthy = [e for e in self.engines
+                                if e not in self.ejected]
+
+    def _on_error(self, context):
+        # A lost connection, or a failure to connect
+        if context.is_disconnect or context.connection is None:
+            self.eject(context.engine)
+
+    def _check_ejected(self):
+        # Only one thread starts the check, `get` reads _checking unlocked
+        now = time.time()
+        with self._lock:
+            if self._checking:
+                return
+            due = [e for e, at in self.ejected.items() if at <= now]
+            if not due:
+                return
+            self._checking = True
+
+        def check():
+            try:
+                for engine in due:
+                    try:
+                        engine.dispose()
+                        with engine.connect() as conn:
+                            conn.execute(sa.text("SELECT 1"))
+                        self.restore(engine)
+                    except Exception:
+                        with self._lock:
+                            if engine in self.ejected:
+                                self.ejected[engine] = \
+                                    time.time() + self.check_interval
+            finally:
+                with self._lock:
+                    self._checking = False
+
+        thread = threading.Thread(target=check)
+        thread.daemon = True
+        thread.start()
+
+# ------------------------------------------------------------------------------
+# Keyset pagination
+
+
+class KeysetPaginator(object):
+    """
+    Paginate a query by seeking after the last row of the page, instead of
+    an OFFSET, so any page takes the same time on a large table, and without
+    counting the rows.
+    The rows are sorted by `order_by`, then by the primary key to break the
+    ties. The sort columns should be indexed and not nullable.
+
+    The `page` is an opaque cursor, and it has the same interface as the
+    Paginator, so the `paginator` macro works with it, as prev/next links:
+
+        users = KeysetPaginator(User.query(),
+                                order_by=[User.created_at.desc()],
+                                page=request.args.get("page"))
+        for user in users:
+            ...
+        users.next_page_number  # the cursor of the next page
+    """
+    PER_PAGE = 10
+
+    def __init__(self, query, order_by=None, page=None, per_page=PER_PAGE,
+                 callback=None, total=None):
+        """
+        :param query: Query object
+        :param order_by: list of columns, or `column.desc()`
+        :param page: str - the cursor of the page. None for the first page
+        :param per_page: max number of items per page
+        :param callback: a function to callback on each item being iterated.
+        :param total: Number of items, if known. It's not counted
+        """
+        if not isinstance(per_page, int) or per_page < 1:
+            raise TypeError('`per_page` must be a positive integer')
+
+        self.query = query
+        self.per_page = per_page
+        self.callback = callback
+        self.total_items = total
+        self.columns = self._get_columns(query, order_by or [])
+
+        self.page = page
+        self._backward = False
+        self._values = None
+        cursor = self.decode_cursor(page) if page else None
+        if cursor and len(cursor["v"]) == len(self.columns):
+            self._backward = cursor["d"] == "p"
+            self._values = cursor["v"]
+        else:
+            self.page = None
+        self._items = None
+        self._has_more = False
+
+    @staticmethod
+    def _get_columns(query, order_by):
+        """
+        :return: list of (column, attribute name, desc)
+        """
+        mapper = sa.inspect(query.column_descriptions[0]["entity"])
+        columns = []
+        for col in order_by:
+            desc = False
+            if isinstance(col, sa_sql.elements.UnaryExpression):
+                desc = col.modifier is sa_sql.operators.desc_op
+                col = col.element
+            prop = getattr(col, "property", None)
+            if prop is None:
+                prop = mapper.get_property_by_column(col)
+            columns.append((col, prop.key, desc))
+
+        keys = [c[1] for c in columns]
+        desc = columns[-1][2] if columns else False
+        for col in mapper.primary_key:
+            key = mapper.get_property_by_column(col).key
+            if key not in keys:
+                columns.append((getattr(mapper.class_, key), key, desc))
+        return columns
+
+    @property
+    def items(self):
+        if self._items is None:
+            query = self.query.order_by(None)
+            orders = []
+            for col, _, desc in self.columns:
+                # Going back, the rows are read in reverse, then put back
+                desc = desc != self._backward
+                orders.append(col.desc() if desc else col.asc())
+            query = query.order_by(*orders)
+
+            if self._values is not None:
+                values = [_decode_cursor_value(v) for v in self._values]
+                clauses = []
+                for i, (col, _, desc) in enumerate(self.columns):
+                    cond = [self.columns[j][0] == values[j] for j in range(i)]
+                    if desc != self._backward:
+                        cond.append(col < values[i])
+                    else:
+                        cond.append(col > values[i])
+                    clauses.append(sa.and_(*cond))
+                query = query.filter(sa.or_(*clauses))
+
+            items = query.limit(self.per_page + 1).all()
+            self._has_more = len(items) > self.per_page
+            items = items[:self.per_page]
+            if self._backward:
+                items.reverse()
+            self._items = items
+        return self._items
+
+    def __iter__(self):
+        for i in self.items:
+            yield self.callback(i) if self.callback else i
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_prev(self):
+        """True if a previous page exists."""
+        if self._backward:
+            return bool(self.items) and self._has_more
+        return self._values is not None and bool(self.items)
+
+    @property
+    def has_next(self):
+        """True if a next page exists."""
+        if self._backward:
+            return bool(self.items)
+        return self._has_more
+
+    @property
+    def next_cursor(self):
+        """The cursor of the next page, or None"""
+        if self.has_next:
+            return self._cursor(self.items[-1], "n")
+        return None
+
+    @property
+    def prev_cursor(self):
+        """The cursor of the previous page, or None"""
+        if self.has_prev:
+            return self._cursor(self.items[0], "p")
+        return None
+
+    # The cursors take the place of the page numbers of the Paginator
+    next_page_number = next_cursor
+    prev_page_number = prev_cursor
+
+    @property
+    def pages(self):
+        return self.iter_pages()
+
+    def iter_pages(self, *args, **kwargs):
+        """There is no numbered page"""
+        return iter([])
+
+    def _cursor(self, item, direction):
+        values = [_encode_cursor_value(getattr(item, key))
+                  for _, key, _ in self.columns]
+        return self.encode_cursor({"d": direction, "v": values})
+
+    @staticmethod
+    def encode_cursor(data):
+        data = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        :return: dict, or None if the cursor is not valid
+        """
+        try:
+            cursor = str(cursor)
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            data = json.loads(data.decode("utf-8"))
+            if data["d"] in ("n", "p") and isinstance(data["v"], list):
+                return data
+        except Exception:
+            pass
+        return None
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, arrow.Arrow):
+        return {"arrow": value.isoformat()}
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat(), "tz": value.tzinfo is not None}
+    if isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    return value
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if "arrow" in value:
+            return arrow.get(value["arrow"])
+        if "datetime" in value:
+            dt = arrow.get(value["datetime"])
+            return dt.datetime if value.get("tz") else dt.naive
+        if "date" in value:
+            return arrow.get(value["date"]).date()
+        if "decimal" in value:
+            return decimal.Decimal(value["decimal"])
+    return value
+
+
+# ------------------------------------------------------------------------------
+# PoolMetrics
+
+
+class PoolMetrics(object):
+    """
+    Measure how long getting a connection from the pool takes.
+    It keeps the count, the total and max wait, and a histogram of the waits.
+    When a wait crosses `wait_warning` seconds, it logs a warning and calls
+    the callbacks added with `on_slow_checkout`.
+
+        @db.pool_metrics.on_slow_checkout
+        def slow_checkout(wait, pool):
+            ...
+    """
+
+    # Upper bounds of the histogram buckets, in milliseconds
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, float("inf"))
+
+    def __init__(self, wait_warning=0.5):
+        self.wait_warning = wait_warning
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.slow_checkouts = 0
+            self.histogram = [0] * len(self.BUCKETS)
+
+    def on_slow_checkout(self, fn):
+        """
+        Add a callback, called with (wait, pool) on a slow checkout
+        """
+        self._callbacks.append(fn)
+        return fn
+
+    def instrument(self, engine):
+        """
+        Wrap the connect of the engine pool, to time the checkouts.
+        The new pool is wrapped too when the engine is disposed
+        """
+        self._wrap_pool(engine.pool)
+        sa_event.listen(engine, "engine_disposed",
+                        lambda e: self._wrap_pool(e.pool))
+
+    def _wrap_pool(self, pool):
+        # SQLAlchemy < 1.4 checks out the connections of engine.connect()
+        # with unique_connection
+        for name in ("connect", "unique_connection"):
+            if hasattr(pool, name):
+                setattr(pool, name, self._timed(getattr(pool, name), pool))
+
+    def _timed(self, checkout, pool):
+        def timed_checkout(*args, **kwargs):
+            start = time.time()
+            try:
+                return checkout(*args, **kwargs)
+            finally:
+                self.record(time.time() - start, pool)
+        return timed_checkout
+
+    def record(self, wait, pool=None):
+        """
+        Record the wait of a checkout
+        :param wait: float - seconds
+        :param pool: the pool
+        """
+        ms = wait * 1000
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.histogram[bisect.bisect_left(self.BUCKETS, ms)] += 1
+            slow = self.wait_warning and wait >= self.wait_warning
+            if slow:
+                self.slow_checkouts += 1
+        if slow:
+            logging.warning("DB pool checkout took %.1fms (%s)"
+                            % (ms, pool.status() if pool else ""))
+            for fn in self._callbacks:
+                fn(wait, pool)
+
+    def stats(self):
+        """
+        :return: dict
+        """
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "wait_total": self.wait_total,
+                "wait_avg": self.wait_total / self.checkouts
+                if self.checkouts else 0.0,
+                "wait_max": self.wait_max,
+                "slow_checkouts": self.slow_checkouts,
+                "wait_histogram": [("<=%sms" % b if b != float("inf")
+                                    else ">%sms" % self.BUCKETS[-2], c)
+                                   for b, c in zip(self.BUCKETS,
+                                                   self.histogram)]
+            }
+
 # ------------------------------------------------------------------------------
 # StorageObjectType
 
@@ -96,6 +739,9 @@ class StorageObjectType(sa_utils.JSONType):
 
         img.image.url (will get it from my_other_storage)
 
+        # Load the objects of many rows at once, instead of one by one
+        images = StorageObject.hydrate(Image.query().all())
+
 
     """
 
@@ -121,8 +767,19 @@ class StorageObject(dict):
     """
     This object will be loaded when querying the table
     It also extends dict so it can json serialized when being copied
+
+    The keys not saved in the db, ie: secure_url, extra, are memoized in
+    the cache by object name and hash, so the storage is called once per
+    object, not once per request.
+
+    To load the objects of a result set at once, instead of one storage call
+    per row:
+        users = StorageObject.hydrate(User.query().all())
     """
 
+    # Keys memoized in the cache, besides the ones of StorageObjectType
+    METADATA_KEYS = ["secure_url", "full_path", "extra", "meta_data"]
+
     def __init__(self, data):
         """
         :param data: dict
@@ -132,18 +789,42 @@ class StorageObject(dict):
 
         self._storage_obj = None
         self._storage_loaded = False
+        self._metadata = None
         self._data = data
         super(self.__class__, self).__init__(data)
 
     def __getattr__(self, item):
-        if item in self._data and not self._storage_loaded:
-            return self._data.get(item)
+        # Private and special attributes are never looked up in the storage,
+        # ie: when unpickling, before __init__ sets them
+        if item.startswith("_"):
+            raise AttributeError(item)
 
         if not self._storage_loaded:
-            from mocha.ext import storage
-            self.from_storage(storage)
+            if item in self._data:
+                return self._data.get(item)
+            if self._metadata is None:
+                self._metadata = _get_storage_metadata(self.cache_key)[0] or {}
+            if item in self._metadata:
+                return self._metadata[item]
+            self._load()
         return getattr(self._storage_obj, item)
 
+    def __reduce__(self):
+        # Pickled without the storage object, ie: when cached
+        return self.__class__, (dict(self._data),)
+
+    @property
+    def cache_key(self):
+        """
+        The cache key of the metadata, by object name and hash
+        :return: str
+        """
+        name = self._data.get("name") or ""
+        if isinstance(name, six.text_type):
+            name = name.encode("utf-8")
+        return "mocha:storage:object:%s:%s" % (hashlib.md5(name).hexdigest(),
+                                               self._data.get("hash"))
+
     def from_storage(self, storage):
         """
         To use a different storage
@@ -152,3 +833,133 @@ class StorageObject(dict):
         self._storage_obj = storage.get(self._data["name"])
         self._storage_loaded = True
 
+    def _load(self):
+        """
+        Load the object from the default storage, and memoize its metadata
+        """
+        from mocha.ext import storage
+        self.from_storage(storage)
+        if self._storage_obj is not None:
+            _set_storage_metadata({self.cache_key: _get_metadata(self._storage_obj)})
+
+    @classmethod
+    def hydrate(cls, items, storage=None, workers=None):
+        """
+        Load the unloaded StorageObjects of a result set at once.
+        The metadata are taken from the cache, and the objects not in the cache
+        are loaded from the storage concurrently, in a pool of `workers` threads
+
+            users = StorageObject.hydrate(User.query().all())
+
+        :param items: a list of StorageObject, or of models with StorageObject
+                      columns, ie: the rows of a query
+        :param storage: flask_cloudy.Storage - To use a different storage. The
+                        metadata are memoized only with the default storage
+        :param workers: int - Max number of concurrent storage calls. By
+                        default STORAGE_HYDRATE_WORKERS
+        :return: items
+        """
+        objects = {}
+        for obj in _find_storage_objects(items):
+            if not obj._storage_loaded and obj._data.get("name"):
+                objects.setdefault(obj.cache_key, []).append(obj)
+        if not objects:
+            return items
+
+        memoize = storage is None
+        if memoize:
+            cached = _get_storage_metadata(*objects.keys())
+            for key, metadata in zip(list(objects.keys()), cached):
+                if metadata:
+                    for obj in objects.pop(key):
+                        obj._metadata = metadata
+            if not objects:
+                return items
+            from mocha.ext import storage
+
+        if workers is None:
+            workers = _config("STORAGE_HYDRATE_WORKERS", 8)
+        keys = list(objects.keys())
+        names = [objects[k][0]._data["name"] for k in keys]
+        pool = ThreadPool(max(1, min(workers, len(names))))
+        try:
+            storage_objs = pool.map(storage.get, names)
+        finally:
+            pool.close()
+            pool.join()
+
+        # The metadata are read here, in the caller's context, since some
+        # keys need the app, ie: the url of a local storage
+        metadata = {}
+        for key, storage_obj in zip(keys, storage_objs):
+            for obj in objects[key]:
+                obj._storage_obj = storage_obj
+                obj._storage_loaded = True
+            if storage_obj is not None:
+                metadata[key] = _get_metadata(storage_obj)
+        if memoize and metadata:
+            _set_storage_metadata(metadata)
+        return items
+
+
+def _find_storage_objects(items):
+    """
+    Yield the StorageObjects in the items, and in their attributes
+    :param items: a StorageObject, a model, or a list of them
+    """
+    if isinstance(items, StorageObject) or not hasattr(items, "__iter__"):
+        items = [items]
+    for item in items:
+        if isinstance(item, StorageObject):
+            yield item
+        elif item is not None:
+            for v in getattr(item, "__dict__", {}).values():
+                if isinstance(v, StorageObject):
+                    yield v
+
+
+def _get_metadata(storage_obj):
+    """
+    Return the keys of a flask_cloudy.Object to memoize
+    :param storage_obj: flask_cloudy.Object
+    :return: dict
+    """
+    metadata = {}
+    for k in StorageObjectType.DEFAULT_KEYS + StorageObject.METADATA_KEYS:
+        try:
+            metadata[k] = getattr(storage_obj, k)
+        except Exception as e:
+            logging.debug("StorageObject: can't get '%s': %s" % (k, e))
+    return metadata
+
+
+def _config(key, default=None):
+    from flask import current_app, has_app_context
+    if has_app_context():
+        return current_app.config.get(key, default)
+    return default
+
+
+def _get_storage_metadata(*keys):
+    """
+    Get the memoized metadata
+    :return: list of dict, or None when not in the cache
+    """
+    from flask import has_app_context
+    if not has_app_context():
+        return [None] * len(keys)
+    from mocha.ext import cache
+    return cache.get_many(*keys)
+
+
+def _set_storage_metadata(mapping):
+    """
+    Memoize the metadata
+    :param mapping: dict - {cache_key: metadata}
+    """
+    from flask import has_app_context
+    if has_app_context():
+        from mocha.ext import cache
+        cache.set_many(mapping,
+                       timeout=_config("STORAGE_OBJECT_CACHE_TIMEOUT", 3600))
+
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+XML Serializer
+
+Serialize dicts, lists and generators to XML, in the same shape as
+`dicttoxml` 1.6.6 with its defaults, so it can replace it in `render.xml`:
+
+    <?xml version="1.0" encoding="UTF-8" ?>
+    <root><name type="str">Mocha</name><tags type="list">
+    <item type="str">flask</item></tags></root>
+
+Where dicttoxml fails, it differs: the keys that are not strings, ie: int, are
+converted to text instead of raising, the `name` attribute of the invalid keys
+is escaped, and bytes are decoded as a UTF-8 string instead of a list of ints.
+The `name` attribute is always before `type`, as dicttoxml does on Python 3.
+
+The elements are written in a flat list instead of recursive strings, the
+tag names sanitization is cached, and `iter_xml` yields the document in
+chunks, so a large list or a generator is never held in memory at once.
+
+    xml_serializer.dumps(data) -> bytes
+    xml_serializer.iter_xml(data) -> generator of str
+"""
+
+from __future__ import unicode_literals
+import six
+import numbers
+from xml.dom.minidom import parseString
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
+
+__all__ = ["dumps", "iter_xml"]
+
+_STR_TYPES = (str, six.text_type)
+_INT_TYPES = six.integer_types
+
+# Cache of the sanitized tag names: {(type, key): (tag, attrstring)}
+_tag_names = {}
+_TAG_NAMES_MAX_SIZE = 10000
+
+
+def _escape(s):
+    if six.PY2 and isinstance(s, str):
+        s = s.decode("utf-8")
+    return s.replace("&", "&amp;") \
+        .replace('"', "&quot;") \
+        .replace("'", "&apos;") \
+        .replace("<", "&lt;") \
+        .replace(">", "&gt;")
+
+
+def _is_valid_name(name):
+    try:
+        parseString('<?xml version="1.0" encoding="UTF-8" ?><%s>foo</%s>'
+                    % (name, name))
+        return True
+    except Exception:
+        return False
+
+
+def _make_tag(key):
+    """
+    Return a valid tag name for the key, like dicttoxml does:
+    digits are prefixed with `n`, spaces are replaced with `_`,
+    otherwise the key goes into a `name` attribute of a `key` element
+    :param key:
+    :return: tuple (tag, attrstring)
+    """
+    if isinstance(key, six.binary_type):
+        key = key.decode("utf-8")
+    elif type(key) not in _STR_TYPES:
+        key = six.text_type(key)
+    if _is_valid_name(key):
+        return key, ""
+    if key.isdigit():
+        return "n%s" % key, ""
+    if _is_valid_name(key.replace(" ", "_")):
+        return key.replace(" ", "_"), ""
+    return "key", ' name="%s"' % _escape(key)
+
+
+def _tag(key):
+    """
+    Return the cached (tag, attrstring) of a dict key
+    """
+    ck = (type(key), key)
+    try:
+        return _tag_names[ck]
+    except KeyError:
+        tag = _make_tag(key)
+        if len(_tag_names) < _TAG_NAMES_MAX_SIZE:
+            _tag_names[ck] = tag
+        return tag
+
+
+def _write(tag, attr, val, out):
+    """
+    Append the element of a value to out
+    :param tag: the tag name
+    :param attr: the attribute string, ie: ' name="x"'
+    :param val: the value
+    :param out: list
+    """
+    t = type(val)
+    if t in _STR_TYPES:
+        out.append('<%s%s type="str">%s</%s>' % (tag, attr, _escape(val), tag))
+    elif t is six.binary_type:
+        out.append('<%s%s type="str">%s</%s>'
+                   % (tag, attr, _escape(val.decode("utf-8")), tag))
+    elif t is bool:
+        # Like dicttoxml, booleans are written as `True` and `False`
+        out.append('<%s%s type="bool">%s</%s>' % (tag, attr, val, tag))
+    elif t in _INT_TYPES:
+        out.append('<%s%s type="int">%s</%s>' % (tag, attr, val, tag))
+    elif t is float:
+        out.append('<%s%s type="float">%s</%s>' % (tag, attr, val, tag))
+    elif val is None:
+        out.append('<%s%s type="null"></%s>' % (tag, attr, tag))
+    elif t is dict:
+        out.append('<%s%s type="dict">' % (tag, attr))
+        _write_dict(val, out)
+        out.append("</%s>" % tag)
+    elif t is list or t is tuple:
+        out.append('<%s%s type="list">' % (tag, attr))
+        _write_list(val, out)
+        out.append("</%s>" % tag)
+    elif isinstance(val, numbers.Number):
+        out.append('<%s%s type="number">%s</%s>' % (tag, attr, val, tag))
+    elif hasattr(val, "isoformat"):
+        out.append('<%s%s type="str">%s</%s>'
+                   % (tag, attr, _escape(val.isoformat()), tag))
+    elif isinstance(val, dict):
+        out.append('<%s%s type="dict">' % (tag, attr))
+        _write_dict(val, out)
+        out.append("</%s>" % tag)
+    elif isinstance(val, Iterable):
+        out.append('<%s%s type="list">' % (tag, attr))
+        _write_list(val, out)
+        out.append("</%s>" % tag)
+    else:
+        raise TypeError("Unsupported data type: %s (%s)"
+                        % (val, type(val).__name__))
+
+
+def _write_dict(obj, out):
+    for key, val in obj.items():
+        tag, attr = _tag(key)
+        _write(tag, attr, val, out)
+
+
+def _write_list(obj, out):
+    for val in obj:
+        _write("item", "", val, out)
+
+
+def _is_scalar(obj):
+    return type(obj) in _STR_TYPES \
+        or type(obj) is six.binary_type \
+        or obj is None \
+        or isinstance(obj, numbers.Number) \
+        or hasattr(obj, "isoformat")
+
+
+def _write_scalar(obj, out):
+    # Like dicttoxml, None as the whole document is an empty string
+    if obj is None:
+        out.append('<item type="str"></item>')
+    else:
+        _write("item", "", obj, out)
+
+
+def iter_xml(obj, root="root", xml_declaration=True, chunk_size=256):
+    """
+    Yield the XML document of the object in chunks.
+    The chunks are cut between the items of the top-level dict, list or
+    generator.
+    :param obj: dict, list, generator or a scalar
+    :param root: the root element name
+    :param xml_declaration: bool - to start with the XML declaration
+    :param chunk_size: int - number of top-level items per chunk
+    :return: generator of str
+    """
+    if xml_declaration:
+        yield '<?xml version="1.0" encoding="UTF-8" ?>'
+    yield "<%s>" % root
+    out = []
+    if _is_scalar(obj):
+        _write_scalar(obj, out)
+    else:
+        if isinstance(obj, dict):
+            items = ((_tag(k), v) for k, v in obj.items())
+        elif isinstance(obj, Iterable):
+            items = ((("item", ""), v) for v in obj)
+        else:
+            raise TypeError("Unsupported data type: %s (%s)"
+                            % (obj, type(obj).__name__))
+        for i, ((tag, attr), val) in enumerate(items, 1):
+            _write(tag, attr, val, out)
+            if i % chunk_size == 0:
+                yield "".join(out)
+                out = []
+    yield "".join(out)
+    yield "</%s>" % root
+
+
+def dumps(obj, root="root", xml_declaration=True):
+    """
+    Serialize the object to an XML document
+    :param obj: dict, list, generator or a scalar
+    :param root: the root element name
+    :param xml_declaration: bool - to start with the XML declaration
+    :return: bytes
+    """
+    out = []
+    if xml_declaration:
+        out.append('<?xml version="1.0" encoding="UTF-8" ?>')
+    out.append("<%s>" % root)
+    if _is_scalar(obj):
+        _write_scalar(obj, out)
+    elif isinstance(obj, dict):
+        _write_dict(obj, out)
+    elif isinstance(obj, Iterable):
+        _write_list(obj, out)
+    else:
+        raise TypeError("Unsupported data type: %s (%s)"
+                        % (obj, type(obj).__name__))
+    out.append("</%s>" % root)
+    return "".join(out).encode("utf-8")
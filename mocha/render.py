@@ -2,48 +2,90 @@
 
 
 
-import copy
+import time
 import inspect
+import datetime
 import arrow
 import blinker
 import functools
+import collections
 import flask_cors
+import flask_login
 from jinja2 import Markup
-from dicttoxml import dicttoxml
 from werkzeug.wrappers import BaseResponse
+from . import utils
+from .extras import xml_serializer
+from .ext import cache
 from .core import (Mocha,
                    init_app as h_init_app,
                    apply_function_to_members,
                    build_endpoint_route_name,
                    set_view_attr,
-                   get_view_attr)
+                   get_view_attr,
+                   config,
+                   _check_conditional,
+                   _stream_with_context)
 from flask import (Response,
-                   jsonify,
                    request,
                    current_app,
                    url_for,
                    make_response,
+                   session,
                    g)
 
 # ----------------------------------------------------------------------------------------------------------------------
-# ----  Monkey patch jsonify, to convert other data type: ie: Arrow
+# ----  Monkey patch flask json, to convert other data type: ie: Arrow
 import flask.json
 from flask.json import dumps as flask_dumps
 
 
 class _JSONEnc(flask.json.JSONEncoder):
     def default(self, o):
-        if isinstance(o, arrow.Arrow):
-            return o.for_json()
-        else:
+        try:
+            return utils._json_default(o)
+        except TypeError:
             return super(self.__class__, self).default(o)
 
 
 def dumps(o, **kw):
-    kw["cls"] = _JSONEnc
-    return flask_dumps(o, **kw)
+    """
+    flask.json.dumps, and so the `tojson` filter, with the JSON serializer of
+    the app. See `utils.json_dumps`. The calls with options it doesn't take,
+    ie: `separators`, go to the flask json
+    """
+    if set(kw) - set(["indent", "sort_keys"]):
+        kw["cls"] = _JSONEnc
+        return flask_dumps(o, **kw)
+    return utils.json_dumps(o,
+                            pretty=bool(kw.get("indent")),
+                            sort_keys=kw.get("sort_keys", False)).decode("utf-8")
 flask.json.dumps = dumps
 
+
+def jsonify(*args, **kwargs):
+    """
+    Like flask.jsonify, but the data is serialized straight to bytes with the
+    JSON serializer of the app. See `utils.json_dumps`
+    It's indented with JSONIFY_PRETTYPRINT_REGULAR, and sent as
+    JSONIFY_MIMETYPE
+    :return: Response
+    """
+    if args and kwargs:
+        raise TypeError("jsonify() behavior undefined when passed both args "
+                        "and kwargs")
+    data = args[0] if len(args) == 1 else args or kwargs
+    config = current_app.config
+    pretty = config.get("JSONIFY_PRETTYPRINT_REGULAR", False)
+    return current_app.response_class(
+        utils.json_dumps(data, pretty=pretty),
+        mimetype=config.get("JSONIFY_MIMETYPE", "application/json"))
+
+
+def _setup_json_serializer(app):
+    utils.set_json_serializer(app.config.get("JSON_SERIALIZER"))
+
+h_init_app(_setup_json_serializer)
+
 # ----------------------------------------------------------------------------------------------------------------------
 
 
@@ -87,18 +129,66 @@ def _build_response(data, renderer=None):
         raise AttributeError(" Renderer is required")
     if isinstance(data, dict) or data is None:
         data = {} if data is None else data
+        response = _pop_conditional(data)
+        if response is not None:
+            return response
         for _ in __view_parsers:
             data = _(data)
         return renderer(data), 200
     elif isinstance(data, tuple):
         data, status, headers = _normalize_response_tuple(data)
+        if isinstance(data, dict):
+            response = _pop_conditional(data)
+            if response is not None:
+                return response
         for _ in __view_parsers:
             data = _(data)
         return renderer(data or {}), status, headers
     return data
 
+def _pop_conditional(data):
+    """
+    Pop the `_etag` and `_last_modified` supplied by the view in its data.
+    Return a 304 response if the client has this copy already
+    :param data: dict
+    :return: Response or None
+    """
+    etag = data.pop("_etag", None)
+    last_modified = data.pop("_last_modified", None)
+    if etag or last_modified:
+        return _check_conditional(etag, last_modified)
+    return None
+
+
+def _conditional_response(response):
+    """
+    Response extension, to answer If-None-Match and If-Modified-Since with
+    a 304. It applies to the views supplying `_etag` or `_last_modified`,
+    or to all the views with the config CONDITIONAL_RESPONSE.
+    Without an etag from the view, a strong one is computed from the body.
+    :param response:
+    :return: Response
+    """
+    validators = getattr(g, "__CONDITIONAL__", None)
+    if validators is None and not config("CONDITIONAL_RESPONSE"):
+        return response
+    g.__CONDITIONAL__ = None
+    if request.method not in ("GET", "HEAD") \
+            or response.status_code != 200 \
+            or response.is_streamed:
+        return response
+    etag, last_modified = validators or (None, None)
+    if etag:
+        response.set_etag(etag)
+    elif "ETag" not in response.headers:
+        response.set_etag(utils.md5(response.get_data()))
+    if last_modified:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
+
+
 json_renderer = lambda i, data: _build_response(data, jsonify)
-xml_renderer = lambda i, data: _build_response(data, dicttoxml)
+xml_renderer = lambda i, data: _build_response(data, xml_serializer.dumps)
 
 
 def json(func):
@@ -131,10 +221,125 @@ def xml(func):
         @functools.wraps(func)
         def decorated_view(*args, **kwargs):
             data = func(*args, **kwargs)
-            return _build_response(data, dicttoxml)
+            return _build_response(data, xml_serializer.dumps)
         return decorated_view
 
 
+def json_stream(func):
+    """
+    Decorator to stream a large result as a JSON array, item by item, so it's
+    never held in memory. The view returns a generator, a list or a
+    SQLAlchemy query, which is fetched in batches of JSON_STREAM_YIELD_PER
+    rows. The view parsers are applied to each item.
+
+        @render.json_stream
+        def export(self):
+            return Post.query().filter(Post.is_published == True)
+
+    ** Errors raised while streaming can't change the response anymore, since
+    the status and headers have been sent.
+
+    :param func:
+    :return:
+    """
+    return _stream_decorator(func, json_stream, _json_array_stream,
+                             "application/json")
+
+
+def ndjson_stream(func):
+    """
+    Decorator to stream a large result as newline delimited JSON, one item
+    per line. See `json_stream`
+    :param func:
+    :return:
+    """
+    return _stream_decorator(func, ndjson_stream, _ndjson_stream,
+                             "application/x-ndjson")
+
+
+def xml_stream(func):
+    """
+    Decorator to stream a large result as XML, item by item. The document
+    has the same shape as @render.xml with a list. See `json_stream`
+    :param func:
+    :return:
+    """
+    return _stream_decorator(func, xml_stream, _xml_stream,
+                             "application/xml")
+
+
+def _stream_decorator(func, decorator, stream, mimetype):
+    if inspect.isclass(func):
+        apply_function_to_members(func, decorator)
+        return func
+    else:
+        @functools.wraps(func)
+        def decorated_view(*args, **kwargs):
+            data = func(*args, **kwargs)
+            if isinstance(data, Response) or isinstance(data, BaseResponse):
+                return data
+            return Response(_stream_with_context(stream(data)),
+                            mimetype=mimetype)
+        return decorated_view
+
+
+def _stream_items(data):
+    """
+    Yield the items of the data, after the view parsers
+    :param data: iterable or SQLAlchemy query
+    """
+    if hasattr(data, "yield_per"):
+        data = data.yield_per(config("JSON_STREAM_YIELD_PER", 1000))
+    for item in data:
+        if hasattr(item, "__table__") or hasattr(item, "_asdict"):
+            item = utils._json_default(item)
+        for _ in __view_parsers:
+            item = _(item)
+        yield item
+
+
+def _buffer_stream(chunks, size=65536):
+    """
+    Join the small chunks, to send fewer and larger writes
+    """
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b"".join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield b"".join(buf)
+
+
+def _json_array_stream(data):
+    def chunks():
+        yield b"["
+        sep = b""
+        for item in _stream_items(data):
+            yield sep
+            yield utils.json_dumps(item)
+            sep = b","
+        yield b"]"
+    return _buffer_stream(chunks())
+
+
+def _xml_stream(data):
+    chunks = xml_serializer.iter_xml(_stream_items(data))
+    return _buffer_stream(c.encode("utf-8") for c in chunks)
+
+
+def _ndjson_stream(data):
+    def chunks():
+        for item in _stream_items(data):
+            yield utils.json_dumps(item)
+            yield b"\n"
+    return _buffer_stream(chunks())
+
+
 def jsonp(func):
     """Wraps JSONified output for JSONP requests.
     http://flask.pocoo.org/snippets/79/
@@ -221,8 +426,277 @@ def template(page=None, layout=None, markup="jade", **kwargs):
     return decorator
 
 
+def stream(func):
+    """
+    Decorator to stream the rendered template, instead of rendering the whole
+    page first. The first bytes are sent sooner, and the page is never held
+    in memory. Best for views with a large result, ie: long listings.
+
+    It works on both Mocha class and view methods, along with @template
+
+    on class
+        all the views of the class are streamed
+
+    on method that return a dict
+        the view is streamed
+
+    ** Errors raised by the template while streaming can't change the
+    response anymore, since the status and headers have been sent. For the
+    same reason, the template can't change the session, except for reading
+    the flashed messages.
+
+    :return:
+    """
+    if inspect.isclass(func):
+        setattr(func, "template_stream", True)
+        return func
+    else:
+        @functools.wraps(func)
+        def wrap(*args, **kwargs):
+            response = func(*args, **kwargs)
+            if isinstance(response, dict) or response is None:
+                response = response or {}
+                response.setdefault("_stream", True)
+            return response
+        return wrap
+
+
+# ------------------------------------------------------------------------------
+# RESPONSE CACHE
+
+
+def cached(timeout=300, query_args=None, vary=None, stale=0, tags=None,
+           public=False):
+    """
+    Decorator to cache the final response of a view, once it's rendered, in
+    `mocha.cache`.
+
+    It works on both Mocha class and view methods. Decorators restricting the
+    access, ie: @login_required, must be placed above it, so they still run
+    when the response comes from the cache.
+
+    The response is cached by endpoint, view args, query args, locale and the
+    `vary` key. Without `vary`, the responses of an authenticated user are
+    cached by user id, so a user never gets the page of another one.
+    A page reading the CSRF token, ie: with a form, is not cached.
+    It's sent with an ETag, Last-Modified and Cache-Control, and a request
+    with a matching If-None-Match gets a 304.
+
+        @render.cached(timeout=600, query_args=["page"], tags=["post:{id}"])
+        def read(self, id):
+            ...
+
+        # in the model, on update
+        render.invalidate_cached("post:%s" % post.id)
+
+    :param timeout: int - seconds the response is fresh
+    :param query_args: list - the query args to key on. None for all
+    :param vary: callable - returns an extra key. ie: the user or the role
+            lambda: current_user.id
+        It replaces the user id key, so to share a page between all the
+        users, return a constant: lambda: None
+    :param stale: int - seconds a response is still served after it expires,
+            while one request renders it again
+    :param tags: list - tags to invalidate the response with
+            `invalidate_cached`. They are formatted with the view args
+    :param public: bool - to allow shared caches to keep the response
+    :return:
+    """
+    options = {
+        "timeout": timeout,
+        "query_args": tuple(query_args) if query_args is not None else None,
+        "vary": vary,
+        "stale": stale,
+        "tags": tuple(tags or ()),
+        "public": public
+    }
+
+    def decorator(f):
+        if inspect.isclass(f):
+            apply_function_to_members(f, decorator)
+            return f
+
+        @functools.wraps(f)
+        def wrap(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return f(*args, **kwargs)
+            key = _response_cache_key(options)
+            entry = cache.get(key)
+            if entry is not None:
+                # Once stale, only the request getting the lock renders it
+                if time.time() < entry["fresh_until"] \
+                        or not cache.add(key + ":lock", 1, timeout=30):
+                    return _cached_response(entry, options)
+            g.__RESPONSE_CACHE__ = key, options
+            return f(*args, **kwargs)
+        return wrap
+    return decorator
+
+
+def invalidate_cached(*tags):
+    """
+    Invalidate the responses cached with these tags
+    :param tags: str
+    """
+    for tag in tags:
+        cache.set(_tag_key(tag), utils.guid(), timeout=0)
+
+
+def invalidate_cached_on_change(model, *tags):
+    """
+    Invalidate the cached responses with these tags whenever a record of the
+    model is inserted, updated or deleted.
+    The tags are formatted with the record id.
+
+        invalidate_cached_on_change(Post, "posts", "post:{id}")
+
+    :param model: db.Model
+    :param tags: str
+    """
+    from sqlalchemy import event
+
+    def listener(mapper, connection, target):
+        invalidate_cached(*[t.format(id=target.id) for t in tags])
+
+    for e in ("after_insert", "after_update", "after_delete"):
+        event.listen(model, e, listener)
+
+
+def _tag_key(tag):
+    return "mocha:render:cached:tag:%s" % tag
+
+
+def _response_cache_key(options):
+    view_args = request.view_args or {}
+    if options["query_args"] is None:
+        query = sorted(request.args.lists())
+    else:
+        query = [(k, request.args.getlist(k)) for k in options["query_args"]]
+    locale = None
+    if "babel" in current_app.extensions:
+        from flask_babel import get_locale
+        locale = str(get_locale())
+    parts = [request.endpoint, sorted(view_args.items()), query, locale]
+    if options["vary"]:
+        parts.append(options["vary"]())
+    else:
+        parts.append(_current_user_key())
+    if options["tags"]:
+        tags = [_tag_key(t.format(**view_args)) for t in options["tags"]]
+        parts.append(cache.get_many(*tags))
+    return "mocha:render:cached:%s" % utils.md5(repr(parts).encode("utf-8"))
+
+
+def _current_user_key():
+    """
+    The id of the authenticated user, or None
+    """
+    if not hasattr(current_app, "login_manager"):
+        return None
+    user = flask_login.current_user
+    if user and user.is_authenticated:
+        return "user:%s" % user.get_id()
+    return None
+
+
+def _set_cache_headers(response, entry, options):
+    response.set_etag(entry["etag"])
+    response.last_modified = datetime.datetime.utcfromtimestamp(
+        entry["created_at"])
+    cache_control = ["public" if options["public"] else "private",
+                     "max-age=%d" % max(0, entry["fresh_until"] - time.time())]
+    if options["stale"]:
+        cache_control.append("stale-while-revalidate=%d" % options["stale"])
+    response.headers["Cache-Control"] = ", ".join(cache_control)
+
+
+def _cached_response(entry, options):
+    if entry["etag"] in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(entry["body"],
+                            status=entry["status"],
+                            headers=entry["headers"])
+    _set_cache_headers(response, entry, options)
+    return response
+
+
+def _cache_response(response):
+    """
+    Response extension, to save the response of a @cached view
+    """
+    pending = getattr(g, "__RESPONSE_CACHE__", None)
+    if pending is None:
+        return response
+    g.__RESPONSE_CACHE__ = None
+    key, options = pending
+
+    # Streamed responses, errors, and pages depending on a session change,
+    # ie: a flashed message, or holding the CSRF token, are not cached
+    if response.status_code == 200 \
+            and not response.is_streamed \
+            and not session.modified \
+            and not getattr(g, "__CSRF_TOKEN_READ__", False):
+        now = time.time()
+        body = response.get_data()
+        entry = {
+            "status": response.status_code,
+            "headers": [(k, v) for k, v in response.headers
+                        if k.lower() != "set-cookie"],
+            "body": body,
+            "etag": utils.md5(body),
+            "created_at": now,
+            "fresh_until": now + options["timeout"]
+        }
+        cache.set(key, entry, timeout=options["timeout"] + options["stale"])
+        _set_cache_headers(response, entry, options)
+    cache.delete(key + ":lock")
+    return response
+
+# The response extensions run in this order: a response is cached before it
+# can be turned into a 304 for the client
+Mocha._ext.extend([_cache_response, _conditional_response])
+
+
 # -----
 
+# A menu item of the compiled nav.
+# `props` are the static properties, `title` and `visible` may be resolved on
+# each request, `subnav` is a tuple of _NavItem, or None for a menu link
+_NavItem = collections.namedtuple("_NavItem", ["props", "title", "visible", "subnav"])
+
+
+class _LazySiteNav(object):
+    """
+    Hold the nav in `g.__SITENAV__`, and only render it the first time it is
+    read. JSON endpoints and templates without nav don't pay for it
+    """
+
+    def __init__(self, nav):
+        self._nav = nav
+        self._menu = None
+
+    @property
+    def menu(self):
+        if self._menu is None:
+            self._menu = self._nav.render()
+        return self._menu
+
+    def __iter__(self):
+        return iter(self.menu)
+
+    def __len__(self):
+        return len(self.menu)
+
+    def __getitem__(self, index):
+        return self.menu[index]
+
+    def __bool__(self):
+        return bool(self.menu)
+
+    __nonzero__ = __bool__
+
+
 class SiteNavigation(object):
     """
     SiteNavigation is class decorator to build page menu while building the enpoints
@@ -307,6 +781,7 @@ class SiteNavigation(object):
 
     def __init__(self):
         self.MENU = {}
+        self._compiled = None
 
     def add(self, title, obj, **kwargs):
         """
@@ -325,10 +800,14 @@ class SiteNavigation(object):
 
     def clear(self):
         self.MENU = {}
+        self._compiled = None
 
     def _push(self, title, view, class_name, is_class, **kwargs):
         """ Push nav data stack """
 
+        # The menu will be compiled again on next render
+        self._compiled = None
+
         # Set the page title
         set_view_attr(view, "title", title, cls_name=class_name)
 
@@ -403,12 +882,25 @@ class SiteNavigation(object):
         """Title can also be a function"""
         return title() if hasattr(title, '__call__') else title
 
-    def _test_visibility(self, shows):
+    def _test_visibility(self, shows, results=None):
+        """
+        :param shows: bool, callback or list of them
+        :param results: dict - to memoize the callbacks results, when rendering
+        """
         if isinstance(shows, bool):
             return shows
         elif not isinstance(shows, list):
             shows = [shows]
-        return all([x() if hasattr(x, "__call__") else x for x in shows])
+        if results is None:
+            results = {}
+        for x in shows:
+            if hasattr(x, "__call__"):
+                if x not in results:
+                    results[x] = x()
+                x = results[x]
+            if not x:
+                return False
+        return True
 
     def get(self, cls):
         key = self.get_key(cls)
@@ -422,48 +914,72 @@ class SiteNavigation(object):
         """
         return "%s.%s" % (cls.__module__, cls.__name__)
 
-    def render(self):
-        """ Render the menu into a sorted by order multi dict """
+    def compile(self):
+        """
+        Compile the menu into an immutable tree, sorted by order, with the ids
+        set. It's done once, then each render only applies the request
+        data on it: the active endpoint, the visibility and callable titles
+        :return: tuple of _NavItem
+        """
         menu_list = []
         menu_index = 0
-        for _, menu in copy.deepcopy(self.MENU).items():
+        for _, menu in self.MENU.items():
+            _id = str(menu_index)
             subnav = []
-
-            menu["kwargs"]["_id"] = str(menu_index)
-            menu["kwargs"]["active"] = False
-            if "visible" in menu["kwargs"]:
-                menu["kwargs"]["visible"] = self._test_visibility(menu["kwargs"]["visible"])
-
             for s in menu["subnav"]:
-                if s["title"]:
-                    s["title"] = self._get_title(s["title"])
-
-                if s["endpoint"] == request.endpoint:
-                    s["active"] = True
-                    menu["kwargs"]["active"] = True
-                s["visible"] = self._test_visibility(s["visible"])
                 menu_index += 1
-                s["_id"] = str(menu_index)
-                subnav.append(s)
-
-            _kwargs = menu["kwargs"]
+                props = dict(s, _id=str(menu_index))
+                subnav.append(_NavItem(props=props,
+                                       title=s["title"],
+                                       visible=s["visible"],
+                                       subnav=None))
 
             if menu["title"]:
-                _kwargs.update({
-                    "subnav": self._sort(subnav),
-                    "order": menu["order"],
-                    "title": self._get_title(menu["title"])
-                })
-                menu_list.append(_kwargs)
+                props = dict(menu["kwargs"], _id=_id, order=menu["order"])
+                menu_list.append(_NavItem(props=props,
+                                          title=menu["title"],
+                                          visible=props.get("visible"),
+                                          subnav=tuple(self._sort(subnav))))
             else:
                 menu_list += subnav
             menu_index += 1
 
-        return self._sort(menu_list)
+        self._compiled = tuple(self._sort(menu_list))
+        return self._compiled
+
+    def render(self):
+        """ Render the menu into a sorted by order multi dict """
+        menu = self._compiled
+        if menu is None:
+            menu = self.compile()
+        results = {}
+        return [self._render_item(item, request.endpoint, results) for item in menu]
+
+    def _render_item(self, item, endpoint, results):
+        """
+        Apply the request data on a compiled menu item
+        :param item: _NavItem
+        :param endpoint: the current endpoint
+        :param results: dict of the visibility callbacks results
+        :return: dict
+        """
+        props = dict(item.props)
+        if item.title:
+            props["title"] = self._get_title(item.title)
+        if "visible" in props:
+            props["visible"] = self._test_visibility(item.visible, results)
+
+        if item.subnav is None:
+            props["active"] = props["endpoint"] == endpoint
+        else:
+            subnav = [self._render_item(s, endpoint, results) for s in item.subnav]
+            props["subnav"] = subnav
+            props["active"] = any(s["active"] for s in subnav)
+        return props
 
     def _sort(self, items):
         """ Reorder the nav by key order """
-        return sorted(items, key=lambda s: s["order"])
+        return sorted(items, key=lambda s: s.props["order"])
 
     def init_app(self, app):
 
@@ -482,9 +998,9 @@ class SiteNavigation(object):
 
         @app.before_request
         def p(*args, **kwargs):
-            """ Will always run the menu """
+            """ The menu is rendered when it's first read """
             if request.endpoint not in ["static", None]:
-                setattr(g, "__SITENAV__", nav.render())
+                setattr(g, "__SITENAV__", _LazySiteNav(self))
 
 
 nav = SiteNavigation()
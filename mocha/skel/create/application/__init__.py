@@ -160,6 +160,13 @@ AVAILABLE_APPS = {
             "reset_password_token_ttl": 60,  # in minutes
             "reset_password_email_template": "reset-password.txt",
 
+            # USER CACHE
+            # To cache the logged in user, so requests don't query it every time
+            # None: disabled | "local": per process cache | "cache": mocha.cache
+            "user_cache": None,
+            "user_cache_ttl": 60,  # in seconds
+            "user_cache_size": 1000,  # max users, for the "local" cache
+
             # VIEWS
             # Login view: to login/logout/signup/lost-password
             "login": {
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Tasks
+
+To run some work outside of the request, ie: sending mail
+
+    from mocha import async_task
+
+    @async_task(retries=3)
+    def resize_image(object_name):
+        ...
+
+    resize_image.delay("images/a.jpg")  # queued, returns right away
+    resize_image("images/a.jpg")  # runs now
+
+The backend is set with the config TASKS_BACKEND:
+    thread: in-process thread pool. (default)
+    local: runs the task right away, in the caller. For tests
+    sql: a table in the db, run by `mocha :worker`
+    redis://host:port/db: a redis list, run by `mocha :worker`
+
+The arguments are passed to the task as JSON, on all the backends, so a task
+never shares an object, ie: a db model, with the caller. See
+`tasks.can_enqueue`. `delay` takes the arguments of the task only.
+The tasks run within the app context.
+"""
+
+import six
+import json
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from . import utils, exceptions
+from .core import init_app, db
+
+__all__ = ["async_task", "tasks"]
+
+# Registered tasks: {name: (fn, retries, retry_delay)}
+_tasks = {}
+
+
+def async_task(name=None, retries=0, retry_delay=30):
+    """
+    Decorator to make a function a task, that can be queued with `$fn.delay()`
+    The function can still be called directly.
+
+    :param name: str - The task name. By default, module + function name
+    :param retries: int - Number of times to retry the task when it fails
+    :param retry_delay: int - Seconds to wait before a retry
+    :return:
+    """
+    def decorator(fn):
+        task_name = name or "%s.%s" % (fn.__module__, fn.__name__)
+        _tasks[task_name] = (fn, retries, retry_delay)
+
+        def delay(*args, **kwargs):
+            return tasks.enqueue(task_name, args, kwargs)
+
+        fn.task_name = task_name
+        fn.delay = delay
+        return fn
+    return decorator
+
+
+# ------------------------------------------------------------------------------
+# Backends
+#
+# A backend stores the jobs: {"id", "task", "args", "kwargs", "attempts"}
+#   enqueue(job): to add a job
+#   dequeue(timeout): to get the next job to run, or None after timeout
+#   done(job): when the job ran
+#   retry(job, delay): to run the job again after delay seconds
+#   fail(job, error): when the job failed on its last attempt
+# The args of the job are passed as JSON, see `_json_copy`
+
+
+def _json_copy(job):
+    """
+    Copy a job through JSON, like the sql and redis backends store it
+    :param job: dict
+    :return: dict
+    """
+    return json.loads(utils.to_json(job))
+
+
+class LocalBackend(object):
+    """
+    Runs the job right away, in the caller. Retries don't wait.
+    The jobs are kept in `done_jobs` and `failed_jobs`, for tests
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.done_jobs = []
+        self.failed_jobs = []
+
+    def enqueue(self, job):
+        self.queue.run_job(_json_copy(job))
+
+    def dequeue(self, timeout):
+        return None
+
+    def done(self, job):
+        self.done_jobs.append(job)
+
+    def retry(self, job, delay):
+        self.queue.run_job(job)
+
+    def fail(self, job, error):
+        self.failed_jobs.append(job)
+
+
+class ThreadBackend(object):
+    """
+    Runs the jobs in a thread pool of the app process.
+    The jobs are lost if the process stops
+    """
+
+    def __init__(self, queue, workers=4):
+        self.queue = queue
+        self.workers = workers
+        self.pool = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, job):
+        # The pool is created on first use, so it's created after the
+        # server forks its workers
+        if self.pool is None:
+            with self._lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(self.workers)
+        self.pool.apply_async(self.queue.run_job, (_json_copy(job),))
+
+    def dequeue(self, timeout):
+        raise exceptions.MochaError("TASKS_BACKEND 'thread' runs the tasks in "
+                                    "the app process. There is no worker")
+
+    def done(self, job):
+        pass
+
+    def retry(self, job, delay):
+        timer = threading.Timer(delay, self.enqueue, (job,))
+        timer.daemon = True
+        timer.start()
+
+    def fail(self, job, error):
+        pass
+
+
+class SQLBackend(object):
+    """
+    Stores the jobs in the table `mocha_task` of the db.
+    A job taken by a worker is hidden for TASKS_TIMEOUT seconds. If it's not
+    done by then, ie: the worker died, another worker takes it.
+    """
+    table_name = "mocha_task"
+    STATUS_PENDING = "pending"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, queue, timeout=300):
+        import sqlalchemy as sa
+        self.queue = queue
+        self.timeout = timeout
+        self.table = sa.Table(self.table_name, sa.MetaData(),
+                              sa.Column("id", sa.String(32), primary_key=True),
+                              sa.Column("task", sa.String(255)),
+                              sa.Column("data", sa.Text),
+                              sa.Column("status", sa.String(20), index=True),
+                              sa.Column("attempts", sa.Integer, default=0),
+                              sa.Column("run_at", sa.Float, index=True),
+                              sa.Column("error", sa.Text))
+        self._created = False
+
+    @property
+    def engine(self):
+        if not self._created:
+            self.table.create(db.engine, checkfirst=True)
+            self._created = True
+        return db.engine
+
+    def enqueue(self, job):
+        data = utils.to_json({"args": job["args"], "kwargs": job["kwargs"]})
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert().values(id=job["id"],
+                                                    task=job["task"],
+                                                    data=data,
+                                                    status=self.STATUS_PENDING,
+                                                    attempts=job["attempts"],
+                                                    run_at=time.time()))
+
+    def dequeue(self, timeout):
+        t = self.table
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            with self.engine.begin() as conn:
+                row = conn.execute(t.select()
+                                   .where(t.c.status == self.STATUS_PENDING)
+                                   .where(t.c.run_at <= now)
+                                   .order_by(t.c.run_at)
+                                   .limit(1)).fetchone()
+                if row is not None:
+                    # Taken only if no other worker changed run_at
+                    claimed = conn.execute(t.update()
+                                           .where(t.c.id == row.id)
+                                           .where(t.c.run_at == row.run_at)
+                                           .values(run_at=now + self.timeout))
+                    if claimed.rowcount == 1:
+                        data = json.loads(row.data)
+                        return {"id": row.id,
+                                "task": row.task,
+                                "args": data["args"],
+                                "kwargs": data["kwargs"],
+                                "attempts": row.attempts}
+                    continue
+            if now >= deadline:
+                return None
+            time.sleep(min(1, deadline - now))
+
+    def done(self, job):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete()
+                         .where(self.table.c.id == job["id"]))
+
+    def retry(self, job, delay):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.update()
+                         .where(self.table.c.id == job["id"])
+                         .values(attempts=job["attempts"],
+                                 run_at=time.time() + delay))
+
+    def fail(self, job, error):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.update()
+                         .where(self.table.c.id == job["id"])
+                         .values(status=self.STATUS_FAILED,
+                                 attempts=job["attempts"],
+                                 error=six.text_type(error)))
+
+
+class RedisBackend(object):
+    """
+    Stores the jobs in a redis list. The retries wait in a sorted set, until
+    a worker moves them back to the list.
+    A job taken by a worker is lost if the worker dies while running it.
+    """
+    queue_key = "mocha:tasks:queue"
+    delayed_key = "mocha:tasks:delayed"
+    failed_key = "mocha:tasks:failed"
+    failed_max_size = 1000
+
+    def __init__(self, queue, url):
+        import redis
+        self.queue = queue
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def enqueue(self, job):
+        self.redis.lpush(self.queue_key, utils.to_json(job))
+
+    def dequeue(self, timeout):
+        self._move_delayed()
+        item = self.redis.brpop(self.queue_key, timeout=max(1, int(timeout)))
+        if item:
+            return json.loads(item[1].decode("utf-8"))
+        return None
+
+    def _move_delayed(self):
+        items = self.redis.zrangebyscore(self.delayed_key, 0, time.time())
+        for item in items:
+            # Only the worker removing it moves it
+            if self.redis.zrem(self.delayed_key, item):
+                self.redis.lpush(self.queue_key, item)
+
+    def done(self, job):
+        pass
+
+    def retry(self, job, delay):
+        self.redis.execute_command("ZADD", self.delayed_key,
+                                   time.time() + delay, utils.to_json(job))
+
+    def fail(self, job, error):
+        job = dict(job, error=six.text_type(error))
+        pipe = self.redis.pipeline()
+        pipe.lpush(self.failed_key, utils.to_json(job))
+        pipe.ltrim(self.failed_key, 0, self.failed_max_size - 1)
+        pipe.execute()
+
+
+# ------------------------------------------------------------------------------
+
+class _TaskQueue(object):
+    """
+    config keys: TASKS_*
+    Queue the jobs in the backend set by TASKS_BACKEND, and run them
+    """
+    app = None
+    backend = None
+
+    def init_app(self, app):
+        self.app = app
+        name = app.config.get("TASKS_BACKEND") or "thread"
+        if name == "thread":
+            self.backend = ThreadBackend(self,
+                                         app.config.get("TASKS_WORKERS", 4))
+        elif name == "local":
+            self.backend = LocalBackend(self)
+        elif name == "sql":
+            self.backend = SQLBackend(self, app.config.get("TASKS_TIMEOUT", 300))
+        elif name.startswith("redis://") or name.startswith("rediss://"):
+            self.backend = RedisBackend(self, name)
+        else:
+            raise exceptions.MochaError("Invalid TASKS_BACKEND: '%s'" % name)
+
+    def enqueue(self, task, args=(), kwargs=None):
+        """
+        Queue a task
+        :param task: str - the task name
+        :param args: tuple
+        :param kwargs: dict
+        :return: str - the job id
+        """
+        if task not in _tasks:
+            raise exceptions.MochaError("Task '%s' is not registered" % task)
+        if not self.backend:
+            raise exceptions.MochaError("Tasks are not initialized")
+        job = {
+            "id": utils.guid(),
+            "task": task,
+            "args": list(args),
+            "kwargs": kwargs or {},
+            "attempts": 0
+        }
+        self.backend.enqueue(job)
+        return job["id"]
+
+    def can_enqueue(self, args=(), kwargs=None):
+        """
+        Check that the arguments of a task get to it unchanged. They are
+        passed as JSON, so ie: a datetime would become a string, and an object
+        would fail
+        :param args: tuple
+        :param kwargs: dict
+        :return: bool
+        """
+        data = {"args": list(args), "kwargs": kwargs or {}}
+        try:
+            return json.loads(utils.to_json(data)) == data
+        except (TypeError, ValueError):
+            return False
+
+    def run_job(self, job):
+        """
+        Run a job within the app context, then retry it or fail it if it
+        raises an error
+        :param job: dict
+        :return: bool - True if it ran
+        """
+        if job["task"] not in _tasks:
+            logging.error("Task '%s' is not registered" % job["task"])
+            self.backend.fail(job, "Task is not registered")
+            return False
+
+        fn, retries, retry_delay = _tasks[job["task"]]
+        try:
+            with self.app.app_context():
+                fn(*job["args"], **job["kwargs"])
+            self.backend.done(job)
+            return True
+        except Exception as e:
+            job["attempts"] += 1
+            if job["attempts"] <= retries:
+                logging.warning(u"Task '%s' failed, retry %s/%s in %ss: %s"
+                                % (job["task"], job["attempts"], retries,
+                                   retry_delay, six.text_type(e)))
+                self.backend.retry(job, retry_delay)
+            else:
+                logging.exception("Task '%s' failed" % job["task"])
+                self.backend.fail(job, e)
+            return False
+
+    def work(self, burst=False, timeout=5):
+        """
+        Run the jobs of the backend, for `mocha :worker`
+        :param burst: bool - To stop once there is no more job
+        :param timeout: int - Seconds to wait for a job before checking again
+        :return: int - the number of jobs run
+        """
+        count = 0
+        while True:
+            job = self.backend.dequeue(timeout)
+            if job:
+                self.run_job(job)
+                count += 1
+            elif burst:
+                return count
+
+tasks = _TaskQueue()
+init_app(tasks.init_app)
@@ -30,6 +30,9 @@ import urllib
 import hashlib
 import json
 import uuid
+import decimal
+import threading
+import collections
 from six import string_types
 from slugify import slugify
 from werkzeug.utils import import_string
@@ -47,6 +50,11 @@ from six.moves.urllib.parse import (urlparse,
                                     urlencode,
                                     unquote_plus as urllib_unquote_plus)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def is_email_valid(email):
     """
@@ -190,6 +198,90 @@ class dict_dot(dict):
             return default
 
 
+class LRUCache(object):
+    """
+    A thread safe, in process LRU cache, with an optional time to live.
+    It keeps the count of hits and misses.
+
+    cache = LRUCache(maxsize=1000, ttl=60)
+    cache.set("key", value)
+    cache.get("key")
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        """
+        :param maxsize: int - the max number of entries to keep
+        :param ttl: int - seconds before an entry expires. None never expires
+        """
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value of the key, or the default if missing or expired
+        :param key:
+        :param default:
+        :return: mixed
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Set the value of the key. The least recently used entries are evicted
+        once maxsize is reached
+        :param key:
+        :param value:
+        :param ttl: int - seconds. To override the default ttl
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Remove the key
+        :param key:
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all the entries
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Return the hits, misses and size of the cache
+        :return: dict
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
+
+
 def list_replace(subject_list, replacement, string):
     """
     To replace a list of items by a single replacement
@@ -329,25 +421,111 @@ def unsign_data(data, secret_key, salt=None, **kw):
 # ------------------------------------------------------------------------------
 
 
+# JSON
+#
+# One serializer for the whole app: `to_json`, `render.json`, `jsonify` and
+# the `tojson` filter. The backend is set with `set_json_serializer`, from the
+# config JSON_SERIALIZER. `orjson` is used when installed, otherwise the
+# stdlib `json`.
+#
+# Arrow, datetime, date, Decimal, UUID and SQLAlchemy models and rows are
+# serialized natively. Datetimes are in UTC, as '2017-01-02T03:04:05Z', naive
+# ones are taken as UTC.
+
+
+def _json_default(obj):
+    """
+    Convert the types json doesn't know
+    :param obj:
+    :return: a serializable object
+    """
+    if isinstance(obj, arrow.Arrow):
+        return obj.isoformat()
+    elif isinstance(obj, datetime.datetime):
+        if obj.tzinfo is not None:
+            obj = obj.replace(tzinfo=None) - obj.utcoffset()
+        return obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+    elif isinstance(obj, datetime.date):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, uuid.UUID):
+        return str(obj)
+    elif hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    elif hasattr(obj, "__table__"):
+        return {c.key: getattr(obj, c.key) for c in obj.__table__.columns}
+    elif hasattr(obj, "_asdict"):
+        return obj._asdict()
+    raise TypeError("Object of type '%s' is not JSON serializable"
+                    % type(obj).__name__)
+
+
+class _MochaJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return _json_default(obj)
+
+
+def _stdlib_json_dumps(obj, pretty=False, sort_keys=False):
+    return json.dumps(obj,
+                      default=_json_default,
+                      indent=2 if pretty else None,
+                      sort_keys=sort_keys,
+                      separators=(",", ": " if pretty else ":")) \
+        .encode("utf-8")
+
+
+def _orjson_dumps(obj, pretty=False, sort_keys=False):
+    # The datetimes go to _json_default, for the same format as json
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=_json_default, option=option)
+
+
+_json_serializers = {
+    "json": _stdlib_json_dumps,
+    "orjson": _orjson_dumps
+}
+_json_dumps = _orjson_dumps if orjson else _stdlib_json_dumps
+
+
+def set_json_serializer(name=None):
+    """
+    Set the backend of the JSON serializer
+    :param name: str - json | orjson | auto. `auto` or None picks the fastest
+            installed
+    """
+    global _json_dumps
+    if not name or name == "auto":
+        name = "orjson" if orjson else "json"
+    if name not in _json_serializers:
+        raise ValueError("Invalid JSON serializer: '%s'" % name)
+    if name == "orjson" and not orjson:
+        raise ImportError("JSON serializer 'orjson' is not installed")
+    _json_dumps = _json_serializers[name]
+
+
+def json_dumps(d, pretty=False, sort_keys=False):
+    """
+    Serialize data to JSON bytes, with the JSON serializer set
+    :param d: dict or list
+    :param pretty: bool - to indent by 2 spaces
+    :param sort_keys: bool
+    :return: bytes
+    """
+    return _json_dumps(d, pretty=pretty, sort_keys=sort_keys)
+
+
 def to_json(d):
     """
     Convert data to json. It formats datetime/arrow time
     :param d: dict or list
     :return: json data
     """
-    return json.dumps(d, cls=_MochaJSONEncoder)
-
-
-class _MochaJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, arrow.Arrow):
-            return obj.for_json()
-        elif isinstance(obj, datetime.datetime):
-            return obj.strftime('%Y-%m-%dT%H:%M:%SZ')
-        elif isinstance(obj, datetime.date):
-            return obj.strftime('%Y-%m-%d')
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
+    return _json_dumps(d).decode("utf-8")
 
 
 class InspectDecoratorCompatibilityError(Exception):
@@ -410,6 +588,36 @@ def get_decorators_list(method):
     return kls.parse()
 
 
+def get_wrapped_functions(method):
+    """
+    Return the method along with all the functions it wraps, by following
+    `__wrapped__` and the decorators closures.
+    Unlike `get_decorators_list`, it doesn't read the source files, so it also
+    works when only the .pyc are deployed
+    :param method: object
+    :return: List
+    """
+    functions = []
+    stack = [method]
+    while stack:
+        fn = stack.pop()
+        fn = getattr(fn, "__func__", fn)
+        if any(fn is f for f in functions):
+            continue
+        functions.append(fn)
+        wrapped = getattr(fn, "__wrapped__", None)
+        if wrapped is not None:
+            stack.append(wrapped)
+        for cell in getattr(fn, "__closure__", None) or []:
+            try:
+                inner = cell.cell_contents
+            except ValueError:  # empty cell
+                continue
+            if inspect.isfunction(inner) or inspect.ismethod(inner):
+                stack.append(inner)
+    return functions
+
+
 # ------------------------------------------------------------------------------
 
 # DEPRECATED
@@ -0,0 +1,5 @@
+"""
+A minimal application directory, to build Mocha apps in the tests:
+
+    app = Brew(__name__, app_directory="tests.mocha_app")
+"""
@@ -0,0 +1,18 @@
+"""
+Config of the test application
+"""
+
+import tempfile
+
+
+class Dev(object):
+    SECRET_KEY = "test"
+    CACHE_TYPE = "simple"
+    STORAGE_PROVIDER = "LOCAL"
+    STORAGE_CONTAINER = tempfile.mkdtemp()
+    STORAGE_KEY = None
+    STORAGE_SECRET = None
+    STORAGE_SERVER = False
+    MAIL_URL = None
+    RECAPTCHA_ENABLED = False
+    TASKS_BACKEND = "local"
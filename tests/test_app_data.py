@@ -0,0 +1,82 @@
+import pytest
+import sqlalchemy as sa
+from flask import Flask
+from mocha import db, cache
+
+pytestmark = pytest.mark.skipif(sa.__version__ >= "1.4",
+                                reason="Active-Alchemy needs SQLAlchemy < 1.4")
+
+
+@pytest.fixture(scope="module")
+def app_data():
+    app = Flask(__name__)
+    app.config["CACHE_TYPE"] = "simple"
+    cache.init_app(app)
+    if not db._IS_OK_:
+        db.connect__("sqlite://", app)
+    from mocha.contrib import app_data
+    db.create_all()
+    with app.app_context():
+        yield app_data
+
+
+def test_app_data_set_invalidates(app_data):
+    app_data.set("site", {"name": "Mocha", "theme": {"color": "red"}})
+    assert app_data.get("site", "theme.color") == "red"
+
+    with db.record_queries() as recorder:
+        assert app_data.get("site", "name") == "Mocha"
+    assert recorder.count == 0
+
+    app_data.set("site", {"name": "Latte"})
+    assert app_data.get("site", "name") == "Latte"
+    assert app_data.get("site", "theme.color") == "red"
+
+
+def test_app_data_version_bump(app_data, monkeypatch):
+    # The version is checked on each read
+    monkeypatch.setattr(app_data, "config", lambda key, default=None: 0)
+    # The simple cache stands for a cache shared by the workers
+    monkeypatch.setattr(app_data, "is_cache_shared", lambda: True)
+    app_data.set("worker", {"count": 1})
+    assert app_data.get("worker", "count") == 1
+    version_key = app_data._version_key(app_data.make_key("worker"))
+    version = cache.get(version_key)
+
+    # Changed by another worker: the db is updated and the version bumped
+    app_data.AppData.get_by_key("worker", True).update(value={"count": 2})
+    assert app_data.get("worker", "count") == 1
+    cache.set(version_key, "another-version", timeout=0)
+    assert app_data.get("worker", "count") == 2
+    assert version != "another-version"
+
+
+def test_app_data_returns_a_copy(app_data):
+    app_data.set("copy", {"items": [1, 2]})
+    data = app_data.get("copy")
+    data["items"].append(3)
+    data["other"] = True
+    assert app_data.get("copy") == {"items": [1, 2]}
+
+
+def test_app_data_local_cache_ttl(app_data, monkeypatch):
+    # A per process cache can't tell the other workers: the ttl bounds it
+    app_data.set("local", {"count": 1})
+    with db.record_queries() as recorder:
+        assert app_data.get("local", "count") == 1
+        assert app_data.get("local", "count") == 1
+    assert recorder.count == 1
+
+    # Changed by another worker
+    app_data.AppData.get_by_key("local", True).update(value={"count": 2})
+    assert app_data.get("local", "count") == 1
+    check_at = app_data._local_cache[app_data.make_key("local")][2]
+    monkeypatch.setattr(app_data.time, "time", lambda: check_at)
+    assert app_data.get("local", "count") == 2
+
+
+def test_app_data_node_copy(app_data):
+    app_data.set("node", {"theme": {"colors": ["red"]}})
+    app_data.get("node", "theme.colors").append("blue")
+    app_data.get("node", "theme")["font"] = "serif"
+    assert app_data.get("node") == {"theme": {"colors": ["red"]}}
@@ -0,0 +1,170 @@
+import six
+import pytest
+from flask import Flask
+from mocha import db, utils
+
+# mocha.contrib.auth uses Python 2 relative imports
+pytestmark = pytest.mark.skipif(six.PY3, reason="mocha.contrib.auth is Python 2 only")
+
+
+@pytest.fixture(scope="module")
+def models():
+    app = Flask(__name__)
+    db.connect__("sqlite://", app)
+    from mocha.contrib.auth import models
+    db.create_all()
+    for level, name in models.AuthUserRole.ROLES:
+        models.AuthUserRole.new(name=name, level=level)
+    return models
+
+
+def test_roles_map_reuse(models):
+    Role = models.AuthUserRole
+    admin = Role.get_by_name("admin")
+    Role.reset_roles_map()
+    with db.record_queries() as recorder:
+        assert Role.get_info(admin.id) == ("admin", 89)
+        assert Role.get_info(admin.id) == ("admin", 89)
+        Role.get_info(models.AuthUserRole.get_by_name("member").id)
+    # The map, then the get_by_name
+    assert recorder.count == 2
+
+
+def test_role_created_elsewhere(models):
+    Role = models.AuthUserRole
+    Role.get_roles_map()
+    # Inserted without Role.new, ie: by another process
+    db.session.execute(Role.__table__.insert().values(name="guest", level=5))
+    db.session.commit()
+    guest = Role.get_by_name("guest")
+    assert guest.id not in Role._roles_map
+    assert Role.get_info(guest.id) == ("guest", 5)
+
+
+def test_user_without_role(models):
+    Role = models.AuthUserRole
+    Role.get_roles_map()
+    user = models.AuthUser(role_id=None)
+    with db.record_queries() as recorder:
+        assert user.get_role_info() == (None, None)
+        assert user.has_any_roles("admin", "member") is False
+    assert recorder.count == 0
+    assert Role._roles_map is not None
+
+
+def test_role_update_delete_reset_map(models):
+    Role = models.AuthUserRole
+    role = Role.new(name="reviewer", level=15)
+    assert Role.get_info(role.id) == ("reviewer", 15)
+
+    role.update(name="critic", level=16)
+    assert Role._roles_map is None
+    assert Role.get_info(role.id) == ("critic", 16)
+
+    role.delete()
+    assert Role._roles_map is None
+    assert role.id not in Role.get_roles_map()
+
+
+def test_roles_map_ttl(models, monkeypatch):
+    Role = models.AuthUserRole
+    admin = Role.get_by_name("admin")
+    Role.reset_roles_map()
+    Role.get_roles_map()
+    # Changed by another process
+    db.session.execute(Role.__table__.update()
+                       .where(Role.__table__.c.id == admin.id)
+                       .values(level=88))
+    db.session.commit()
+    assert Role.get_info(admin.id) == ("admin", 89)
+
+    expire_at = Role._roles_map_expire_at
+    monkeypatch.setattr(models.time, "time", lambda: expire_at)
+    assert Role.get_info(admin.id) == ("admin", 88)
+    admin.update(level=89)
+
+
+def test_roles_map_shared_version(models, monkeypatch):
+    from mocha import cache
+    Role = models.AuthUserRole
+    app = Flask(__name__)
+    app.config["CACHE_TYPE"] = "simple"
+    cache.init_app(app)
+    # The simple cache stands for a cache shared by the workers
+    monkeypatch.setattr(models, "is_cache_shared", lambda: True)
+    with app.app_context():
+        admin = Role.get_by_name("admin")
+        Role.reset_roles_map()
+        Role.get_roles_map()
+        db.session.execute(Role.__table__.update()
+                           .where(Role.__table__.c.id == admin.id)
+                           .values(level=88))
+        db.session.commit()
+        assert Role.get_info(admin.id) == ("admin", 89)
+
+        # Another worker changed the roles
+        cache.set(Role._ROLES_MAP_VERSION_KEY, "other", timeout=0)
+        assert Role.get_info(admin.id) == ("admin", 88)
+        with db.record_queries() as recorder:
+            Role.get_info(admin.id)
+        assert recorder.count == 0
+        admin.update(level=89)
+        assert cache.get(Role._ROLES_MAP_VERSION_KEY) != "other"
+
+
+@pytest.fixture
+def auth(models, monkeypatch):
+    """ The auth package, with the "local" identity cache """
+    import mocha.contrib.auth as auth
+    monkeypatch.setattr(auth, "__options__",
+                        utils.dict_dot({"user_cache": "local"}))
+    monkeypatch.setattr(auth, "_user_cache_local", None)
+    monkeypatch.setattr(auth, "_user_cache_stats", {"hits": 0, "misses": 0})
+    return auth
+
+
+def is_cached(auth, user):
+    key = auth._user_cache_key(user.id)
+    return auth._get_user_cache_local().get(key) is not None
+
+
+def test_user_cache_hit(models, auth):
+    user = models.AuthUser.new(username="hit@example.com", password="secret")
+    assert auth._get_cached_user(user.id).id == user.id
+    assert auth.get_user_cache_stats() == {"hits": 0, "misses": 1}
+
+    # A new request: the session is empty, the snapshot is merged into it
+    db.session.expunge_all()
+    with db.record_queries() as recorder:
+        cached = auth._get_cached_user(user.id)
+        assert cached.username == "hit@example.com"
+        assert cached.role.name == "member"
+    assert recorder.count == 0
+    assert cached in db.session
+    assert auth.get_user_cache_stats() == {"hits": 1, "misses": 1}
+
+    # The merged user can be changed like a loaded one
+    cached.update(first_name="Cached")
+    db.session.expunge_all()
+    assert models.AuthUser.get(user.id).first_name == "Cached"
+
+
+def test_user_cache_invalidation(models, auth):
+    user = models.AuthUser.new(username="inv@example.com", password="secret")
+
+    auth._get_cached_user(user.id)
+    auth.UserModel(user).update_info(first_name="Updated")
+    assert not is_cached(auth, user)
+    assert auth._get_cached_user(user.id).first_name == "Updated"
+
+    auth.signals.user_login(lambda: user)
+    assert not is_cached(auth, user)
+
+    auth._get_cached_user(user.id)
+    user.reset_secret_key()
+    assert not is_cached(auth, user)
+
+    auth._get_cached_user(user.id)
+    user.delete(hard_delete=True)
+    assert not is_cached(auth, user)
+    assert auth.get_user_cache_stats()["hits"] == 0
@@ -0,0 +1,273 @@
+
+import pytest
+from werkzeug.routing import Map, Rule
+import mocha.core as core
+from mocha.exceptions import MochaError
+
+
+def create_app():
+    """ Build a Mocha app with all the views defined so far """
+    pytest.importorskip("pyjade.runtime")
+    return core.Brew(__name__, app_directory="tests.mocha_app")
+
+
+def test_endpoint_index_fragments():
+    url_map = Map([Rule("/a", endpoint="main.Index:index"),
+                   Rule("/b", endpoint="main.Index:hello_0"),
+                   Rule("/c", endpoint="main.Index:hello_1")])
+    index = core._EndpointIndex()
+    index.freeze(url_map)
+
+    assert index.frozen is True
+    assert index.resolve("main.Index:index") == "main.Index:index"
+    assert index.resolve("Index:index") == "main.Index:index"
+    assert index.resolve("Index:hello") == "main.Index:hello_0"
+    assert index.resolve("Index:hello_1") == "main.Index:hello_1"
+    assert index.resolve("hello") is None
+    assert index.ambiguous == {}
+
+
+def test_endpoint_index_ambiguous():
+    url_map = Map([Rule("/a", endpoint="main.Index:index"),
+                   Rule("/b", endpoint="api.Index:index")])
+    index = core._EndpointIndex()
+    index.freeze(url_map)
+
+    assert "Index:index" in index.ambiguous
+    with pytest.raises(MochaError):
+        index.resolve("Index:index")
+    assert index.resolve("api.Index:index") == "api.Index:index"
+
+
+def test_build_dispatch():
+    from mocha import render
+
+    class Dispatched(core.Mocha):
+        def before_request(self, name, **kwargs):
+            pass
+
+        def before_index(self, **kwargs):
+            pass
+
+        def index(self):
+            pass
+
+        def after_request(self, name, response):
+            return response
+
+    i = Dispatched()
+    dispatch = Dispatched._build_dispatch(i, "index", i.index)
+
+    assert dispatch.before_request == i.before_request
+    assert dispatch.before_view == i.before_index
+    assert dispatch.after_view is None
+    assert dispatch.after_request == i.after_request
+    assert dispatch.renderer is None
+    assert dispatch.template.endswith("/Dispatched/index.jade")
+    # The response is cached before it's turned into a 304
+    assert dispatch.extensions == (render._cache_response,
+                                   render._conditional_response)
+
+
+def test_render_template_of_caller():
+    from flask import Flask, request
+    from jinja2 import DictLoader
+
+    class Rendered(core.Mocha):
+        base_layout = "layout.html"
+
+        def index(self):
+            return self.render()
+
+        def helper(self):
+            return self.render()
+
+        def with_helper(self):
+            return self.helper()
+
+        def with_action(self):
+            return self.index()
+
+    app = Flask(__name__)
+    app.jinja_loader = DictLoader({"layout.html": "{{ __template__ }}"})
+    with app.test_request_context("/"):
+        request.view_args = {}
+        for name, action in [("index", "index"),
+                             ("with_helper", "helper"),
+                             ("with_action", "index")]:
+            response = Rendered.make_proxy_method(name)()
+            assert response.get_data(as_text=True) \
+                .endswith("/Rendered/%s.jade" % action)
+
+
+class SharedActions(object):
+    def shared(self):
+        return "shared"
+
+
+class InheritA(SharedActions, core.Mocha):
+    pass
+
+
+class InheritB(SharedActions, core.Mocha):
+    pass
+
+
+def test_endpoint_index_inherited_action():
+    app = create_app()
+    a = app.test_client().get("/inherit-a/shared/")
+    b = app.test_client().get("/inherit-b/shared/")
+    assert a.status_code == b.status_code == 200
+
+    index = core.Mocha._endpoints
+    assert index.resolve_action(InheritA().shared).endswith("InheritA:shared")
+    assert index.resolve_action(InheritB().shared).endswith("InheritB:shared")
+    # The function alone doesn't tell the view
+    assert index.resolve_action(SharedActions.shared) is None
+
+
+def test_build_two_apps():
+    app1 = create_app()
+    app2 = create_app()
+    assert app1 is not app2
+    assert core.Mocha._endpoints.frozen
+    with app2.test_request_context("/"):
+        response = core.redirect("InheritB:shared")
+        assert response.location.endswith("/inherit-b/shared/")
+
+
+def template_app(monkeypatch, tmpdir, **config):
+    """ A Flask app with a few templates on disk, set as the Mocha app """
+    from flask import Flask
+    import jinja2
+    templates = tmpdir.mkdir("templates")
+    templates.join("index.html").write("Hello {{ name }}")
+    templates.join("page.html").write("{% extends 'index.html' %}")
+    templates.join("broken.html").write("{% if %}")
+    templates.join("notes.txt").write("{% if %}")
+    app = Flask(__name__)
+    app.jinja_loader = jinja2.FileSystemLoader(str(templates))
+    app.config.update(config)
+    monkeypatch.setattr(core.Mocha, "_app", app)
+    return app
+
+
+def test_setup_bytecode_cache_filesystem(monkeypatch, tmpdir):
+    app = template_app(monkeypatch, tmpdir,
+                       TEMPLATE_BYTECODE_CACHE="filesystem",
+                       TEMPLATE_CACHE_DIR=str(tmpdir.join("cache")))
+    core.Mocha._setup_bytecode_cache()
+    cache = app.jinja_env.bytecode_cache
+    assert cache.directory == str(tmpdir.join("cache", "bytecode"))
+
+    app.jinja_env.get_template("index.html")
+    files = tmpdir.join("cache", "bytecode").listdir()
+    assert len(files) == 1
+
+    # The extensions loaded are part of the key
+    app.jinja_env.add_extension("jinja2.ext.do")
+    core.Mocha._setup_bytecode_cache()
+    assert app.jinja_env.bytecode_cache.pattern != cache.pattern
+
+
+def test_setup_bytecode_cache_config(monkeypatch, tmpdir):
+    app = template_app(monkeypatch, tmpdir)
+    core.Mocha._setup_bytecode_cache()
+    assert app.jinja_env.bytecode_cache is None
+
+    app.config["TEMPLATE_BYTECODE_CACHE"] = "filesystem"
+    with pytest.raises(MochaError):
+        core.Mocha._setup_bytecode_cache()
+
+    app.config["TEMPLATE_BYTECODE_CACHE"] = "redis://localhost"
+    with pytest.raises(MochaError):
+        core.Mocha._setup_bytecode_cache()
+
+
+def test_precompile_templates(monkeypatch, tmpdir):
+    app = template_app(monkeypatch, tmpdir)
+    results = core.Mocha.precompile_templates(workers=2, extensions=("html",))
+
+    assert sorted(name for name, _, _ in results) \
+        == ["broken.html", "index.html", "page.html"]
+    errors = dict((name, error) for name, _, error in results)
+    assert errors["index.html"] is None
+    assert errors["page.html"] is None
+    assert errors["broken.html"] is not None
+    assert app.jinja_env.get_template("page.html").render(name="a") == "Hello a"
+
+
+def test_stream_template_compress_html():
+    from flask import Flask, render_template
+    from jinja2 import DictLoader
+
+    app = Flask(__name__)
+    app.config["COMPRESS_HTML"] = True
+    app.jinja_env.add_extension("mocha.extras.htmlcompress.HTMLCompress")
+    app.jinja_loader = DictLoader({
+        "page.html": "<div>\n  {{ text }}\n</div>  <pre>{{ text }}</pre>"})
+    with app.test_request_context("/"):
+        response = core.Mocha._stream_template("page.html",
+                                               {"text": "a  \n  b"})
+        assert response.is_streamed
+        # Like render_template: the template is compressed, not the values
+        html = response.get_data(as_text=True)
+        assert html == render_template("page.html", text="a  \n  b")
+        assert html == "<div> a  \n  b </div> <pre>a  \n  b</pre>"
+
+
+def test_stream_template_context():
+    from flask import Flask, g, session
+    from flask.signals import before_render_template, template_rendered
+    from jinja2 import DictLoader
+
+    app = Flask(__name__)
+    app.secret_key = "secret"
+    app.jinja_loader = DictLoader({
+        "page.html": "{{ session['name'] }} {{ g.user }}"
+                     "{% for i in items %} {{ i }}{% endfor %}"})
+    events = []
+
+    def items():
+        for i in range(2):
+            events.append("item")
+            yield i
+
+    @app.route("/")
+    def index():
+        session["name"] = "mocha"
+        g.user = "user"
+        response = core.Mocha._stream_template("page.html",
+                                               {"items": items()})
+        events.append("returned")
+        return response
+
+    def on_before(sender, template, context):
+        events.append("before")
+
+    def on_rendered(sender, template, context):
+        events.append("rendered")
+
+    with before_render_template.connected_to(on_before, app), \
+            template_rendered.connected_to(on_rendered, app):
+        r = app.test_client().get("/")
+        assert r.get_data(as_text=True) == "mocha user 0 1"
+
+    assert events == ["returned", "before", "item", "item", "rendered"]
+
+
+def test_endpoint_index_scan(caplog):
+    url_map = Map([Rule("/a", endpoint="main.Index:hello_world"),
+                   Rule("/b", endpoint="main.Index:save", methods=["POST"])])
+    index = core._EndpointIndex()
+    index.freeze(url_map)
+
+    assert index.resolve("hello_wo") is None
+    assert index.scan(url_map, "hello_wo") == "main.Index:hello_world"
+    assert index.scan(url_map, "Index:sa") is None
+    assert index.scan(url_map, "Index:sa", ("GET", "POST")) == "main.Index:save"
+    assert caplog.text.count("is not indexed") == 3
+
+    # The url map is scanned once per fragment
+    assert index.scan(Map([]), "hello_wo") == "main.Index:hello_world"
+    assert caplog.text.count("is not indexed") == 3
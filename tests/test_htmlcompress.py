@@ -0,0 +1,64 @@
+
+from jinja2 import Environment
+from mocha.extras.htmlcompress import HTMLCompress, HTMLMinifier
+
+CORPUS = [
+    ("<div>\n  <p>Hello   World</p>\n</div>",
+     "<div> <p>Hello World</p> </div>"),
+    ("<ul>\n\t<li>a</li>\n\t<li>b</li>\n</ul>",
+     "<ul> <li>a</li> <li>b</li> </ul>"),
+    ("<pre>\n  keep   this\n</pre>\n\n<p>a  b</p>",
+     "<pre>\n  keep   this\n</pre> <p>a b</p>"),
+    ("<textarea>  x\n  y</textarea>  <br>  z",
+     "<textarea>  x\n  y</textarea> <br> z"),
+    ("<script>\nvar a = '<pre>';\n  if (a < b) {}\n</script>\n<p> x </p>",
+     "<script>\nvar a = '<pre>';\n  if (a < b) {}\n</script> <p> x </p>"),
+    ("<style>\n  a { color: red }\n</style>\n<b>  bold</b>",
+     "<style>\n  a { color: red }\n</style> <b> bold</b>"),
+    ("<pre>a <pre>  nested  </pre>  still</pre>  out",
+     "<pre>a <pre>  nested  </pre>  still</pre> out"),
+    ("<PRE>  upper  </PRE>  x", "<PRE>  upper  </PRE> x"),
+    ("<script>var s = '<script>';\n</script>\n\n<p>  x</p>",
+     "<script>var s = '<script>';\n</script> <p> x</p>"),
+    ("<textarea><textarea>  a</textarea>  <b>  b</b>",
+     "<textarea><textarea>  a</textarea> <b> b</b>"),
+    ("<style>/* <style> */  a {}</style>  <i>  i</i>",
+     "<style>/* <style> */  a {}</style> <i> i</i>"),
+    ("<p>a single space is kept</p>", "<p>a single space is kept</p>"),
+    ("", ""),
+]
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_minify_corpus():
+    for html, expected in CORPUS:
+        assert HTMLMinifier.minify(html) == expected
+
+
+def test_minify_stream_chunks():
+    for html, expected in CORPUS:
+        for size in (1, 2, 3, 5, 8):
+            stream = HTMLMinifier.minify_stream(_chunks(html, size))
+            assert "".join(stream) == expected
+
+
+def test_minify_same_as_extension():
+    env = Environment(extensions=[HTMLCompress])
+    for html, expected in CORPUS:
+        # The extension matches lowercase tags only, and tracks the tags
+        # inside of the raw text elements, so "<pre>" in a js string, or a
+        # nested "<style>", never gets closed
+        if "PRE" in html or "<script>" in html \
+                or html.count("<textarea>") > 1 or html.count("<style>") > 1:
+            continue
+        assert env.from_string(html).render() == HTMLMinifier.minify(html)
+
+
+def test_minify_generate():
+    env = Environment()
+    tpl = env.from_string("<ul>{% for i in items %}\n  <li>{{ i }}</li>{% endfor %}\n</ul>")
+    html = "".join(HTMLMinifier.minify_stream(tpl.generate(items=[1, 2])))
+    assert html == "<ul> <li>1</li> <li>2</li> </ul>"
@@ -0,0 +1,97 @@
+import os
+import time
+import pytest
+from jinja2 import Environment, DictLoader
+
+jade = pytest.importorskip("mocha.extras.jade")
+
+SOURCE = "div.box\n  p Hello {{ name }}\n"
+
+
+@pytest.fixture
+def conversions(tmpdir, monkeypatch):
+    """ Enable the cache in a temp dir, and count the jade conversions """
+    calls = []
+    process = jade.process
+
+    def counted(*args, **kwargs):
+        calls.append(args[0])
+        return process(*args, **kwargs)
+
+    monkeypatch.setattr(jade, "process", counted)
+    monkeypatch.setattr(jade, "_cache", None)
+    jade.set_cache_dir(str(tmpdir))
+    return calls
+
+
+def test_render_jade_template():
+    env = Environment(loader=DictLoader({"page.jade": SOURCE}),
+                      extensions=[jade.PyJadeExtension])
+    html = env.get_template("page.jade").render(name="Mocha")
+    assert '<div class="box">' in html
+    assert "<p>Hello Mocha</p>" in html
+
+
+def test_cache_hit_miss(conversions, tmpdir):
+    first = jade.convert(SOURCE)
+    assert len(conversions) == 1
+    assert len(tmpdir.listdir()) == 1
+
+    # Hit: read from the disk, not converted again
+    assert jade.convert(SOURCE) == first
+    assert len(conversions) == 1
+
+    # Miss: a changed source or options is a new entry
+    jade.convert(SOURCE + "p Bye\n")
+    jade.convert(SOURCE, pretty=True)
+    assert len(conversions) == 3
+    assert len(tmpdir.listdir()) == 3
+
+
+def test_cache_atomic_write(conversions, tmpdir, monkeypatch):
+    cache = jade._cache
+    key = cache.get_key(SOURCE, {})
+    cache.set(key, u"<p>caf\u00e9</p>")
+    assert cache.get(key) == u"<p>caf\u00e9</p>"
+    assert [f.basename for f in tmpdir.listdir()] == [key + ".jinja"]
+
+    # A failed write leaves neither a partial entry nor its temp file
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "rename", fail)
+    key2 = cache.get_key(SOURCE, {"pretty": True})
+    cache.set(key2, u"<p>partial</p>")
+    assert cache.get(key2) is None
+    assert [f.basename for f in tmpdir.listdir()] == [key + ".jinja"]
+
+
+def test_cache_prune(conversions, tmpdir):
+    cache = jade._cache
+    jade.convert(SOURCE)
+    jade.convert(SOURCE + "p Old\n")
+    stray = tmpdir.join(cache.tmp_prefix + "dead")
+    stray.write("partial")
+    other = tmpdir.join("README")
+    other.write("not an entry")
+
+    # The old entry, and the temp file, were not used for a day
+    old = time.time() - 86400
+    os.utime(cache.get_path(cache.get_key(SOURCE + "p Old\n", {})), (old, old))
+    os.utime(str(stray), (old, old))
+
+    assert cache.prune(3600) == 2
+    assert sorted(f.basename for f in tmpdir.listdir()) \
+        == sorted(["README", cache.get_key(SOURCE, {}) + ".jinja"])
+
+
+def test_cache_hit_marks_used(conversions, tmpdir):
+    cache = jade._cache
+    jade.convert(SOURCE)
+    path = cache.get_path(cache.get_key(SOURCE, {}))
+    old = time.time() - 86400
+    os.utime(path, (old, old))
+
+    jade.convert(SOURCE)
+    assert cache.prune(3600) == 0
+    assert os.path.exists(path)
@@ -0,0 +1,82 @@
+import markdown
+from flask import Flask
+from jinja2 import Environment
+from mocha.extras import md, jinja_helpers
+
+
+def test_pool_reuse():
+    pool = md.MarkdownPool(maxsize=1)
+    mkd = pool.acquire(md.TOC_EXTENSIONS)
+    assert isinstance(mkd, markdown.Markdown)
+    mkd.convert("[TOC]\n# Title")
+    assert "Title" in mkd.toc
+
+    # Released reset, then reused
+    pool.release(md.TOC_EXTENSIONS, mkd)
+    assert mkd.toc == ""
+    assert pool.acquire(md.TOC_EXTENSIONS) is mkd
+    # In use, or another extension set: a new instance
+    assert pool.acquire(md.TOC_EXTENSIONS) is not mkd
+    assert pool.acquire(md.IMAGES_EXTENSIONS) is not mkd
+
+    # No more than maxsize idle instances
+    pool.release(md.TOC_EXTENSIONS, mkd)
+    pool.release(md.TOC_EXTENSIONS, markdown.Markdown())
+    assert pool._pools[md.TOC_EXTENSIONS] == [mkd]
+
+
+def test_pool_convert():
+    pool = md.MarkdownPool()
+    assert pool.convert("# Title", md.CONVERT_EXTENSIONS) \
+        == '<h1 id="title">Title</h1>'
+    assert pool.convert("![a](a.png)", md.IMAGES_EXTENSIONS, "images") \
+        == ["a.png"]
+    # The instance used was returned to the pool
+    assert len(pool._pools[md.IMAGES_EXTENSIONS]) == 1
+
+
+def test_cache(monkeypatch):
+    calls = []
+    convert = md.pool.convert
+
+    def counted(text, extensions, attr=None):
+        calls.append(text)
+        return convert(text, extensions, attr)
+
+    monkeypatch.setattr(md.pool, "convert", counted)
+    monkeypatch.setattr(md, "_cache", None)
+    md.html("# Title")
+    md.html("# Title")
+    assert len(calls) == 2
+
+    md.set_cache_size(1)
+    html = md.html("# Title")
+    assert md.html("# Title") == html
+    assert "#title" in md.toc("# Title")
+    assert len(calls) == 4
+
+    # LRU: the html was evicted by the toc
+    md.html("# Title")
+    assert len(calls) == 5
+
+    md.set_cache_size(0)
+    assert md._cache is None
+
+
+def test_cache_size_config(monkeypatch):
+    monkeypatch.setattr(md, "_cache", None)
+    app = Flask(__name__)
+    app.config["MARKDOWN_CACHE_SIZE"] = 10
+    jinja_helpers.jinja_helpers(app)
+    assert md._cache.maxsize == 10
+
+    app.config["MARKDOWN_CACHE_SIZE"] = 0
+    jinja_helpers.jinja_helpers(app)
+    assert md._cache is None
+
+
+def test_markdown_tag():
+    env = Environment(extensions=[md.MarkdownTagExtension])
+    html = env.from_string("{% markdown %}\n*Hi*\n{% endmarkdown %}").render()
+    assert html == "<p><em>Hi</em></p>"
+    assert isinstance(env.markdowner, markdown.Markdown)
@@ -0,0 +1,327 @@
+
+import time
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool
+from mocha.extras.mocha_db import PoolMetrics
+
+
+def test_pool_metrics():
+    engine = sa.create_engine("sqlite://", poolclass=QueuePool)
+    metrics = PoolMetrics(wait_warning=0.000001)
+    slow = []
+    metrics.on_slow_checkout(lambda wait, pool: slow.append(wait))
+    metrics.instrument(engine)
+
+    for _ in range(3):
+        with engine.connect() as conn:
+            conn.execute(sa.text("select 1"))
+
+    stats = metrics.stats()
+    assert stats["checkouts"] == 3
+    assert sum(c for _, c in stats["wait_histogram"]) == 3
+    assert stats["wait_max"] >= stats["wait_avg"] > 0
+    assert stats["slow_checkouts"] == len(slow) == 3
+
+    engine.dispose()
+    with engine.connect() as conn:
+        conn.execute(sa.text("select 1"))
+    assert metrics.stats()["checkouts"] == 4
+
+
+def test_routing_session(tmpdir):
+    from sqlalchemy.ext.declarative import declarative_base
+    from mocha.extras.mocha_db import RoutingSession, ReplicaSet
+
+    Base = declarative_base()
+
+    class Item(Base):
+        __tablename__ = "item"
+        id = sa.Column(sa.Integer, primary_key=True)
+        name = sa.Column(sa.String(50))
+
+    primary_url = "sqlite:///%s" % tmpdir.join("primary.db")
+    replica_url = "sqlite:///%s" % tmpdir.join("replica.db")
+    for url, name in ((primary_url, "primary"), (replica_url, "replica")):
+        engine = sa.create_engine(url)
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(Item.__table__.insert().values(id=1, name=name))
+
+    class DB(object):
+        engine = sa.create_engine(primary_url)
+        replicas = ReplicaSet([replica_url], {})
+
+    session = RoutingSession(db=DB())
+    assert session.query(Item).filter(Item.id == 1).one().name == "replica"
+
+    session.add(Item(id=2, name="new"))
+    session.commit()
+    assert session.query(Item).filter(Item.id == 2).one().name == "new"
+    session.close()
+
+    DB.replicas.eject(DB.replicas.engines[0])
+    session = RoutingSession(db=DB())
+    assert session.query(Item).filter(Item.id == 1).one().name == "primary"
+
+
+def test_replica_check_once(monkeypatch):
+    from multiprocessing.pool import ThreadPool
+    from mocha.extras import mocha_db
+
+    replicas = mocha_db.ReplicaSet(["sqlite://"], {}, check_interval=0)
+    engine = replicas.engines[0]
+    replicas.eject(engine)
+    checks = []
+
+    class Thread(object):
+        def __init__(self, target):
+            self.target = target
+
+        def start(self):
+            checks.append(self.target)
+
+    def slow_time():
+        # So the readers all reach the check together
+        time.sleep(0.05)
+        return _time()
+
+    _time = time.time
+    monkeypatch.setattr(mocha_db, "threading",
+                        type("threading", (), {"Thread": Thread}))
+    monkeypatch.setattr(mocha_db, "time",
+                        type("time", (), {"time": staticmethod(slow_time)}))
+    pool = ThreadPool(8)
+    try:
+        assert pool.map(lambda _: replicas.get(), range(8)) == [None] * 8
+    finally:
+        pool.close()
+        pool.join()
+    assert len(checks) == 1
+
+    checks[0]()
+    assert not replicas._checking
+    assert replicas.get() is engine
+
+
+def test_query_recorder():
+    import pytest
+    from mocha.extras.mocha_db import MochaDB
+
+    db = MochaDB()
+    engine = sa.create_engine("sqlite://")
+    with engine.connect() as conn:
+        with db.record_queries() as recorder:
+            for i in range(3):
+                conn.execute(sa.text("select :i"), {"i": i})
+            conn.execute(sa.text("select :i"), {"i": 0})
+        conn.execute(sa.text("select 1"))
+
+        assert recorder.count == 4
+        assert recorder.duplicates() == [("select ?", 2)]
+        assert recorder.repeated(min_count=3) == [("select ?", 4)]
+        assert recorder.summary()["duplicates"] == 1
+
+        with db.assert_max_queries(1):
+            conn.execute(sa.text("select 1"))
+        with pytest.raises(AssertionError):
+            with db.assert_max_queries(1):
+                conn.execute(sa.text("select 1"))
+                conn.execute(sa.text("select 2"))
+
+
+def test_query_recorder_statement_raises():
+    import pytest
+    from mocha.extras.mocha_db import MochaDB
+
+    db = MochaDB()
+    engine = sa.create_engine("sqlite://")
+    with engine.connect() as conn:
+        with db.record_queries() as recorder:
+            with pytest.raises(sa.exc.OperationalError):
+                conn.execute(sa.text("select * from missing"))
+            conn.execute(sa.text("select 1"))
+        # Nothing is left on the pooled connection
+        assert "mocha_query_start" not in conn.connection.info
+    assert recorder.count == 1
+    assert recorder.queries[0][2] >= 0
+
+
+def test_storage_object_hydrate(tmpdir):
+    import flask
+    import flask_cloudy
+    from mocha.ext import cache
+    from mocha.extras.mocha_db import StorageObject
+
+    app = flask.Flask(__name__)
+    app.config["CACHE_TYPE"] = "simple"
+    cache.init_app(app)
+    storage = flask_cloudy.Storage(provider="LOCAL", container=str(tmpdir))
+
+    data = []
+    for i in range(3):
+        path = tmpdir.join("src-%s.txt" % i)
+        path.write("file %s" % i)
+        obj = storage.upload(str(path), name="file-%s.txt" % i)
+        data.append({"name": obj.name, "hash": obj.hash, "size": obj.size})
+
+    calls = []
+    get = storage.get
+
+    def counted_get(name):
+        calls.append(name)
+        return get(name)
+    storage.get = counted_get
+
+    with app.app_context():
+        objects = [StorageObject(dict(d)) for d in data]
+        # With another storage, nothing is memoized
+        StorageObject.hydrate(objects, storage=storage, workers=2)
+        assert sorted(calls) == ["file-0.txt", "file-1.txt", "file-2.txt"]
+        assert all(o._storage_loaded for o in objects)
+        assert objects[1].extension == "txt"
+
+        import mocha.ext
+        mocha.ext.storage, default_storage = storage, mocha.ext.storage
+        try:
+            del calls[:]
+            objects = [StorageObject(dict(d)) for d in data]
+            StorageObject.hydrate(objects)
+            assert len(calls) == 3
+
+            # Memoized by name and hash
+            del calls[:]
+            objects = [StorageObject(dict(d)) for d in data]
+            StorageObject.hydrate(objects)
+            assert calls == []
+            assert not objects[0]._storage_loaded
+            assert objects[0].extension == "txt"
+            assert isinstance(objects[0].meta_data, dict)
+            assert calls == []
+        finally:
+            mocha.ext.storage = default_storage
+
+
+def test_keyset_paginator():
+    import datetime
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.ext.declarative import declarative_base
+    from mocha.extras.mocha_db import KeysetPaginator
+
+    Base = declarative_base()
+
+    class Post(Base):
+        __tablename__ = "post"
+        id = sa.Column(sa.Integer, primary_key=True)
+        created_at = sa.Column(sa.DateTime, index=True)
+
+    engine = sa.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    start = datetime.datetime(2020, 1, 1)
+    # Two posts per date, to sort by the primary key on ties
+    session.add_all([Post(id=i, created_at=start + datetime.timedelta(days=i // 2))
+                     for i in range(1, 12)])
+    session.commit()
+
+    def get_page(page=None):
+        return KeysetPaginator(session.query(Post),
+                               order_by=[Post.created_at.desc()],
+                               page=page,
+                               per_page=4)
+
+    expected = sorted(range(1, 12), key=lambda i: (i // 2, i), reverse=True)
+    pages = []
+    page = get_page()
+    assert not page.has_prev
+    while True:
+        pages.append([p.id for p in page])
+        if not page.has_next:
+            break
+        page = get_page(page.next_page_number)
+    assert [i for ids in pages for i in ids] == expected
+    assert [len(ids) for ids in pages] == [4, 4, 3]
+
+    # Back from the last page
+    page = get_page(page.prev_page_number)
+    assert [p.id for p in page] == pages[1]
+    page = get_page(page.prev_page_number)
+    assert [p.id for p in page] == pages[0]
+    assert not page.has_prev and page.has_next
+
+    # An invalid cursor is the first page
+    assert [p.id for p in get_page("not-a-cursor")] == pages[0]
+    assert list(get_page().iter_pages()) == []
+
+    # The offset options of paginate
+    import flask
+    import pytest
+    from mocha import ext
+    from mocha.exceptions import MochaError
+    with flask.Flask(__name__).test_request_context("/"):
+        page = ext.paginate(session.query(Post), mode="keyset",
+                            order_by=[Post.created_at.desc()],
+                            per_page=4, padding=2, static_query=False)
+        assert [p.id for p in page] == pages[0]
+        with pytest.raises(MochaError):
+            ext.paginate(session.query(Post), mode="keyset",
+                         static_query=True)
+
+
+def create_recorded_app(monkeypatch):
+    """ An app with the query recorder of mocha.ext, and a sqlite engine """
+    import flask
+    from mocha import ext
+
+    monkeypatch.setattr(ext.db, "_IS_OK_", True)
+    app = flask.Flask(__name__)
+    app.debug = True
+    app.config.update(DB_RECORD_QUERIES=True, DB_QUERIES_WARNING_COUNT=2)
+    ext._query_recorder(app)
+    engine = sa.create_engine("sqlite://")
+
+    def query(n):
+        with engine.connect() as conn:
+            for i in range(n):
+                conn.execute(sa.text("select :i"), {"i": i})
+    return app, query
+
+
+def test_query_recorder_streamed(monkeypatch, caplog):
+    import flask
+    app, query = create_recorded_app(monkeypatch)
+
+    @app.route("/")
+    def index():
+        query(1)
+        return "ok"
+
+    @app.route("/stream")
+    def stream():
+        def generate():
+            query(3)
+            yield "ok"
+        return flask.Response(flask.stream_with_context(generate()))
+
+    client = app.test_client()
+    r = client.get("/")
+    assert r.headers["X-DB-Queries"].startswith("count=1;")
+
+    r = client.get("/stream")
+    assert "X-DB-Queries" not in r.headers
+    assert r.data == b"ok"
+    assert "GET /stream: 3 queries" in caplog.text
+
+
+def test_query_recorder_view_raises(monkeypatch):
+    from mocha.extras import mocha_db
+    app, query = create_recorded_app(monkeypatch)
+    app.debug = False
+
+    @app.route("/error")
+    def error():
+        query(1)
+        raise ValueError("error")
+
+    r = app.test_client().get("/error")
+    assert r.status_code == 500
+    assert not getattr(mocha_db._recorders, "stack", None)
@@ -0,0 +1,261 @@
+
+from flask import Flask
+from mocha import render, cache
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config["CACHE_TYPE"] = "simple"
+    cache.init_app(app)
+    calls = []
+
+    @app.route("/post/<int:id>")
+    @render.cached(timeout=60, query_args=["page"], tags=["post:{id}"])
+    def post(id):
+        calls.append(id)
+        return "post %s, %s" % (id, len(calls))
+
+    app.after_request(render._cache_response)
+    return app, calls
+
+
+def test_cached_response():
+    app, calls = create_app()
+    client = app.test_client()
+
+    r1 = client.get("/post/1?page=1&other=x")
+    r2 = client.get("/post/1?page=1&other=y")
+    assert r1.data == r2.data
+    assert len(calls) == 1
+    assert r2.headers["ETag"] == r1.headers["ETag"]
+    assert "max-age" in r2.headers["Cache-Control"]
+
+    client.get("/post/1?page=2")
+    assert len(calls) == 2
+
+    r3 = client.get("/post/1?page=1",
+                    headers={"If-None-Match": r1.headers["ETag"]})
+    assert r3.status_code == 304
+    assert len(calls) == 2
+
+
+def test_cached_invalidate():
+    app, calls = create_app()
+    client = app.test_client()
+
+    client.get("/post/1")
+    client.get("/post/2")
+    with app.app_context():
+        render.invalidate_cached("post:1")
+    client.get("/post/1")
+    client.get("/post/2")
+    assert calls == [1, 2, 1]
+
+
+def test_cached_per_user():
+    import flask_login
+
+    class User(flask_login.UserMixin):
+        def __init__(self, id):
+            self.id = id
+
+    app, calls = create_app()
+    login_manager = flask_login.LoginManager(app)
+
+    @login_manager.request_loader
+    def load_user(request):
+        id = request.headers.get("X-User")
+        return User(id) if id else None
+
+    @app.route("/me")
+    @render.cached(timeout=60)
+    def me():
+        calls.append(flask_login.current_user.is_authenticated)
+        return "me %s" % flask_login.current_user.get_id()
+
+    @app.route("/shared")
+    @render.cached(timeout=60, vary=lambda: None)
+    def shared():
+        calls.append("shared")
+        return "shared %s" % flask_login.current_user.get_id()
+
+    client = app.test_client()
+    assert client.get("/me", headers={"X-User": "1"}).data == b"me 1"
+    assert client.get("/me", headers={"X-User": "2"}).data == b"me 2"
+    assert client.get("/me", headers={"X-User": "1"}).data == b"me 1"
+    assert client.get("/me").data == b"me None"
+    assert client.get("/me").data == b"me None"
+    assert calls == [True, True, False]
+
+    # With vary, the users share the page
+    assert client.get("/shared", headers={"X-User": "1"}).data \
+        == client.get("/shared", headers={"X-User": "2"}).data
+    assert calls.count("shared") == 1
+
+
+def test_cached_csrf_token():
+    from flask import render_template_string
+    from mocha import ext
+
+    app, calls = create_app()
+    app.secret_key = "secret"
+    ext._SeaSurf(app)
+
+    @app.route("/form")
+    @render.cached(timeout=60)
+    def form():
+        calls.append("form")
+        return render_template_string("<input value='{{ csrf_token() }}'>")
+
+    @app.route("/page")
+    @render.cached(timeout=60)
+    def page():
+        calls.append("page")
+        return "page"
+
+    # The first request of a client sets the token in the session, so it's
+    # not cached
+    forms = []
+    for _ in range(2):
+        client = app.test_client()
+        client.get("/page")
+        forms.append(client.get("/form").data)
+    assert calls.count("page") == 2
+
+    # Each client gets its own token: the form is never cached
+    assert forms[0] != forms[1]
+    assert calls.count("form") == 2
+
+    # A page without the token is cached
+    client.get("/page")
+    client.get("/page")
+    assert calls.count("page") == 3
+
+
+def create_conditional_app():
+    app = Flask(__name__)
+    calls = []
+
+    @app.route("/api/<int:id>")
+    @render.json
+    def api(id):
+        calls.append(id)
+        return {"id": id, "_etag": "v%s" % id}
+
+    app.after_request(render._conditional_response)
+    return app, calls
+
+
+def test_conditional_response():
+    app, calls = create_conditional_app()
+    client = app.test_client()
+
+    r1 = client.get("/api/1")
+    assert r1.status_code == 200
+    assert r1.headers["ETag"] == '"v1"'
+    assert b"_etag" not in r1.data
+
+    r2 = client.get("/api/1", headers={"If-None-Match": '"v1"'})
+    assert r2.status_code == 304
+    assert r2.data == b""
+
+    r3 = client.get("/api/2", headers={"If-None-Match": '"v1"'})
+    assert r3.status_code == 200
+
+
+def test_jsonify_config():
+    import datetime
+    import flask
+    app = Flask(__name__)
+    app.config.update(JSONIFY_PRETTYPRINT_REGULAR=False,
+                      JSONIFY_MIMETYPE="application/vnd.api+json")
+    data = {"at": datetime.datetime(2017, 1, 2, 3, 4, 5)}
+
+    with app.test_request_context("/"):
+        r = render.jsonify(data)
+        assert r.mimetype == "application/vnd.api+json"
+        assert r.data == b'{"at":"2017-01-02T03:04:05Z"}'
+
+        app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+        assert render.jsonify(data).data \
+            == b'{\n  "at": "2017-01-02T03:04:05Z"\n}'
+
+        # flask.json.dumps, and the tojson filter, use the same serializer
+        assert flask.json.dumps(data) == '{"at":"2017-01-02T03:04:05Z"}'
+        html = flask.render_template_string("{{ data|tojson }}", data=data)
+        assert html == '{"at":"2017-01-02T03:04:05Z"}'
+
+
+def test_json_stream():
+    import json
+    app = Flask(__name__)
+
+    @app.route("/export")
+    @render.json_stream
+    def export():
+        return ({"id": i} for i in range(3000))
+
+    @app.route("/export.ndjson")
+    @render.ndjson_stream
+    def export_ndjson():
+        return ({"id": i} for i in range(3))
+
+    client = app.test_client()
+    r = client.get("/export")
+    assert r.is_streamed
+    assert r.mimetype == "application/json"
+    assert json.loads(r.data.decode("utf-8")) == [{"id": i}
+                                                   for i in range(3000)]
+
+    r = client.get("/export.ndjson")
+    assert r.data == b'{"id":0}\n{"id":1}\n{"id":2}\n'
+
+
+def test_site_navigation():
+    nav = render.SiteNavigation()
+    title_calls = []
+
+    def docs_title():
+        title_calls.append(1)
+        return "Docs"
+
+    @nav(docs_title, order=1)
+    class NavDocs(object):
+        @nav("Intro", order=2)
+        def intro(self):
+            pass
+
+        @nav("Hidden", order=1, visible=lambda: False)
+        def hidden(self):
+            pass
+
+    compiled = nav.compile()
+    assert nav.compile() == compiled
+
+    app = Flask(__name__)
+    app.add_url_rule("/intro", endpoint="test_render.NavDocs:intro",
+                     view_func=lambda: "")
+    with app.test_request_context("/intro"):
+        menu = render._LazySiteNav(nav)
+        assert title_calls == []
+        docs = [m for m in menu if m["title"] == "Docs"][0]
+        assert len(menu) == 1
+        assert title_calls == [1]
+
+        assert docs["active"] is True
+        assert [s["title"] for s in docs["subnav"]] == ["Hidden", "Intro"]
+        hidden, intro = docs["subnav"]
+        assert intro["active"] is True and intro["visible"] is True
+        assert hidden["active"] is False and hidden["visible"] is False
+
+    with app.test_request_context("/"):
+        docs = render._LazySiteNav(nav)[0]
+        assert docs["active"] is False
+        assert not any(s["active"] for s in docs["subnav"])
+
+    # A new item compiles the menu again
+    @nav("More")
+    def more():
+        pass
+    assert nav._compiled is None
+    assert len(nav.compile()) == 2
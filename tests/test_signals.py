@@ -0,0 +1,72 @@
+
+import time
+import inspect
+import blinker
+from mocha import decorators
+from mocha.decorators import emit_signal
+
+
+def test_emit_signal():
+    namespace = blinker.Namespace()
+
+    @emit_signal(namespace=namespace)
+    def add(a, b=2, **kwargs):
+        return a + b
+
+    assert add(1) == 3
+
+    received = []
+
+    @add.observe
+    def on_add(result, **kw):
+        received.append((result, kw["kwargs"], kw["sender"]))
+
+    assert add(1, b=3, c=4) == 4
+    assert received == [(4, {"a": 1, "b": 3, "c": 4, "kwargs": {"c": 4}},
+                         "add")]
+
+
+def test_emit_signal_no_receivers(monkeypatch):
+    namespace = blinker.Namespace()
+
+    @emit_signal(namespace=namespace)
+    def add(a, b=2):
+        return a + b
+
+    # Without receivers, the arguments are not bound
+    calls = []
+    getcallargs = inspect.getcallargs
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return getcallargs(*args, **kwargs)
+
+    monkeypatch.setattr(decorators.inspect, "getcallargs", counted)
+    assert add(1) == 3
+    assert calls == []
+
+    # Bound once, for both pre and post
+    add.pre.connect(lambda *a, **kw: None, weak=False)
+    add.observe(lambda result, **kw: None, weak=False)
+    assert add(1) == 3
+    assert len(calls) == 1
+
+
+def test_emit_signal_background():
+    namespace = blinker.Namespace()
+    received = []
+
+    @emit_signal(namespace=namespace, background=True)
+    def hello(name):
+        return "hello %s" % name
+
+    @hello.observe
+    def on_hello(result, **kw):
+        received.append(result)
+
+    assert hello("mocha") == "hello mocha"
+    for _ in range(100):
+        if received:
+            break
+        time.sleep(0.01)
+    assert received == ["hello mocha"]
@@ -0,0 +1,164 @@
+
+import time
+from flask import Flask
+from mocha import tasks as t
+
+
+def create_queue(backend):
+    app = Flask(__name__)
+    app.config["TASKS_BACKEND"] = backend
+    queue = t._TaskQueue()
+    queue.init_app(app)
+    return queue
+
+
+def test_async_task():
+    @t.async_task(name="tests.add")
+    def add(a, b):
+        return a + b
+
+    assert add.task_name == "tests.add"
+    assert add(1, 2) == 3
+    assert t._tasks["tests.add"] == (add, 0, 30)
+
+
+def test_local_backend_retries():
+    calls = []
+
+    @t.async_task(name="tests.flaky", retries=2)
+    def flaky(x):
+        calls.append(x)
+        if len(calls) < 3:
+            raise ValueError("flaky")
+
+    queue = create_queue("local")
+    queue.enqueue("tests.flaky", ("a",))
+    assert calls == ["a", "a", "a"]
+    assert len(queue.backend.done_jobs) == 1
+    assert queue.backend.failed_jobs == []
+
+
+    @t.async_task(name="tests.fail", retries=1)
+    def fail():
+        raise ValueError("fail")
+
+    queue.enqueue("tests.fail")
+    assert queue.backend.failed_jobs[0]["attempts"] == 2
+
+
+def test_thread_backend():
+    done = []
+
+    @t.async_task(name="tests.append")
+    def append(x):
+        done.append(x)
+
+    queue = create_queue("thread")
+    queue.enqueue("tests.append", (1,))
+    for _ in range(100):
+        if done:
+            break
+        time.sleep(0.01)
+    assert done == [1]
+
+
+def test_can_enqueue():
+    import datetime
+    now = datetime.datetime(2017, 1, 2)
+
+    # The args are passed as JSON on all the backends
+    for backend in ("local", "thread", "sql"):
+        queue = create_queue(backend)
+        assert queue.can_enqueue(("a", 1), {"b": [1, {"c": None}]})
+        assert not queue.can_enqueue((now,))
+        assert not queue.can_enqueue((), {"obj": object()})
+
+
+def test_local_backend_json_args():
+    received = []
+
+    @t.async_task(name="tests.received")
+    def receive(items):
+        received.append(items)
+
+    items = [1, 2]
+    create_queue("local").enqueue("tests.received", (items,))
+    assert received == [items]
+    assert received[0] is not items
+
+
+def test_sql_backend_unicode_error(monkeypatch):
+    import sqlalchemy as sa
+
+    class DB(object):
+        engine = sa.create_engine("sqlite://")
+
+    monkeypatch.setattr(t, "db", DB)
+    queue = create_queue("sql")
+    queue.app = Flask(__name__)
+
+    @t.async_task(name="tests.unicode_error", retries=1, retry_delay=0)
+    def unicode_error():
+        raise ValueError(u"caf\u00e9")
+
+    queue.enqueue("tests.unicode_error")
+    # Retried, then failed
+    for _ in range(2):
+        assert queue.run_job(queue.backend.dequeue(0)) is False
+    table = queue.backend.table
+    with DB.engine.begin() as conn:
+        row = conn.execute(table.select()).fetchone()
+    assert row.status == queue.backend.STATUS_FAILED
+    assert row.error == u"caf\u00e9"
+
+
+def test_send_mail_async(monkeypatch):
+    import datetime
+    from mocha import ext, core
+
+    class User(object):
+        name = "Mocha"
+
+    app = Flask(__name__)
+    app.config.update(MAIL_ASYNC=True,
+                      MAIL_URL="smtp://localhost:25",
+                      MAIL_SENDER="app@example.com",
+                      MAIL_TEMPLATE={
+                          "async-welcome.txt":
+                              "{% block subject %}Hi {{ user.name }}"
+                              "{% endblock %}"
+                              "{% block body %}Welcome {{ user.name }}"
+                              "{% endblock %}"})
+    monkeypatch.setattr(core.Mocha, "_app", app)
+    queue = create_queue("local")
+    queue.app = app
+    monkeypatch.setattr(t.tasks, "app", app)
+    monkeypatch.setattr(t.tasks, "backend", queue.backend)
+    mailer = ext._Mailer()
+    mailer.init_app(app)
+    monkeypatch.setattr(ext, "mail", mailer)
+    sent = []
+    monkeypatch.setattr(mailer.mail, "send", sent.append)
+
+    # Rendered now: the task only gets the mail, not the user object
+    job_id = ext.send_mail("async-welcome.txt", "a@b.com", user=User(),
+                           cc=["c@d.com"], reply_to="r@example.com")
+    assert len(job_id) == 32
+    job = queue.backend.done_jobs[0]
+    assert job["args"][0] == "a@b.com"
+    assert job["args"][1]["subject"] == "Hi Mocha"
+    assert "user" not in job["args"][1]
+    message = sent[0]
+    assert message.subject == "Hi Mocha"
+    assert message.body == "Welcome Mocha"
+    assert message.recipients == ["a@b.com"]
+    assert message.cc == ["c@d.com"]
+    assert message.reply_to == "r@example.com"
+
+    # Not JSON serializable: sent now
+    del sent[:]
+    now = datetime.datetime(2017, 1, 2)
+    assert ext.send_mail("async-welcome.txt", "a@b.com", user=User(),
+                         date=now) is None
+    assert sent[0].date is now
+    assert len(queue.backend.done_jobs) == 1
@@ -70,6 +70,31 @@ def test_get_decorators_list():
     assert "deco2" in decos
 
 
+def test_get_wrapped_functions():
+
+    def marker(func):
+        func._marked = True
+        return func
+
+    def deco(func):
+        def decorated_view(*args, **kwargs):
+            return func(*args, **kwargs)
+        return decorated_view
+
+    class Hi(object):
+
+        @deco
+        @marker
+        def hello(self):
+            return True
+
+    k_hi = Hi()
+    functions = utils.get_wrapped_functions(k_hi.hello)
+    assert isinstance(functions, list)
+    assert len(functions) == 2
+    assert any(getattr(f, "_marked", False) for f in functions)
+
+
 def test_dict_dot():
     d = {
         "name": "Mardix",
@@ -136,3 +161,56 @@ def test_dict_replace():
     subject = {"Patriots": "Panthers", "champions": "winners"}
     assert "Panthers" in utils.dict_replace(subject, string)
     assert "winners" in utils.dict_replace(subject, string)
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    cache.delete("c")
+    assert cache.get("c", "x") == "x"
+    cache.set("d", 4, ttl=-1)
+    assert cache.get("d") is None
+    assert cache.stats() == {"hits": 3, "misses": 3, "size": 1}
+
+
+def test_to_json():
+    import json
+    import arrow
+    import decimal
+    import datetime
+    data = {
+        "arrow": arrow.get("2017-01-02T03:04:05+00:00"),
+        "datetime": datetime.datetime(2017, 1, 2, 3, 4, 5),
+        "date": datetime.date(2017, 1, 2),
+        "decimal": decimal.Decimal("1.5")
+    }
+    assert isinstance(utils.json_dumps(data), bytes)
+    assert json.loads(utils.to_json(data)) == {
+        "arrow": "2017-01-02T03:04:05+00:00",
+        "datetime": "2017-01-02T03:04:05Z",
+        "date": "2017-01-02",
+        "decimal": 1.5
+    }
+
+
+def test_json_serializers():
+    import datetime
+    import dateutil.tz
+    data = {"b": datetime.datetime(2017, 1, 2, 3, 4, 5, 6),
+            "a": datetime.datetime(2017, 1, 2, 5, 4, 5,
+                                   tzinfo=dateutil.tz.tzoffset(None, 7200))}
+    names = ["json"] + (["orjson"] if utils.orjson else [])
+    try:
+        for name in names:
+            utils.set_json_serializer(name)
+            assert utils.json_dumps(data, sort_keys=True) \
+                == b'{"a":"2017-01-02T03:04:05Z","b":"2017-01-02T03:04:05Z"}'
+            assert utils.json_dumps([1], pretty=True) == b'[\n  1\n]'
+    finally:
+        utils.set_json_serializer()
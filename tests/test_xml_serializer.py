@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import re
+import six
+import decimal
+import datetime
+import pytest
+from mocha.extras import xml_serializer
+
+dicttoxml = pytest.importorskip("dicttoxml")
+dicttoxml_compatible = pytest.mark.skipif(
+    dicttoxml.__version__ != "1.6.6",
+    reason="The output is the one of dicttoxml 1.6.6")
+
+CORPUS = [
+    {},
+    [],
+    "text",
+    10,
+    True,
+    None,
+    {"name": "Mocha", "count": 3, "ratio": 0.5, "active": True,
+     "none": None, "price": decimal.Decimal("9.99")},
+    {"escaped": "<a href='x'>Tom & \"Jerry\"</a>", "unicode": u"café ☕"},
+    {"date": datetime.date(2017, 1, 2),
+     "datetime": datetime.datetime(2017, 1, 2, 3, 4, 5)},
+    {"nested": {"list": [1, "a", None, True, [1, 2], {"k": "v"}],
+                "tuple": (1, 2),
+                "dict": {"a": {"b": {"c": "d"}}}}},
+    {"1": "digit key", "1.5": "float key", "has space": "x", "-1": "neg"},
+    [{"id": i, "tags": ["a", "b"]} for i in range(5)],
+]
+
+
+@dicttoxml_compatible
+@pytest.mark.parametrize("data", CORPUS)
+def test_dicttoxml_compatible(data):
+    expected = dicttoxml.dicttoxml(data)
+    if six.PY2:
+        # dicttoxml orders the attributes by their hash on Python 2
+        expected = re.sub(br'<key type="(\w+)" name="([^"]*)">',
+                          br'<key name="\2" type="\1">', expected)
+    assert xml_serializer.dumps(data) == expected
+
+
+@pytest.mark.parametrize("data", CORPUS)
+def test_iter_xml(data):
+    chunks = xml_serializer.iter_xml(data, chunk_size=2)
+    assert "".join(chunks).encode("utf-8") == xml_serializer.dumps(data)
+
+
+def test_keys():
+    for key, tag in [(1, '<n1 type="str">'),
+                     (1.5, '<key name="1.5" type="str">'),
+                     (b"bytes", '<bytes type="str">'),
+                     ("a&b", '<key name="a&amp;b" type="str">'),
+                     ("<bad>", '<key name="&lt;bad&gt;" type="str">')]:
+        assert xml_serializer.dumps({key: "v"}) \
+            == ('<?xml version="1.0" encoding="UTF-8" ?><root>%sv%s</root>'
+                % (tag, "</%s>" % tag[1:].split(" ")[0])).encode("utf-8")
+
+
+def test_bytes():
+    data = {"bytes": u"café".encode("utf-8"), "list": [b"a&b"]}
+    assert xml_serializer.dumps(data) \
+        == xml_serializer.dumps({"bytes": u"café", "list": [u"a&b"]})
+    assert xml_serializer.dumps(b"x") == xml_serializer.dumps(u"x")
+
+
+@dicttoxml_compatible
+def test_generator():
+    data = {"items": (i for i in range(3))}
+    expected = dicttoxml.dicttoxml({"items": [0, 1, 2]})
+    assert xml_serializer.dumps(data) == expected